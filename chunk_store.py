@@ -0,0 +1,537 @@
+# START OF FILE chunk_store.py #
+
+import os
+import re
+import json
+import zlib
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Tuple, Any
+
+import near_duplicates
+
+logger = logging.getLogger(__name__)
+
+# SQLite ограничивает число параметров в одном запросе
+_QUERY_BATCH = 500
+_SCHEMA_VERSION = 5
+# Слова запроса для полнотекстового поиска (разбиение на токены повторяет токенизатор unicode61)
+_TERM_RE = re.compile(r'\w+')
+# Поля каталога источников, по которым допустима сортировка
+SOURCE_SORT_FIELDS = ('name', 'chunk_count', 'byte_size', 'ingested_at')
+
+
+class ChunkStore:
+    """
+    Дисковое хранилище текстов и метаданных чанков, адресуемое по int64 id вектора в индексе FAISS.
+    В памяти ничего не держится: при поиске читаются только найденные чанки, поэтому
+    время запуска и потребление памяти не зависят от числа чанков в базе.
+
+    Тексты хранятся сжатыми (zlib), а метаданные - один раз на источник: все чанки документа
+    ссылаются на одну строку таблицы `metadata` вместо собственной копии словаря.
+    Каталог источников (`sources`) обновляется в той же транзакции, что и чанки, поэтому список
+    документов и их число читаются за время, не зависящее от числа чанков.
+    Рядом ведется полнотекстовый индекс FTS5 (`chunks_fts`, ранжирование BM25) - для артикулов, кодов
+    и точных формулировок, которые плохо ловит векторный поиск. Он обновляется в тех же транзакциях,
+    что и чанки, и не хранит копию текста (contentless).
+
+    Источник владеет чанками через ссылки (`chunk_refs`). Почти дубликат чанка, уже сохраненного
+    другим источником, не записывается повторно: новый источник лишь ссылается на существующий чанк,
+    и чанк удаляется, только когда на него не осталось ни одной ссылки. Для поиска почти дубликатов
+    у каждого чанка хранится отпечаток SimHash (`chunk_fingerprints`).
+
+    Ключи источника (`source_keys`) - отпечатки исходного файла, например хеш содержимого или
+    идентификатор файла в Telegram/Google Drive. По ним уже загруженный файл узнается до скачивания.
+
+    Чтение чанков для поиска (get) идет через отдельное соединение каждого потока: в режиме WAL
+    SQLite читатели не ждут незавершенной транзакции писателя.
+    """
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._db_path = db_path
+        self._readers = threading.local()
+        self._reader_conns: List[sqlite3.Connection] = []
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Потерю последних транзакций при сбое питания покрывает журнал изменений базы знаний
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+                self._migrate()
+
+    def _create_tables(self):
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (metadata_id INTEGER PRIMARY KEY, source_id TEXT, "
+            "body TEXT NOT NULL UNIQUE)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_source_id ON metadata(source_id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (index_id INTEGER PRIMARY KEY, doc_id TEXT NOT NULL UNIQUE, "
+            "metadata_id INTEGER NOT NULL REFERENCES metadata(metadata_id), text BLOB NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_metadata_id ON chunks(metadata_id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sources (source_id TEXT PRIMARY KEY, name TEXT, "
+            "chunk_count INTEGER NOT NULL, byte_size INTEGER, ingested_at REAL, content_hash TEXT)")
+        # Составные индексы позволяют отдавать страницу отсортированного списка без сортировки всего каталога
+        for field in SOURCE_SORT_FIELDS:
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_sources_{field} ON sources({field}, source_id)")
+        # rowid строки FTS совпадает с index_id чанка
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(text, content='', "
+            "tokenize='unicode61 remove_diacritics 2')")
+        # metadata_id ссылки - метаданные, с которыми источник загрузил этот чанк
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_refs (source_id TEXT NOT NULL, index_id INTEGER NOT NULL, "
+            "metadata_id INTEGER NOT NULL, PRIMARY KEY (source_id, index_id)) WITHOUT ROWID")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunk_refs_index_id ON chunk_refs(index_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunk_refs_metadata_id ON chunk_refs(metadata_id)")
+        band_columns = ', '.join(f"band{i} INTEGER NOT NULL" for i in range(near_duplicates.BANDS))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_fingerprints (index_id INTEGER PRIMARY KEY, simhash INTEGER NOT NULL, "
+            f"{band_columns})")
+        for i in range(near_duplicates.BANDS):
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_chunk_fingerprints_band{i} ON chunk_fingerprints(band{i})")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS source_keys (key TEXT PRIMARY KEY, source_id TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_source_keys_source_id ON source_keys(source_id)")
+
+    def _migrate(self):
+        """Создает схему или переводит хранилище предыдущих версий на текущую."""
+        # Явная транзакция: иначе переименование таблицы зафиксируется отдельно от переноса строк
+        self._conn.execute("BEGIN")
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")]
+        if 'metadata' in columns:
+            logger.info("Перевожу хранилище чанков на формат с общими метаданными источника...")
+            self._conn.execute("ALTER TABLE chunks RENAME TO chunks_v0")
+            self._conn.execute("DROP INDEX IF EXISTS idx_chunks_source_id")
+            self._create_tables()
+            cursor = self._conn.execute("SELECT index_id, doc_id, text, metadata FROM chunks_v0")
+            while rows := cursor.fetchmany(_QUERY_BATCH):
+                self._insert(rows)
+            self._conn.execute("DROP TABLE chunks_v0")
+        self._create_tables()
+        if columns and version < 2:
+            self._rebuild_catalog()
+        if columns and version < 3:
+            self._rebuild_lexical_index()
+        if columns and version < 4:
+            self._rebuild_refs_and_fingerprints()
+        self._conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _rebuild_catalog(self):
+        """Заполняет каталог по уже сохраненным чанкам. Размер, время загрузки и хеш таких источников неизвестны."""
+        counts: Dict[str, List] = {}
+        rows = self._conn.execute(
+            "SELECT m.source_id, m.body, COUNT(*) FROM chunks c JOIN metadata m ON m.metadata_id = c.metadata_id "
+            "WHERE m.source_id IS NOT NULL GROUP BY m.metadata_id")
+        for source_id, body, count in rows:
+            entry = counts.setdefault(source_id, [json.loads(body).get('source'), 0])
+            entry[1] += count
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO sources (source_id, name, chunk_count) VALUES (?, ?, ?)",
+            [(source_id, name, count) for source_id, (name, count) in counts.items()])
+
+    def _rebuild_lexical_index(self):
+        """Заполняет полнотекстовый индекс по уже сохраненным чанкам."""
+        logger.info("Строю полнотекстовый индекс по сохраненным чанкам...")
+        self._conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('delete-all')")
+        cursor = self._conn.execute("SELECT index_id, text FROM chunks")
+        while rows := cursor.fetchmany(_QUERY_BATCH):
+            self._conn.executemany("INSERT INTO chunks_fts (rowid, text) VALUES (?, ?)",
+                                   [(index_id, zlib.decompress(text).decode('utf-8')) for index_id, text in rows])
+
+    def _rebuild_refs_and_fingerprints(self):
+        """Заполняет ссылки источников и отпечатки почти дубликатов по уже сохраненным чанкам."""
+        logger.info("Строю ссылки источников и отпечатки почти дубликатов по сохраненным чанкам...")
+        self._conn.execute(
+            "INSERT OR IGNORE INTO chunk_refs (source_id, index_id, metadata_id) "
+            "SELECT m.source_id, c.index_id, c.metadata_id FROM chunks c "
+            "JOIN metadata m ON m.metadata_id = c.metadata_id WHERE m.source_id IS NOT NULL")
+        cursor = self._conn.execute(
+            "SELECT index_id, text FROM chunks WHERE index_id NOT IN (SELECT index_id FROM chunk_fingerprints)")
+        while rows := cursor.fetchmany(_QUERY_BATCH):
+            for index_id, text in rows:
+                self._insert_fingerprint(index_id, zlib.decompress(text).decode('utf-8'))
+
+    def _insert_fingerprint(self, index_id: int, text: str):
+        fingerprint = near_duplicates.simhash(text)
+        if fingerprint is not None:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO chunk_fingerprints VALUES (?, ?, {','.join('?' * near_duplicates.BANDS)})",
+                (index_id, fingerprint, *near_duplicates.bands(fingerprint)))
+
+    def _metadata_id(self, body: str, source_id: str | None) -> int:
+        self._conn.execute("INSERT OR IGNORE INTO metadata (source_id, body) VALUES (?, ?)", (source_id, body))
+        return self._conn.execute("SELECT metadata_id FROM metadata WHERE body = ?", (body,)).fetchone()[0]
+
+    def _existing_index_ids(self, index_ids: List[int]) -> set:
+        existing = set()
+        for start in range(0, len(index_ids), _QUERY_BATCH):
+            batch = index_ids[start:start + _QUERY_BATCH]
+            existing.update(row[0] for row in self._conn.execute(
+                f"SELECT index_id FROM chunks WHERE index_id IN ({','.join('?' * len(batch))})", batch))
+        return existing
+
+    def _insert(self, rows: List[Tuple[int, str, str, str]]):
+        """Вставляет строки (index_id, doc_id, текст, метаданные в JSON)."""
+        metadata_ids: Dict[str, Tuple[int, str | None]] = {}
+        for index_id, doc_id, text, body in rows:
+            if body not in metadata_ids:
+                metadata = json.loads(body)
+                normalized = json.dumps(metadata, ensure_ascii=False, sort_keys=True)
+                source_id = metadata.get('source_id')
+                metadata_ids[body] = self._metadata_id(normalized, source_id), source_id
+            metadata_id, source_id = metadata_ids[body]
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO chunks (index_id, doc_id, metadata_id, text) VALUES (?, ?, ?, ?)",
+                (index_id, doc_id, metadata_id, zlib.compress(text.encode('utf-8')))).rowcount
+            if inserted:
+                self._conn.execute("INSERT INTO chunks_fts (rowid, text) VALUES (?, ?)", (index_id, text))
+                self._insert_fingerprint(index_id, text)
+                if source_id:
+                    self._conn.execute("INSERT OR IGNORE INTO chunk_refs (source_id, index_id, metadata_id) "
+                                       "VALUES (?, ?, ?)", (source_id, index_id, metadata_id))
+
+    def add(self, index_ids: List[int], doc_ids: List[str], texts: List[str], metadata: Dict[str, Any],
+            byte_size: int | None = None, ingested_at: float | None = None, content_hash: str | None = None):
+        """
+        Сохраняет чанки одного источника. Уже существующие id пропускаются, поэтому повторная запись безопасна.
+        :param byte_size: Размер исходного текста документа (для каталога источников).
+        :param ingested_at: Время загрузки документа (unix time).
+        :param content_hash: Хеш содержимого документа.
+        """
+        body = json.dumps(metadata, ensure_ascii=False)
+        source_id = metadata.get('source_id')
+        with self._lock, self._conn:
+            existing = self._existing_index_ids(index_ids)
+            self._insert([(index_id, doc_id, text, body) for index_id, doc_id, text in zip(index_ids, doc_ids, texts)
+                          if index_id not in existing])
+            added = len(index_ids) - len(existing)
+            if source_id and added:
+                self._count_source_chunks(metadata, added, byte_size, ingested_at, content_hash)
+
+    def add_refs(self, index_ids: List[int], metadata: Dict[str, Any], byte_size: int | None = None,
+                 ingested_at: float | None = None, content_hash: str | None = None) -> List[int]:
+        """
+        Добавляет источнику metadata['source_id'] ссылки на уже сохраненные чанки (его почти дубликаты).
+        Повторная запись безопасна.
+        :return: id из index_ids, которых в хранилище уже нет (их удалили после поиска дубликатов).
+        """
+        source_id = metadata['source_id']
+        with self._lock, self._conn:
+            existing = self._existing_index_ids(index_ids)
+            metadata_id = self._metadata_id(json.dumps(metadata, ensure_ascii=False, sort_keys=True), source_id)
+            added = sum(self._conn.execute(
+                "INSERT OR IGNORE INTO chunk_refs (source_id, index_id, metadata_id) VALUES (?, ?, ?)",
+                (source_id, index_id, metadata_id)).rowcount for index_id in existing)
+            if added:
+                self._count_source_chunks(metadata, added, byte_size, ingested_at, content_hash)
+            self._delete_unused_metadata([metadata_id])
+        return [index_id for index_id in index_ids if index_id not in existing]
+
+    def _count_source_chunks(self, metadata: Dict[str, Any], added: int, byte_size: int | None,
+                             ingested_at: float | None, content_hash: str | None):
+        source_id = metadata['source_id']
+        self._conn.execute(
+            "INSERT OR IGNORE INTO sources (source_id, name, chunk_count, byte_size, ingested_at, content_hash) "
+            "VALUES (?, ?, 0, ?, ?, ?)", (source_id, metadata.get('source'), byte_size, ingested_at, content_hash))
+        self._conn.execute("UPDATE sources SET chunk_count = chunk_count + ? WHERE source_id = ?",
+                           (added, source_id))
+
+    def find_near_duplicates(self, texts: List[str]) -> List[int | None]:
+        """
+        Ищет среди сохраненных чанков почти дубликаты текстов: кандидаты отбираются по совпадающей полосе
+        отпечатка SimHash, а затем проверяются по расстоянию между отпечатками и доле общих шинглов.
+        :return: Для каждого текста - id найденного чанка или None.
+        """
+        reader = self._reader()
+        band_query = " UNION ".join(f"SELECT index_id FROM chunk_fingerprints WHERE band{i} = ?"
+                                    for i in range(near_duplicates.BANDS))
+        matches: List[int | None] = []
+        for text in texts:
+            fingerprint, match, text_shingles = near_duplicates.simhash(text), None, None
+            if fingerprint is not None:
+                # Ссылки обязательны: чанк без источника нельзя разделить, его некому удалять
+                candidates = reader.execute(
+                    "SELECT f.index_id, f.simhash, c.text FROM chunk_fingerprints f "
+                    f"JOIN chunks c ON c.index_id = f.index_id WHERE f.index_id IN ({band_query}) "
+                    "AND EXISTS (SELECT 1 FROM chunk_refs r WHERE r.index_id = f.index_id) LIMIT 64",
+                    near_duplicates.bands(fingerprint)).fetchall()
+                for index_id, candidate_fingerprint, candidate_text in candidates:
+                    if near_duplicates.distance(fingerprint, candidate_fingerprint) > near_duplicates.MAX_DISTANCE:
+                        continue
+                    text_shingles = text_shingles or near_duplicates.shingles(text)
+                    candidate_shingles = near_duplicates.shingles(zlib.decompress(candidate_text).decode('utf-8'))
+                    if near_duplicates.similarity(text_shingles, candidate_shingles) >= near_duplicates.MIN_SIMILARITY:
+                        match = index_id
+                        break
+            matches.append(match)
+        return matches
+
+    def orphaned_by_source(self, source_id: str) -> List[int]:
+        """Id чанков, на которые ссылается только этот источник (удаляются вместе с ним)."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT r.index_id FROM chunk_refs r WHERE r.source_id = ? AND NOT EXISTS "
+                "(SELECT 1 FROM chunk_refs o WHERE o.index_id = r.index_id AND o.source_id != r.source_id)",
+                (source_id,))]
+
+    def remove_source(self, source_id: str):
+        """
+        Удаляет ссылки источника и его строку каталога. Сами чанки не трогаются: оставшиеся без ссылок
+        удаляются отдельно (delete), а общие с другими источниками переходят к метаданным одного из них.
+        """
+        with self._lock, self._conn:
+            metadata_ids = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT metadata_id FROM chunk_refs WHERE source_id = ?", (source_id,))]
+            self._conn.execute("DELETE FROM chunk_refs WHERE source_id = ?", (source_id,))
+            for metadata_id in metadata_ids:
+                self._conn.execute(
+                    "UPDATE chunks SET metadata_id = (SELECT r.metadata_id FROM chunk_refs r "
+                    "WHERE r.index_id = chunks.index_id LIMIT 1) WHERE metadata_id = ? "
+                    "AND EXISTS (SELECT 1 FROM chunk_refs r WHERE r.index_id = chunks.index_id)", (metadata_id,))
+            self._conn.execute("DELETE FROM sources WHERE source_id = ?", (source_id,))
+            self._conn.execute("DELETE FROM source_keys WHERE source_id = ?", (source_id,))
+            self._delete_unused_metadata(metadata_ids)
+
+    def _delete_unused_metadata(self, metadata_ids):
+        self._conn.executemany(
+            "DELETE FROM metadata WHERE metadata_id = ? "
+            "AND NOT EXISTS (SELECT 1 FROM chunks WHERE chunks.metadata_id = metadata.metadata_id) "
+            "AND NOT EXISTS (SELECT 1 FROM chunk_refs WHERE chunk_refs.metadata_id = metadata.metadata_id)",
+            [(metadata_id,) for metadata_id in metadata_ids])
+
+    def delete(self, index_ids: List[int]):
+        """Удаляет чанки, ссылки источников на них и метаданные, на которые больше никто не ссылается."""
+        with self._lock, self._conn:
+            metadata_ids = set()
+            removed_by_source: Dict[str, int] = {}
+            for start in range(0, len(index_ids), _QUERY_BATCH):
+                batch = index_ids[start:start + _QUERY_BATCH]
+                placeholders = ','.join('?' * len(batch))
+                metadata_ids.update(row[0] for row in self._conn.execute(
+                    f"SELECT metadata_id FROM chunks WHERE index_id IN ({placeholders}) "
+                    f"UNION SELECT metadata_id FROM chunk_refs WHERE index_id IN ({placeholders})", batch + batch))
+                for source_id, count in self._conn.execute(
+                        f"SELECT source_id, COUNT(*) FROM chunk_refs WHERE index_id IN ({placeholders}) "
+                        "GROUP BY source_id", batch):
+                    removed_by_source[source_id] = removed_by_source.get(source_id, 0) + count
+                self._conn.execute(f"DELETE FROM chunk_refs WHERE index_id IN ({placeholders})", batch)
+                self._conn.execute(f"DELETE FROM chunk_fingerprints WHERE index_id IN ({placeholders})", batch)
+                # Из contentless-индекса FTS строка удаляется по тому же тексту, с которым была добавлена
+                removed_texts = self._conn.execute(
+                    f"SELECT index_id, text FROM chunks WHERE index_id IN ({placeholders})", batch).fetchall()
+                self._conn.executemany(
+                    "INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', ?, ?)",
+                    [(index_id, zlib.decompress(text).decode('utf-8')) for index_id, text in removed_texts])
+                self._conn.execute(f"DELETE FROM chunks WHERE index_id IN ({placeholders})", batch)
+            self._conn.executemany("UPDATE sources SET chunk_count = chunk_count - ? WHERE source_id = ?",
+                                   [(count, source_id) for source_id, count in removed_by_source.items()])
+            self._conn.executemany("DELETE FROM sources WHERE source_id = ? AND chunk_count <= 0",
+                                   [(source_id,) for source_id in removed_by_source])
+            self._conn.executemany(
+                "DELETE FROM source_keys WHERE source_id = ? "
+                "AND NOT EXISTS (SELECT 1 FROM sources WHERE sources.source_id = source_keys.source_id)",
+                [(source_id,) for source_id in removed_by_source])
+            self._delete_unused_metadata(metadata_ids)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.execute("DELETE FROM chunk_refs")
+            self._conn.execute("DELETE FROM chunk_fingerprints")
+            self._conn.execute("DELETE FROM metadata")
+            self._conn.execute("DELETE FROM sources")
+            self._conn.execute("DELETE FROM source_keys")
+            self._conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('delete-all')")
+
+    def get(self, index_ids: List[int]) -> Dict[int, Tuple[str, Dict[str, Any]]]:
+        """:return: Словарь {id в индексе: (текст, метаданные)} для найденных чанков."""
+        found = {}
+        parsed: Dict[int, Dict[str, Any]] = {}
+        reader = self._reader()
+        for start in range(0, len(index_ids), _QUERY_BATCH):
+            batch = index_ids[start:start + _QUERY_BATCH]
+            rows = reader.execute(
+                "SELECT c.index_id, c.text, m.metadata_id, m.body FROM chunks c "
+                f"JOIN metadata m ON m.metadata_id = c.metadata_id WHERE c.index_id IN ({','.join('?' * len(batch))})",
+                batch).fetchall()
+            for index_id, text, metadata_id, body in rows:
+                if metadata_id not in parsed:
+                    parsed[metadata_id] = json.loads(body)
+                # Каждый чанк получает свою копию, чтобы изменения вызывающего кода не затрагивали соседей
+                found[index_id] = (zlib.decompress(text).decode('utf-8'), dict(parsed[metadata_id]))
+        return found
+
+    def lexical_search(self, query: str, limit: int, max_term_chunks: int = 2000,
+                       source_ids: List[str] | None = None, max_index_id: int | None = None) -> List[int]:
+        """
+        Полнотекстовый поиск по чанкам: чанк подходит, если содержит хотя бы одно слово запроса,
+        а ранжирование по BM25 поднимает чанки с редкими словами (артикулы, коды) и со всеми словами сразу.
+        :param max_term_chunks: Слова, встречающиеся в большем числе чанков, не участвуют в поиске.
+                                BM25 почти не учитывает такие слова, а ранжирование всех их вхождений
+                                стоило бы десятки миллисекунд на большой базе.
+        :param source_ids: Если задано - искать только в чанках этих источников.
+        :param max_index_id: Если задано - не возвращать чанки с большими id (записанные после снимка индекса).
+        :return: id чанков от наиболее релевантного.
+        """
+        terms = dict.fromkeys(_TERM_RE.findall(query.lower()))
+        if not terms or limit <= 0:
+            return []
+        reader = self._reader()
+        # Частота слова проверяется запросом с LIMIT: работа ограничена max_term_chunks строками на слово
+        rare_terms = [term for term in terms if reader.execute(
+            "SELECT COUNT(*) FROM (SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH ? LIMIT ?)",
+            (f'"{term}"', max_term_chunks + 1)).fetchone()[0] <= max_term_chunks]
+        if not rare_terms:
+            return []
+        sql = "SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH ?"
+        params = [" OR ".join(f'"{term}"' for term in rare_terms)]
+        if source_ids is not None:
+            sql += (" AND rowid IN (SELECT index_id FROM chunk_refs "
+                    f"WHERE source_id IN ({','.join('?' * len(source_ids))}))")
+            params.extend(source_ids)
+        if max_index_id is not None:
+            sql += " AND rowid <= ?"
+            params.append(max_index_id)
+        rows = reader.execute(f"{sql} ORDER BY rank LIMIT ?", (*params, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, check_same_thread=False)
+            self._readers.conn = conn
+            with self._lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def index_ids_for(self, doc_ids: List[str]) -> Dict[str, int]:
+        """:return: Словарь {id чанка: id в индексе} для известных хранилищу чанков."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(doc_ids), _QUERY_BATCH):
+                batch = doc_ids[start:start + _QUERY_BATCH]
+                found.update(self._conn.execute(
+                    f"SELECT doc_id, index_id FROM chunks WHERE doc_id IN ({','.join('?' * len(batch))})",
+                    batch).fetchall())
+        return found
+
+    def index_ids_for_source(self, source_id: str) -> List[int]:
+        """Id всех чанков источника, включая общие с другими источниками."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT index_id FROM chunk_refs WHERE source_id = ?", (source_id,))]
+
+    def index_ids_for_sources(self, source_ids: List[str]) -> List[int]:
+        """Id чанков нескольких источников (для поиска с фильтром). Читается без блокировки писателя."""
+        ids = []
+        reader = self._reader()
+        for start in range(0, len(source_ids), _QUERY_BATCH):
+            batch = source_ids[start:start + _QUERY_BATCH]
+            ids.extend(row[0] for row in reader.execute(
+                f"SELECT index_id FROM chunk_refs WHERE source_id IN ({','.join('?' * len(batch))})", batch))
+        return ids
+
+    def update_source(self, source_id: str, byte_size: int | None, content_hash: str | None):
+        """Записывает размер и хеш источника, которые при потоковой загрузке известны только в конце."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE sources SET byte_size = ?, content_hash = ? WHERE source_id = ?",
+                               (byte_size, content_hash, source_id))
+
+    def add_source_keys(self, source_id: str, keys: List[str]):
+        """Связывает ключи (отпечатки исходного файла) с источником; ключ другого источника переназначается."""
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO source_keys (key, source_id) VALUES (?, ?)",
+                                   [(key, source_id) for key in keys])
+
+    def find_source(self, keys: List[str]) -> str | None:
+        """:return: source_id существующего источника с любым из ключей или None."""
+        if not keys:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT k.source_id FROM source_keys k JOIN sources s ON s.source_id = k.source_id "
+                f"WHERE k.key IN ({','.join('?' * len(keys))}) LIMIT 1", keys).fetchone()
+        return row[0] if row else None
+
+    def rename_source(self, source_id: str, name: str) -> bool:
+        """
+        Меняет отображаемое имя источника в каталоге и в метаданных его чанков.
+        :return: False, если источника нет.
+        """
+        with self._lock, self._conn:
+            if not self._conn.execute("UPDATE sources SET name = ? WHERE source_id = ?", (name, source_id)).rowcount:
+                return False
+            rows = self._conn.execute("SELECT metadata_id, body FROM metadata WHERE source_id = ?",
+                                      (source_id,)).fetchall()
+            for metadata_id, body in rows:
+                metadata = json.loads(body)
+                metadata['source'] = name
+                renamed_id = self._metadata_id(json.dumps(metadata, ensure_ascii=False, sort_keys=True), source_id)
+                if renamed_id != metadata_id:
+                    self._conn.execute("UPDATE chunks SET metadata_id = ? WHERE metadata_id = ?",
+                                       (renamed_id, metadata_id))
+                    self._conn.execute("UPDATE chunk_refs SET metadata_id = ? WHERE metadata_id = ?",
+                                       (renamed_id, metadata_id))
+                    self._conn.execute("DELETE FROM metadata WHERE metadata_id = ?", (metadata_id,))
+            return True
+
+    def has_source(self, source_id: str) -> bool:
+        return self.get_source(source_id) is not None
+
+    def get_source(self, source_id: str) -> Dict[str, Any] | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_SOURCE_COLUMNS} FROM sources WHERE source_id = ?",
+                                     (source_id,)).fetchone()
+        return _source_from_row(row) if row else None
+
+    def list_sources(self, offset: int = 0, limit: int | None = None, order_by: str = 'ingested_at',
+                     descending: bool = False) -> List[Dict[str, Any]]:
+        """
+        Страница каталога источников.
+        :param order_by: Поле сортировки, одно из SOURCE_SORT_FIELDS.
+        :return: Словари с ключами source_id, source (имя файла), chunk_count, byte_size, ingested_at, content_hash.
+        """
+        if order_by not in SOURCE_SORT_FIELDS:
+            raise ValueError(f"Недопустимое поле сортировки источников: {order_by}")
+        direction = 'DESC' if descending else 'ASC'
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_SOURCE_COLUMNS} FROM sources ORDER BY {order_by} {direction}, source_id {direction} "
+                "LIMIT ? OFFSET ?", (-1 if limit is None else limit, offset)).fetchall()
+        return [_source_from_row(row) for row in rows]
+
+    def count_sources(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+
+    def max_index_id(self) -> int:
+        """Наибольший занятый id в индексе или -1 для пустого хранилища."""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(index_id), -1) FROM chunks").fetchone()[0]
+
+    def flush(self):
+        """Переносит журнал SQLite в основной файл и сбрасывает его на диск."""
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def close(self):
+        with self._lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._conn.close()
+
+
+_SOURCE_COLUMNS = "source_id, name, chunk_count, byte_size, ingested_at, content_hash"
+
+
+def _source_from_row(row: Tuple) -> Dict[str, Any]:
+    source_id, name, chunk_count, byte_size, ingested_at, content_hash = row
+    return {'source_id': source_id, 'source': name, 'chunk_count': chunk_count, 'byte_size': byte_size,
+            'ingested_at': ingested_at, 'content_hash': content_hash}
+
+# END OF FILE chunk_store.py #
@@ -102,9 +102,107 @@ GOOGLE_API_SCOPES = ['https://www.googleapis.com/auth/drive.readonly', 'https://
 EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
 VECTOR_STORE_PATH = os.path.join(DATA_DIR, 'faiss_index')
 SOURCE_MAP_PATH = os.path.join(DATA_DIR, 'source_map.json')
+# Тексты и метаданные чанков хранятся на диске и читаются только для найденных при поиске чанков
+CHUNK_STORE_PATH = os.path.join(DATA_DIR, 'chunk_store.sqlite3')
+# Режим "преимущественно чтение": индекс отображается из файла (mmap), а не читается в память целиком.
+# Запуск почти не зависит от размера базы; при первом изменении индекс копируется в память до следующего снимка
+KB_INDEX_MMAP = os.getenv('KB_INDEX_MMAP', 'false').lower() in ('1', 'true', 'yes')
+# Журнал изменений сворачивается в новый снимок индекса, когда превышает размер или возраст
+KB_WAL_COMPACT_SIZE_MB = int(os.getenv('KB_WAL_COMPACT_SIZE_MB', 64))
+KB_WAL_COMPACT_INTERVAL_SECONDS = int(os.getenv('KB_WAL_COMPACT_INTERVAL_SECONDS', 3600))
+# Дисковый кэш векторов чанков (ключ - хеш текста и имени модели)
+EMBEDDING_CACHE_PATH = os.path.join(DATA_DIR, 'embedding_cache.sqlite3')
+EMBEDDING_CACHE_MAX_MB = int(os.getenv('EMBEDDING_CACHE_MAX_MB', 512))
+# Размер батча при векторизации и число процессов для нее (0 - векторизация в текущем потоке)
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 64))
+EMBEDDING_WORKERS = int(os.getenv('EMBEDDING_WORKERS', 0))
+# База начинает с точного плоского индекса и переходит на ANN-индекс KB_INDEX_TYPE,
+# когда число чанков достигает KB_INDEX_PROMOTE_THRESHOLD. Варианты: flat, ivf_flat, ivf_pq, hnsw
+KB_INDEX_TYPE = os.getenv('KB_INDEX_TYPE', 'ivf_flat').lower()
+if KB_INDEX_TYPE not in ["flat", "ivf_flat", "ivf_pq", "hnsw"]:
+    logger.warning(f"Некорректный KB_INDEX_TYPE: {KB_INDEX_TYPE}. Установлено значение по умолчанию 'ivf_flat'.")
+    KB_INDEX_TYPE = 'ivf_flat'
+KB_INDEX_PROMOTE_THRESHOLD = int(os.getenv('KB_INDEX_PROMOTE_THRESHOLD', 50000))
+# Параметры поиска (nprobe / efSearch) подбираются так, чтобы recall@10 относительно точного поиска был не ниже этого
+KB_INDEX_TARGET_RECALL = float(os.getenv('KB_INDEX_TARGET_RECALL', 0.95))
+KB_IVF_NLIST = int(os.getenv('KB_IVF_NLIST', 0))  # 0 - подобрать по размеру базы
+KB_IVF_PQ_M = int(os.getenv('KB_IVF_PQ_M', 48))
+KB_HNSW_M = int(os.getenv('KB_HNSW_M', 32))
+# Сжатие векторов плоского индекса: none, fp16, sq8 или pq (KB_IVF_PQ_M подквантователей по 8 бит).
+# Точные векторы сжатого индекса (и IVF-PQ) хранятся на диске, и KB_RERANK_FACTOR * k его кандидатов
+# переранжируются по ним. Recall сжатого индекса пишется в лог при его построении
+KB_VECTOR_COMPRESSION = os.getenv('KB_VECTOR_COMPRESSION', 'none').lower()
+if KB_VECTOR_COMPRESSION not in ["none", "fp16", "sq8", "pq"]:
+    logger.warning(f"Некорректный KB_VECTOR_COMPRESSION: {KB_VECTOR_COMPRESSION}. Установлено значение по умолчанию 'none'.")
+    KB_VECTOR_COMPRESSION = 'none'
+KB_RERANK_FACTOR = max(1, int(os.getenv('KB_RERANK_FACTOR', 4)))
+# Почти дубликаты чанков (SimHash + доля общих шинглов), уже загруженные другим источником, не векторизуются
+# и не хранятся повторно: новый источник ссылается на существующий чанк
+KB_CHUNK_DEDUP = os.getenv('KB_CHUNK_DEDUP', 'true').lower() in ('1', 'true', 'yes')
+# Удаленные чанки сразу исключаются из поиска, а физически удаляются из индекса в фоне,
+# когда их доля достигает KB_TOMBSTONE_COMPACT_RATIO (но не раньше KB_TOMBSTONE_COMPACT_MIN штук)
+KB_TOMBSTONE_COMPACT_RATIO = float(os.getenv('KB_TOMBSTONE_COMPACT_RATIO', 0.2))
+KB_TOMBSTONE_COMPACT_MIN = int(os.getenv('KB_TOMBSTONE_COMPACT_MIN', 1000))
+# Новые векторы ищутся полным перебором в дельте, пока она не вольется в основной индекс при компактизации
+KB_DELTA_MERGE_SIZE = int(os.getenv('KB_DELTA_MERGE_SIZE', 20000))
+# Гибридный поиск: выдачи векторного и полнотекстового (BM25) поиска объединяются методом RRF.
+# KB_HYBRID_LEXICAL_WEIGHT - вес полнотекстового поиска: 0 - только векторный, 1 - только BM25
+KB_HYBRID_LEXICAL_WEIGHT = float(os.getenv('KB_HYBRID_LEXICAL_WEIGHT', 0.5))
+if not 0.0 <= KB_HYBRID_LEXICAL_WEIGHT <= 1.0:
+    logger.warning(f"Некорректный KB_HYBRID_LEXICAL_WEIGHT: {KB_HYBRID_LEXICAL_WEIGHT}. Установлено значение по умолчанию 0.5.")
+    KB_HYBRID_LEXICAL_WEIGHT = 0.5
+KB_HYBRID_CANDIDATES = int(os.getenv('KB_HYBRID_CANDIDATES', 20))  # кандидатов от каждого из двух поисков
+KB_RRF_K = int(os.getenv('KB_RRF_K', 60))
+# Слова, встречающиеся в большем числе чанков, не участвуют в полнотекстовом поиске (ограничивает его время)
+KB_LEXICAL_MAX_TERM_CHUNKS = int(os.getenv('KB_LEXICAL_MAX_TERM_CHUNKS', 2000))
+# Кэши в памяти для повторяющихся вопросов: эмбеддинг нормализованного запроса и найденные чанки
+# (ключ результата включает версию индекса, поэтому любое изменение базы делает старые результаты неактуальными)
+KB_QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('KB_QUERY_EMBEDDING_CACHE_SIZE', 1024))
+KB_SEARCH_RESULT_CACHE_SIZE = int(os.getenv('KB_SEARCH_RESULT_CACHE_SIZE', 1024))
+# Микропакетирование поиска: одиночные вопросы, пришедшие в пределах окна, ищутся одним пакетом
+# (один вызов модели и один матричный поиск). 0 - выключено
+KB_SEARCH_BATCH_WINDOW_MS = int(os.getenv('KB_SEARCH_BATCH_WINDOW_MS', 0))
+KB_SEARCH_BATCH_MAX_SIZE = int(os.getenv('KB_SEARCH_BATCH_MAX_SIZE', 32))
+# Отдельные базы знаний (коллекции): global - одна общая база, user - своя у каждого пользователя,
+# chat - своя у каждого чата. Коллекции загружаются при первом обращении и выгружаются давно
+# не использованные, когда загруженных больше KB_COLLECTIONS_MAX_LOADED или их индексы занимают
+# больше KB_COLLECTIONS_MEMORY_MB
+KB_COLLECTION_SCOPE = os.getenv('KB_COLLECTION_SCOPE', 'global').lower()
+if KB_COLLECTION_SCOPE not in ["global", "user", "chat"]:
+    logger.warning(f"Некорректный KB_COLLECTION_SCOPE: {KB_COLLECTION_SCOPE}. Установлено значение по умолчанию 'global'.")
+    KB_COLLECTION_SCOPE = 'global'
+KB_COLLECTIONS_DIR = os.path.join(DATA_DIR, 'collections')
+KB_COLLECTIONS_MAX_LOADED = int(os.getenv('KB_COLLECTIONS_MAX_LOADED', 32))
+KB_COLLECTIONS_MEMORY_MB = int(os.getenv('KB_COLLECTIONS_MEMORY_MB', 2048))
+# Очередь загрузки файлов: KB_INGEST_WORKERS файлов обрабатываются одновременно в отдельном пуле потоков,
+# у пользователя не больше KB_INGEST_MAX_JOBS_PER_USER незавершенных задач, а в очереди - не больше
+# KB_INGEST_MAX_PENDING ожидающих. Состояние задач переживает перезапуск бота
+KB_INGEST_JOBS_PATH = os.path.join(DATA_DIR, 'ingestion_jobs.sqlite3')
+KB_INGEST_WORKERS = int(os.getenv('KB_INGEST_WORKERS', 2))
+KB_INGEST_MAX_JOBS_PER_USER = int(os.getenv('KB_INGEST_MAX_JOBS_PER_USER', 5))
+KB_INGEST_MAX_PENDING = int(os.getenv('KB_INGEST_MAX_PENDING', 100))
+# Файлы не больше KB_INGEST_IN_MEMORY_MAX_MB (по размеру, заявленному до скачивания) скачиваются и разбираются
+# в памяти, более крупные - через временный файл в DOWNLOADS_DIR
+KB_INGEST_IN_MEMORY_MAX_MB = float(os.getenv('KB_INGEST_IN_MEMORY_MAX_MB', 20))
 
 # --- Валидация файлов ---
 MAX_FILE_SIZE_MB = int(os.getenv('MAX_FILE_SIZE_MB', 50))
+# Файлы разбираются в песочнице - пуле из PARSER_WORKERS процессов (0 - в потоке загрузки, без ограничений).
+# Процессу разбора доступно не больше PARSER_MEMORY_LIMIT_MB памяти и PARSER_CPU_LIMIT_SECONDS процессорного
+# времени на задачу, задача прерывается через PARSER_TIMEOUT_SECONDS, а процесс заменяется новым
+# после PARSER_WORKER_MAX_TASKS задач (0 - без ограничения)
+PARSER_WORKERS = int(os.getenv('PARSER_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+PARSER_MEMORY_LIMIT_MB = int(os.getenv('PARSER_MEMORY_LIMIT_MB', 1536))
+PARSER_CPU_LIMIT_SECONDS = int(os.getenv('PARSER_CPU_LIMIT_SECONDS', 300))
+PARSER_TIMEOUT_SECONDS = float(os.getenv('PARSER_TIMEOUT_SECONDS', 300))
+PARSER_WORKER_MAX_TASKS = int(os.getenv('PARSER_WORKER_MAX_TASKS', 50))
+# PDF разбирается диапазонами по PDF_PAGES_PER_TASK страниц параллельно в пуле разбора.
+# Страница, не разобранная за PDF_PAGE_TIMEOUT_SECONDS, пропускается
+PDF_PAGES_PER_TASK = max(1, int(os.getenv('PDF_PAGES_PER_TASK', 16)))
+PDF_PAGE_TIMEOUT_SECONDS = float(os.getenv('PDF_PAGE_TIMEOUT_SECONDS', 30))
+# Дисковый кэш извлеченного текста (ключ - хеш содержимого файла и версия парсера), 0 - отключен
+PARSED_TEXT_CACHE_PATH = os.path.join(DATA_DIR, 'parsed_text_cache.sqlite3')
+PARSED_TEXT_CACHE_MAX_MB = int(os.getenv('PARSED_TEXT_CACHE_MAX_MB', 1024))
 
 # --- ГЛАВНОЕ МЕНЮ ---
 MAIN_KEYBOARD_MARKUP = ReplyKeyboardMarkup(
@@ -0,0 +1,102 @@
+# START OF FILE embedding_cache.py #
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    Дисковый кэш векторов чанков, адресуемый по содержимому.
+    Ключ - SHA-256 от имени модели и текста чанка, поэтому один и тот же текст не прогоняется
+    через модель повторно, а смена модели автоматически дает новые ключи.
+    Объем ограничен `max_size_mb`; при переполнении вытесняются давно не использованные записи (LRU).
+    """
+
+    def __init__(self, db_path: str, model_name: str, max_size_mb: int):
+        self.model_name = model_name
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).digest()
+
+    def get_many(self, texts: List[str]) -> Dict[int, np.ndarray]:
+        """
+        Ищет векторы для списка текстов.
+        :return: Словарь {позиция текста в списке: вектор} только для найденных в кэше текстов.
+        """
+        keys = [self._key(text) for text in texts]
+        positions_by_key: Dict[bytes, List[int]] = {}
+        for i, key in enumerate(keys):
+            positions_by_key.setdefault(key, []).append(i)
+
+        found: Dict[int, np.ndarray] = {}
+        unique_keys = list(positions_by_key)
+        with self._lock:
+            # SQLite ограничивает число параметров в запросе, поэтому ищем порциями
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    for i in positions_by_key[key]:
+                        found[i] = vector
+                if rows:
+                    now = time.time()
+                    self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                           [(now, key) for key, _ in rows])
+            self._conn.commit()
+        return found
+
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        """Сохраняет векторы для текстов и при необходимости вытесняет старые записи."""
+        now = time.time()
+        rows = [(self._key(text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for text, vector in zip(texts, vectors)]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            if self._conn.total_changes > before and rows:
+                self._size_bytes += (self._conn.total_changes - before) * len(rows[0][1])
+            if self._size_bytes > self.max_size_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Освобождаем с запасом (до 90% лимита), чтобы не вытеснять по одной записи на каждую вставку
+        target = int(self.max_size_bytes * 0.9)
+        row = self._conn.execute("SELECT LENGTH(vector) FROM embeddings LIMIT 1").fetchone()
+        if not row:
+            self._size_bytes = 0
+            return
+        entries_to_remove = -(-(self._size_bytes - target) // row[0])
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (entries_to_remove,))
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        logger.info(f"Кэш эмбеддингов переполнен: вытеснено {entries_to_remove} записей.")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# END OF FILE embedding_cache.py #
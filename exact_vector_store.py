@@ -0,0 +1,84 @@
+# START OF FILE exact_vector_store.py #
+
+import os
+from typing import Iterator, Tuple
+
+import numpy as np
+
+# Сколько векторов читается и переписывается за раз при сохранении снимка
+_WRITE_BATCH = 8192
+
+
+class ExactVectorStore:
+    """
+    Точные (float32) векторы сжатого базового индекса, по которым переранжируются его кандидаты.
+    Векторы из снимка отображаются из файла (в памяти только страницы, к которым обращался поиск),
+    а влитые в индекс после снимка лежат в памяти до следующего сохранения.
+    Набор неизменяем: добавление возвращает новый объект, поэтому его можно публиковать в снимке индекса.
+    """
+
+    def __init__(self, dim: int, parts: Tuple[Tuple[np.ndarray, np.ndarray], ...] = ()):
+        """:param parts: Пары (id по возрастанию, их векторы)."""
+        self.dim = dim
+        self._parts = parts
+
+    @classmethod
+    def open(cls, path: str, dim: int) -> 'ExactVectorStore':
+        """Открывает векторы снимка: `{path}.vector_ids` (int64 по возрастанию) и `{path}.vectors` (float32)."""
+        ids = np.fromfile(f"{path}.vector_ids", dtype=np.int64)
+        if not len(ids):
+            return cls(dim)
+        vectors = np.memmap(f"{path}.vectors", dtype=np.float32, mode='r', shape=(len(ids), dim))
+        return cls(dim, ((ids, vectors),))
+
+    @staticmethod
+    def remove_files(path: str):
+        for suffix in ('.vector_ids', '.vectors'):
+            if os.path.exists(f"{path}{suffix}"):
+                os.remove(f"{path}{suffix}")
+
+    def with_vectors(self, ids: np.ndarray, vectors: np.ndarray) -> 'ExactVectorStore':
+        if not len(ids):
+            return self
+        order = np.argsort(ids, kind='stable')
+        return ExactVectorStore(self.dim, self._parts + ((ids[order], np.ascontiguousarray(vectors[order])),))
+
+    @property
+    def memory_bytes(self) -> int:
+        """Память под векторы, еще не записанные в снимок (отображенные из файла не учитываются)."""
+        return sum(vectors.nbytes for _, vectors in self._parts if not isinstance(vectors, np.memmap))
+
+    def get(self, ids: np.ndarray) -> np.ndarray:
+        """:return: Векторы по id; для неизвестных id строка заполнена NaN."""
+        result = np.full((len(ids), self.dim), np.nan, dtype=np.float32)
+        for part_ids, part_vectors in self._parts:
+            if not len(part_ids):
+                continue
+            positions = np.minimum(np.searchsorted(part_ids, ids), len(part_ids) - 1)
+            found = part_ids[positions] == ids
+            if found.any():
+                result[found] = part_vectors[positions[found]]
+        return result
+
+    def rerank(self, query_vectors: np.ndarray, distances: np.ndarray, ids: np.ndarray,
+               k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Пересчитывает расстояния кандидатов сжатого индекса по точным векторам и оставляет k лучших.
+        Для кандидатов без точного вектора остается приближенное расстояние.
+        :return: (расстояния L2, id) в формате результата faiss search.
+        """
+        exact = self.get(ids.ravel()).reshape(ids.shape + (self.dim,))
+        exact_distances = ((exact - query_vectors[:, None, :]) ** 2).sum(axis=2)
+        exact_distances = np.where(np.isnan(exact_distances), distances, exact_distances)
+        exact_distances[ids == -1] = np.inf
+        order = np.argsort(exact_distances, axis=1)[:, :k]
+        top_ids = np.take_along_axis(ids, order, axis=1)
+        top_distances = np.take_along_axis(exact_distances, order, axis=1)
+        return np.where(top_ids == -1, np.float32(-1), top_distances).astype(np.float32), top_ids
+
+    def iter_bytes(self, ids: np.ndarray) -> Iterator[bytes]:
+        """Векторы заданных id для записи в файл снимка - кусками, без копии всей матрицы в памяти."""
+        for start in range(0, len(ids), _WRITE_BATCH):
+            yield self.get(ids[start:start + _WRITE_BATCH]).tobytes()
+
+# END OF FILE exact_vector_store.py #
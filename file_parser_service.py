@@ -1,84 +1,701 @@
 # START OF FILE file_parser_service.py #
 
+import io
 import os
+import re
+import math
+import mmap
+import codecs
+import zipfile
+import signal
+import hashlib
 import logging
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+from html.parser import HTMLParser
+from typing import BinaryIO, Callable, Iterator, List, Tuple, Union
+from xml.etree import ElementTree
+
 import docx
+import charset_normalizer
 from pypdf import PdfReader
 from pypdf.errors import PdfReadError
 
 from config import MAX_FILE_SIZE_MB # Импортируем новую константу
+from config import PDF_PAGES_PER_TASK, PDF_PAGE_TIMEOUT_SECONDS
+from config import (PARSER_WORKERS, PARSER_MEMORY_LIMIT_MB, PARSER_CPU_LIMIT_SECONDS, PARSER_TIMEOUT_SECONDS,
+                    PARSER_WORKER_MAX_TASKS)
+from config import PARSED_TEXT_CACHE_PATH, PARSED_TEXT_CACHE_MAX_MB
+from parsed_text_cache import ParsedTextCache
+from parser_sandbox import ParserSandbox
 
 logger = logging.getLogger(__name__)
 
+# Версия разбора: увеличивается при любом изменении извлекаемого текста, чтобы кэш не отдавал старый разбор
+PARSER_VERSION = 1
+# Размер блока, которым читается TXT файл
+_TXT_BLOCK_CHARS = 64 * 1024
+# Порциями такого размера (в байтах) TXT декодируется; строка длиннее _TXT_MAX_LINE_CHARS режется на блоки
+_TXT_READ_BYTES = 256 * 1024
+_TXT_MAX_LINE_CHARS = 4 * _TXT_BLOCK_CHARS
+# Кодировка текста определяется по фрагментам такого размера из начала, середины и конца файла
+_ENCODING_SAMPLE_BYTES = 64 * 1024
+# Однобайтовые кириллические кодировки, которые проверяются раньше charset_normalizer: на коротком
+# русском тексте он ошибается (например, "Привет" в cp1251 принимает за big5)
+_CYRILLIC_ENCODINGS = ('cp1251', 'koi8_r', 'cp866')
+_WORD_RE = re.compile(r'\w+')
+_RUSSIAN_WORD_RE = re.compile(r'[А-Яа-яЁё0-9]+')
+# Файл для разбора: путь на диске или содержимое в памяти (BytesIO, bytes, memoryview)
+FileSource = Union[str, BinaryIO, bytes, bytearray, memoryview]
+# Запас времени на открытие PDF в процессе пула сверх лимита на страницы диапазона
+_PDF_TASK_TIMEOUT_MARGIN_SECONDS = 30
+# Порциями такого размера (в байтах) HTML подается парсеру
+_HTML_READ_BYTES = 64 * 1024
+
+# Разметка Markdown, которая убирается из текста: ссылки и картинки заменяются подписью
+_MD_HEADING_RE = re.compile(r'^\s{0,3}(#{1,6})\s+(.*?)\s*#*\s*$')
+_MD_FENCE_RE = re.compile(r'^\s{0,3}(```|~~~)')
+_MD_LINK_RE = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+_MD_EMPHASIS_RE = re.compile(r'(\*\*|__|`)(.+?)\1')
+_MD_QUOTE_RE = re.compile(r'^\s{0,3}>\s?')
+
+# Пространства имен PPTX (Office Open XML)
+_PPTX_A = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+_PPTX_P = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+_PPTX_R = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PPTX_REL = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+_HTML_SKIPPED_TAGS = {'script', 'style', 'noscript', 'template', 'svg'}
+_HTML_BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'td', 'th', 'table', 'ul', 'ol', 'section', 'article', 'header',
+                    'footer', 'nav', 'aside', 'main', 'blockquote', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr',
+                    'dt', 'dd', 'figcaption', 'title', 'body'}
+_HTML_META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_.:-]+)', re.IGNORECASE)
+
+
+class _PageTimeout(BaseException):
+    # BaseException: pypdf местами перехватывает Exception и продолжил бы разбор страницы
+    pass
+
+
+def _raise_page_timeout(signum, frame):
+    raise _PageTimeout()
+
+
+def _openable(source: str | bytes | BinaryIO) -> str | BinaryIO:
+    # В процесс песочницы файл из памяти передается как bytes
+    return io.BytesIO(source) if isinstance(source, bytes) else _rewound(source)
+
+
+def _count_pdf_pages(source: str | bytes | BinaryIO) -> int:
+    return len(PdfReader(_openable(source)).pages)
+
+
+def _extract_pdf_pages(source: str | bytes, start: int, end: int, page_timeout: float) -> Tuple[List[str], List[int]]:
+    """
+    Выполняется в песочнице: извлекает текст страниц [start, end). Страница, разбор которой
+    не уложился в page_timeout секунд, прерывается по таймеру (SIGALRM) и пропускается.
+    :param source: Путь к PDF или его содержимое (для файлов, скачанных в память).
+    :return: (тексты страниц по порядку, номера пропущенных страниц).
+    """
+    reader = PdfReader(_openable(source))
+    use_alarm = page_timeout > 0 and hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_page_timeout)
+    texts, skipped = [], []
+    for number in range(start, end):
+        try:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, page_timeout)
+            texts.append(reader.pages[number].extract_text() or "")
+        except _PageTimeout:
+            texts.append("")
+            skipped.append(number)
+        finally:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    return texts, skipped
+
+
+def _extract_docx_paragraphs(source: str | bytes | BinaryIO) -> List[str]:
+    """Текст DOCX по абзацам. python-docx загружает документ целиком, поэтому разбор идет в песочнице."""
+    return [paragraph.text for paragraph in docx.Document(_openable(source)).paragraphs]
+
+
+def _extract_pptx_slides(source: str | bytes | BinaryIO) -> List[str]:
+    """
+    Текст PPTX по слайдам в порядке показа. PPTX - это zip с XML каждого слайда;
+    слайды разбираются по одному потоковым XML-парсером.
+    """
+    texts = []
+    with zipfile.ZipFile(_openable(source)) as archive:
+        for slide_name in _pptx_slide_order(archive):
+            paragraphs, runs = [], []
+            with archive.open(slide_name) as slide:
+                for _, element in ElementTree.iterparse(slide, events=('end',)):
+                    if element.tag == f'{_PPTX_A}t':
+                        runs.append(element.text or "")
+                    elif element.tag == f'{_PPTX_A}br':
+                        runs.append("\n")
+                    elif element.tag == f'{_PPTX_A}p':
+                        paragraph = "".join(runs).strip()
+                        if paragraph:
+                            paragraphs.append(paragraph)
+                        runs = []
+                        element.clear()
+            texts.append("\n".join(paragraphs))
+    return texts
+
+
+def _as_stream(source: FileSource) -> BinaryIO:
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+
+def _portable(source: str | BinaryIO) -> str | bytes:
+    # Путь передается в процесс песочницы как есть, а файл из памяти - содержимым
+    return source if isinstance(source, str) else _rewound(source).read()
+
+
+def _rewound(source: str | BinaryIO) -> str | BinaryIO:
+    # Один поток в памяти читается несколько раз (хеши, разбор), поэтому каждый читатель начинает с начала
+    if not isinstance(source, str):
+        source.seek(0)
+    return source
+
+
+def _source_size(source: str | BinaryIO) -> int:
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    if isinstance(source, io.BytesIO):
+        return source.getbuffer().nbytes
+    size = source.seek(0, io.SEEK_END)
+    source.seek(0)
+    return size
+
+
+@contextmanager
+def _source_view(source: FileSource):
+    """Содержимое файла в памяти как буфер: у BytesIO и bytes без копирования."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield source
+    elif isinstance(source, io.BytesIO):
+        with source.getbuffer() as view:
+            yield view
+    else:
+        yield _rewound(source).read()
+
+
+class _HtmlTextExtractor(HTMLParser):
+    """
+    Потоковый (SAX-подобный) сбор текста HTML: дерево документа не строится, текст копится
+    построчно - новая строка начинается на блочных тегах (абзацы, заголовки, ячейки и т.п.).
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines: List[str] = []
+        self.size = 0
+        self._line: List[str] = []
+        self._line_size = 0
+        self._skipped_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _HTML_SKIPPED_TAGS:
+            self._skipped_depth += 1
+        elif tag in _HTML_BLOCK_TAGS:
+            self._end_line()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _HTML_BLOCK_TAGS:
+            self._end_line()
+
+    def handle_endtag(self, tag):
+        if tag in _HTML_SKIPPED_TAGS:
+            self._skipped_depth = max(0, self._skipped_depth - 1)
+        elif tag in _HTML_BLOCK_TAGS:
+            self._end_line()
+
+    def handle_data(self, data):
+        if self._skipped_depth:
+            return
+        self._line.append(data)
+        self._line_size += len(data)
+        if self._line_size >= _TXT_BLOCK_CHARS:
+            # Текст без блочных тегов не копится в одну бесконечную строку: она обрывается
+            # на последнем пробеле, а недочитанное слово переходит в следующую
+            text = "".join(self._line)
+            tail = "" if text[-1:].isspace() else text.split()[-1]
+            if len(tail) == len(text):
+                tail = ""  # Пробелов нет вовсе - строка обрывается посреди слова
+            self._line = [text[:len(text) - len(tail)]]
+            self._end_line()
+            if tail:
+                self._line, self._line_size = [tail], len(tail)
+
+    def _end_line(self):
+        line = " ".join("".join(self._line).split())
+        self._line, self._line_size = [], 0
+        if line:
+            self.lines.append(line)
+            self.size += len(line) + 1
+
+    def take_block(self, final: bool = False) -> str | None:
+        """Собранные строки одним блоком, если их набралось на _TXT_BLOCK_CHARS (или в конце документа)."""
+        if final:
+            self._end_line()
+        if not self.lines or (self.size < _TXT_BLOCK_CHARS and not final):
+            return None
+        block = "\n".join(self.lines)
+        self.lines, self.size = [], 0
+        return block
+
+
+def _clean_markdown_line(line: str) -> str:
+    line = _MD_QUOTE_RE.sub('', line)
+    line = _MD_LINK_RE.sub(r'\1', line)
+    return _MD_EMPHASIS_RE.sub(r'\2', line)
+
 
 class FileParserService:
     """
-    Сервис для извлечения текста из файлов различных форматов (PDF, DOCX, TXT).
+    Сервис для извлечения текста из файлов различных форматов (PDF, DOCX, TXT, Markdown, PPTX, HTML).
     """
 
-    def extract_text(self, file_path: str) -> str | None:
+    def __init__(self):
+        # PDF, DOCX и PPTX разбираются в песочнице: парсеры этих форматов загружают документ в память
+        # и на поврежденном файле могут работать бесконечно. TXT, Markdown и HTML читаются потоково
+        # за линейное время и разбираются в потоке загрузки
+        self.sandbox: ParserSandbox | None = None
+        if PARSER_WORKERS > 0:
+            self.sandbox = ParserSandbox(PARSER_WORKERS, PARSER_MEMORY_LIMIT_MB, PARSER_CPU_LIMIT_SECONDS,
+                                         PARSER_TIMEOUT_SECONDS, PARSER_WORKER_MAX_TASKS)
+        self.text_cache: ParsedTextCache | None = None
+        if PARSED_TEXT_CACHE_MAX_MB > 0:
+            self.text_cache = ParsedTextCache(PARSED_TEXT_CACHE_PATH, PARSER_VERSION, PARSED_TEXT_CACHE_MAX_MB)
+
+    def extract_text(self, file_path: FileSource, file_name: str | None = None) -> str | None:
         """
         Главный метод, который определяет тип файла и вызывает соответствующий парсер.
         Включает валидацию размера файла.
-        :param file_path: Путь к файлу.
+        :param file_path: Путь к файлу или его содержимое в памяти.
+        :param file_name: Имя файла (обязательно для содержимого в памяти - по нему определяется формат).
         :return: Извлеченный текст или None в случае ошибки.
         """
-        if not os.path.exists(file_path):
-            logger.error(f"Файл не найден по пути: {file_path}")
+        try:
+            blocks = self.iter_text_blocks(file_path, file_name=file_name)
+        except ValueError:
+            return None
+        try:
+            return "\n".join(blocks)
+        except Exception as e:
+            logger.error(f"Произошла ошибка при парсинге файла {file_name or file_path}: {e}", exc_info=True)
             return None
 
-        file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
+    def iter_text_blocks(self, file_path: FileSource, cache_keys: List[str] | None = None,
+                         file_name: str | None = None) -> Iterator[str]:
+        """
+        Потоковый вариант extract_text: текст отдается блоками (страницы PDF, абзацы DOCX, группы строк TXT)
+        по мере разбора, не собираясь в одну строку. Блоки соединяются переводом строки.
+        Ошибки разбора возникают при чтении блоков.
+        :param file_path: Путь к файлу или его содержимое в памяти (BytesIO, bytes, memoryview).
+        :param cache_keys: Ключи файла (см. ParsedTextCache). Если текст файла уже разбирался, он берется
+                           из кэша, иначе разобранные блоки сохраняются в кэш.
+        :param file_name: Имя файла (обязательно для содержимого в памяти - по нему определяется формат).
+        :raises ValueError: Файл не найден, слишком большой или его формат не поддерживается.
+        """
+        if isinstance(file_path, str):
+            if not os.path.exists(file_path):
+                logger.error(f"Файл не найден по пути: {file_path}")
+                raise ValueError("Файл не найден.")
+            file_name = file_name or os.path.basename(file_path)
+        else:
+            file_path = _as_stream(file_path)
+            if not file_name:
+                raise ValueError("Для файла в памяти нужно имя файла.")
+
+        file_size_mb = _source_size(file_path) / (1024 * 1024)
         if file_size_mb > MAX_FILE_SIZE_MB:
-            logger.warning(f"Файл {os.path.basename(file_path)} (Размер: {file_size_mb:.2f} МБ) "
+            logger.warning(f"Файл {file_name} (Размер: {file_size_mb:.2f} МБ) "
                            f"превышает максимально допустимый размер ({MAX_FILE_SIZE_MB} МБ). Отклонено.")
-            return None # <--- Возвращаем None при превышении размера
+            raise ValueError(f"Файл слишком большой ({file_size_mb:.2f} МБ). "
+                             f"Максимальный размер: {MAX_FILE_SIZE_MB} МБ.")
 
-        _, extension = os.path.splitext(file_path.lower())
-        logger.info(f"Начинается парсинг файла: {os.path.basename(file_path)} с расширением {extension}")
+        _, extension = os.path.splitext(file_name.lower())
+        parsers = {'.pdf': self._iter_pdf_pages, '.docx': self._iter_docx_paragraphs, '.txt': self._iter_txt_lines,
+                   '.md': self._iter_markdown_sections, '.pptx': self._iter_pptx_slides,
+                   '.html': self._iter_html_blocks, '.htm': self._iter_html_blocks}
+        if extension not in parsers:
+            logger.warning(f"Неподдерживаемый формат файла: {extension}")
+            raise ValueError(f"Формат файла '{extension}' не поддерживается.")
+        if cache_keys:
+            cached = self.iter_cached_blocks(cache_keys)
+            if cached is not None:
+                return cached
+        logger.info(f"Начинается парсинг файла: {file_name} с расширением {extension}")
+        blocks = parsers[extension](file_path, file_name)
+        if cache_keys and self.text_cache is not None:
+            return self.text_cache.store(cache_keys, blocks)
+        return blocks
 
-        try:
-            if extension == '.pdf':
-                return self._extract_text_from_pdf(file_path)
-            elif extension == '.docx':
-                return self._extract_text_from_docx(file_path)
-            elif extension == '.txt':
-                return self._extract_text_from_txt(file_path)
-            else:
-                logger.warning(f"Неподдерживаемый формат файла: {extension}")
-                return None
-        except Exception as e:
-            logger.error(f"Произошла ошибка при парсинге файла {file_path}: {e}", exc_info=True)
+    def find_cached_text(self, keys: List[str]) -> List[str] | None:
+        """
+        Проверяет, разбирался ли уже файл с такими ключами (например, md5Checksum Google Drive).
+        :return: Все известные ключи файла (в том числе sha256: содержимого) или None.
+        """
+        if self.text_cache is None or not keys:
             return None
+        return self.text_cache.find(keys)
 
-    def _extract_text_from_pdf(self, file_path: str) -> str:
-        """Извлекает текст из PDF файла."""
-        text = []
-        try:
-            reader = PdfReader(file_path)
+    def iter_cached_blocks(self, keys: List[str]) -> Iterator[str] | None:
+        """Блоки ранее разобранного текста файла или None, если его нет в кэше."""
+        if self.text_cache is None or not keys:
+            return None
+        blocks = self.text_cache.iter_blocks(keys)
+        if blocks is not None:
+            logger.info(f"Текст файла взят из кэша разбора по ключам {keys}.")
+        return blocks
+
+    def file_digests(self, file_path: FileSource) -> dict:
+        """
+        Хеши содержимого файла для узнавания уже загруженных файлов: sha256 и md5
+        (md5 совпадает с md5Checksum, который Google Drive отдает до скачивания).
+        :param file_path: Путь к файлу или его содержимое в памяти.
+        :return: {'sha256': ..., 'md5': ...} в шестнадцатеричном виде.
+        """
+        digests = {'sha256': hashlib.sha256(), 'md5': hashlib.md5()}
+        if isinstance(file_path, str):
+            with open(file_path, 'rb') as f:
+                while block := f.read(1024 * 1024):
+                    for digest in digests.values():
+                        digest.update(block)
+        else:
+            # Содержимое в памяти хешируется без копирования
+            with _source_view(file_path) as view:
+                for digest in digests.values():
+                    digest.update(view)
+        return {name: digest.hexdigest() for name, digest in digests.items()}
+
+    def _iter_pdf_pages(self, source: str | BinaryIO, file_name: str) -> Iterator[str]:
+        """
+        Извлекает текст из PDF файла постранично. Диапазоны по PDF_PAGES_PER_TASK страниц разбираются
+        параллельно в песочнице (pypdf не отпускает GIL и иначе занял бы одно ядро и потоки бота),
+        а страницы отдаются в исходном порядке. Одновременно в работе не больше двух диапазонов
+        на процесс, чтобы разобранный текст не копился быстрее, чем его индексируют.
+        """
+        if self.sandbox is None:
+            # Без песочницы страницы разбираются по одной в текущем потоке и без таймаута
+            try:
+                reader = PdfReader(_rewound(source))
+            except PdfReadError as e:
+                logger.error(f"Не удалось прочитать PDF файл {file_name}. Возможно, он зашифрован или поврежден. "
+                             f"Ошибка: {e}")
+                raise
             for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text.append(page_text)
-            logger.info(
-                f"PDF файл {os.path.basename(file_path)} успешно обработан. Найдено страниц: {len(reader.pages)}.")
-            return "\n".join(text)
+                text = page.extract_text()
+                if text:
+                    yield text
+            logger.info(f"PDF файл {file_name} успешно обработан. Найдено страниц: {len(reader.pages)}.")
+            return
+
+        payload = _portable(source)
+        try:
+            page_count = self.sandbox.run(_count_pdf_pages, payload)
         except PdfReadError as e:
             logger.error(
-                f"Не удалось прочитать PDF файл {file_path}. Возможно, он зашифрован или поврежден. Ошибка: {e}")
+                f"Не удалось прочитать PDF файл {file_name}. Возможно, он зашифрован или поврежден. Ошибка: {e}")
+            raise
+        pages_per_task = PDF_PAGES_PER_TASK
+        if isinstance(payload, bytes):
+            # Файл из памяти передается в процесс песочницы вместе с каждым диапазоном,
+            # поэтому диапазоны крупнее: копий не больше, чем диапазонов в работе
+            pages_per_task = max(pages_per_task, math.ceil(page_count / (self.sandbox.workers * 2)))
+        def submit(start: int, end: int) -> Tuple[int, int, Future]:
+            # Время страниц ограничивают таймеры внутри _extract_pdf_pages, общий таймер задачи не нужен
+            return start, end, self.sandbox.submit(_extract_pdf_pages, payload, start, end,
+                                                   PDF_PAGE_TIMEOUT_SECONDS, timeout=0)
+
+        pending: deque = deque()
+        try:
+            for start in range(0, page_count, pages_per_task):
+                pending.append(submit(start, min(start + pages_per_task, page_count)))
+                if len(pending) >= self.sandbox.workers * 2:
+                    yield from self._collect_pdf_pages(file_name, pending, submit)
+            while pending:
+                yield from self._collect_pdf_pages(file_name, pending, submit)
+        finally:
+            # Загрузка могла прерваться: еще не начатые диапазоны не нужны
+            for _, _, future in pending:
+                future.cancel()
+        logger.info(f"PDF файл {file_name} успешно обработан. Найдено страниц: {page_count}.")
+
+    def _collect_pdf_pages(self, file_name: str, pending: deque,
+                           submit: Callable[[int, int], Tuple[int, int, Future]]) -> Iterator[str]:
+        """Отдает страницы первого диапазона из очереди pending."""
+        start, end, future = pending.popleft()
+        timeout = None
+        if PDF_PAGE_TIMEOUT_SECONDS > 0:
+            timeout = PDF_PAGE_TIMEOUT_SECONDS * (end - start) + _PDF_TASK_TIMEOUT_MARGIN_SECONDS
+        try:
+            texts, skipped = self.sandbox.result(future, timeout)
+        except TimeoutError:
+            # Таймер страницы не сработал (например, на Windows) - диапазон пропускается целиком.
+            # Песочница завершает зависший процесс вместе с его пулом, поэтому остальные диапазоны
+            # ставятся заново в новый пул
+            logger.warning(f"Страницы {start + 1}-{end} файла {file_name} не разобраны "
+                           f"за {timeout:.0f} с и пропущены.")
+            stale = list(pending)
+            pending.clear()
+            for range_start, range_end, stale_future in stale:
+                stale_future.cancel()
+                pending.append(submit(range_start, range_end))
+            return
+        for number in skipped:
+            logger.warning(f"Страница {number + 1} файла {file_name} не разобрана "
+                           f"за {PDF_PAGE_TIMEOUT_SECONDS:.0f} с и пропущена.")
+        yield from (text for text in texts if text)
+
+    def _run_sandboxed(self, func, source: str | BinaryIO):
+        """Выполняет разбор func(source) в песочнице, а если она отключена - в текущем потоке."""
+        if self.sandbox is None:
+            return func(source)
+        return self.sandbox.run(func, _portable(source))
+
+    def close(self):
+        if self.sandbox is not None:
+            self.sandbox.close()
+        if self.text_cache is not None:
+            self.text_cache.close()
+
+    def _iter_docx_paragraphs(self, source: str | BinaryIO, file_name: str) -> Iterator[str]:
+        """Извлекает текст из DOCX файла по абзацам."""
+        yield from self._run_sandboxed(_extract_docx_paragraphs, source)
+        logger.info(f"DOCX файл {file_name} успешно обработан.")
+
+    def _iter_txt_lines(self, source: str | BinaryIO, file_name: str) -> Iterator[str]:
+        """
+        Читает TXT файл группами строк по _TXT_BLOCK_CHARS символов. Файл отображается в память (mmap)
+        и декодируется порциями, поэтому ни байты, ни текст файла целиком в памяти не собираются.
+        Кодировка определяется по фрагментам файла (UTF-8, cp1251 и другие).
+        """
+        with _byte_view(source) as data:
+            encoding = _detect_encoding(data)
+            logger.info(f"TXT файл {file_name}: кодировка {encoding}.")
+            # Переводы строк приводятся к \n, как при чтении в текстовом режиме
+            decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(errors='replace'),
+                                                   translate=True)
+            # Блок отдается, когда за ним есть еще текст: перевод строки между блоками добавит потребитель,
+            # а у последнего блока завершающий перевод строки сохраняется
+            pending, block = "", None
+            for offset in range(0, len(data), _TXT_READ_BYTES):
+                pending += decoder.decode(data[offset:offset + _TXT_READ_BYTES])
+                while len(pending) >= _TXT_BLOCK_CHARS:
+                    # Блок заканчивается строкой, на которой набралось _TXT_BLOCK_CHARS символов
+                    cut = pending.find("\n", _TXT_BLOCK_CHARS - 1) + 1
+                    if not cut:
+                        if len(pending) < _TXT_MAX_LINE_CHARS:
+                            break
+                        cut = _TXT_MAX_LINE_CHARS
+                    if block is not None:
+                        yield block.removesuffix("\n")
+                    block, pending = pending[:cut], pending[cut:]
+            pending += decoder.decode(b'', final=True)
+            if pending:
+                if block is not None:
+                    yield block.removesuffix("\n")
+                block = pending
+            if block is not None:
+                yield block
+        logger.info(f"TXT файл {file_name} успешно обработан.")
+
+    def _iter_markdown_sections(self, source: str | BinaryIO, file_name: str) -> Iterator[str]:
+        """
+        Читает Markdown построчно и отдает разделы: новый блок начинается с заголовка или когда
+        раздел превышает _TXT_BLOCK_CHARS. Разметка (заголовки, выделение, ссылки) убирается,
+        содержимое блоков кода сохраняется как есть. Строка длиннее _TXT_BLOCK_CHARS читается
+        кусками, а не целиком.
+        """
+        with _open_text(source) as f:
+            lines, size, in_code, continued = [], 0, False, False
+            while line := f.readline(_TXT_BLOCK_CHARS):
+                # Кусок, продолжающий длинную строку, не может начинать заголовок или блок кода
+                continuation, continued = continued, not line.endswith("\n")
+                line = line.rstrip("\r\n")
+                if not continuation and _MD_FENCE_RE.match(line):
+                    in_code = not in_code
+                    continue
+                heading = None if in_code or continuation else _MD_HEADING_RE.match(line)
+                if heading or size >= _TXT_BLOCK_CHARS:
+                    block = "\n".join(lines).strip("\n")
+                    if block:
+                        yield block
+                    lines, size = [], 0
+                if heading:
+                    line = _clean_markdown_line(heading.group(2))
+                elif not in_code:
+                    line = _clean_markdown_line(line)
+                lines.append(line)
+                size += len(line) + 1
+            block = "\n".join(lines).strip("\n")
+            if block:
+                yield block
+        logger.info(f"Markdown файл {file_name} успешно обработан.")
+
+    def _iter_pptx_slides(self, source: str | BinaryIO, file_name: str) -> Iterator[str]:
+        """Извлекает текст PPTX по слайдам в порядке показа (пустые слайды пропускаются)."""
+        try:
+            slides = self._run_sandboxed(_extract_pptx_slides, source)
+        except zipfile.BadZipFile as e:
+            logger.error(f"Не удалось прочитать PPTX файл {file_name}. Возможно, он поврежден. Ошибка: {e}")
             raise
+        yield from (text for text in slides if text)
+        logger.info(f"PPTX файл {file_name} успешно обработан. Найдено слайдов: {len(slides)}.")
+
+    def _iter_html_blocks(self, source: str | BinaryIO, file_name: str) -> Iterator[str]:
+        """
+        Извлекает видимый текст HTML потоково: файл подается SAX-подобному парсеру порциями по
+        _HTML_READ_BYTES, текст отдается блоками по мере накопления. Кодировка берется из <meta charset>,
+        а без него определяется по началу файла.
+        """
+        with _open_binary(source) as f:
+            head = f.read(_HTML_READ_BYTES)
+            charset = _HTML_META_CHARSET_RE.search(head)
+            encoding = _detect_encoding(head)
+            if charset and not head.startswith(codecs.BOM_UTF8):
+                try:
+                    encoding = codecs.lookup(charset.group(1).decode('ascii')).name
+                except LookupError:
+                    logger.warning(f"Неизвестная кодировка {charset.group(1)!r} в {file_name}, читается как UTF-8.")
+            decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            extractor = _HtmlTextExtractor()
+            data = head
+            while data:
+                extractor.feed(decoder.decode(data))
+                block = extractor.take_block()
+                if block:
+                    yield block
+                data = f.read(_HTML_READ_BYTES)
+            extractor.feed(decoder.decode(b'', final=True))
+            extractor.close()
+            block = extractor.take_block(final=True)
+            if block:
+                yield block
+        logger.info(f"HTML файл {file_name} успешно обработан.")
+
+
+@contextmanager
+def _open_text(source: str | BinaryIO):
+    with _byte_view(source) as data:
+        encoding = _detect_encoding(data)
+    if isinstance(source, str):
+        with open(source, 'r', encoding=encoding, errors='replace') as f:
+            yield f
+        return
+    f = io.TextIOWrapper(_rewound(source), encoding=encoding, errors='replace')
+    try:
+        yield f
+    finally:
+        # Поток из памяти принадлежит вызывающему: обертка отсоединяется, а не закрывает его
+        f.detach()
+
+
+@contextmanager
+def _open_binary(source: str | BinaryIO):
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            yield f
+    else:
+        yield _rewound(source)
+
+
+@contextmanager
+def _byte_view(source: str | BinaryIO):
+    """
+    Содержимое файла как буфер без чтения в память: файл на диске отображается через mmap,
+    у BytesIO берется его внутренний буфер.
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Пустой файл отобразить нельзя
+                yield b''
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+    elif isinstance(source, io.BytesIO):
+        with source.getbuffer() as data:
+            yield data
+    else:
+        yield _rewound(source).read()
+
+
+def _detect_encoding(data) -> str:
+    """
+    Кодировка текста по фрагментам из начала, середины и конца: BOM, затем UTF-8, если все фрагменты
+    в ней корректны, затем кириллические кодировки, если в них получается русский текст, иначе наиболее
+    вероятная по charset_normalizer (cp1251, если определить не удалось).
+    """
+    head = bytes(data[:4])
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    size = len(data)
+    starts = sorted({0, max(0, (size - _ENCODING_SAMPLE_BYTES) // 2), max(0, size - _ENCODING_SAMPLE_BYTES)})
+    samples = [bytes(data[start:start + _ENCODING_SAMPLE_BYTES]) for start in starts]
+    if all(_is_utf8(sample) for sample in samples):
+        return 'utf-8'
+    for encoding in _CYRILLIC_ENCODINGS:
+        if _looks_russian(samples, encoding):
+            return encoding
+    match = charset_normalizer.from_bytes(b"\n".join(samples)).best()
+    return match.encoding if match else 'cp1251'
+
+
+def _looks_russian(samples: List[bytes], encoding: str) -> bool:
+    """
+    Фрагменты в этой кодировке читаются как русский текст: декодируются без ошибок, слова с не-ASCII
+    символами почти все целиком кириллические, а строчных букв больше, чем заглавных. Последнее
+    отличает cp1251 от koi8_r: в них одни и те же байты дают буквы разного регистра.
+    """
+    try:
+        text = "".join(sample.decode(encoding) for sample in samples)
+    except UnicodeDecodeError:
+        return False
+    words = [word for word in _WORD_RE.findall(text) if not word.isascii()]
+    russian = [word for word in words if _RUSSIAN_WORD_RE.fullmatch(word)]
+    if not russian or len(russian) < 0.9 * len(words):
+        return False
+    letters = [ch for word in russian for ch in word if ch.isalpha()]
+    return 2 * sum(ch.islower() for ch in letters) >= len(letters)
+
+
+def _is_utf8(sample: bytes) -> bool:
+    # Фрагмент может начинаться и заканчиваться посреди многобайтового символа
+    sample = sample[:3].lstrip(bytes(range(0x80, 0xC0))) + sample[3:]
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
 
-    def _extract_text_from_docx(self, file_path: str) -> str:
-        """Извлекает текст из DOCX файла."""
-        doc = docx.Document(file_path)
-        text = [p.text for p in doc.paragraphs]
-        logger.info(f"DOCX файл {os.path.basename(file_path)} успешно обработан.")
-        return "\n".join(text)
-
-    def _extract_text_from_txt(self, file_path: str) -> str:
-        """Извлекает текст из TXT файла."""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-        logger.info(f"TXT файл {os.path.basename(file_path)} успешно обработан.")
-        return text
+def _pptx_slide_order(archive: zipfile.ZipFile) -> List[str]:
+    """Файлы слайдов в порядке показа (по списку слайдов презентации, а не по именам файлов)."""
+    try:
+        with archive.open('ppt/_rels/presentation.xml.rels') as rels:
+            targets = {rel.get('Id'): rel.get('Target') for rel in ElementTree.parse(rels).getroot()
+                       if rel.tag == f'{_PPTX_REL}Relationship'}
+        with archive.open('ppt/presentation.xml') as presentation:
+            slide_ids = ElementTree.parse(presentation).getroot().find(f'{_PPTX_P}sldIdLst')
+        names = [os.path.normpath(os.path.join('ppt', targets[slide.get(f'{_PPTX_R}id')])).replace(os.sep, '/')
+                 for slide in (slide_ids if slide_ids is not None else [])]
+        existing = set(archive.namelist())
+        return [name for name in names if name in existing]
+    except (KeyError, ElementTree.ParseError):
+        # Нестандартный файл без списка слайдов - порядок по номерам в именах
+        names = [name for name in archive.namelist() if re.fullmatch(r'ppt/slides/slide\d+\.xml', name)]
+        return sorted(names, key=lambda name: int(re.search(r'\d+', name.rsplit('/', 1)[1]).group()))
 
 # END OF FILE file_parser_service.py #
\ No newline at end of file
@@ -213,6 +213,39 @@ class GoogleDriveService:
             logger.error(f"Произошла непредвиденная ошибка при загрузке файла {file_id}: {e}")
             return None
 
+    @retry_on_http_error()
+    async def download_to_memory(self, file_id: str) -> io.BytesIO | None:
+        """
+        Загружает файл с Google Drive по его ID в память, без записи на диск.
+        :param file_id: ID файла в Google Drive.
+        :return: Содержимое файла (позиция в начале) в случае успеха, иначе None.
+        """
+        if not self.is_authenticated:
+            logger.warning(f"Попытка скачать файл {file_id} без аутентификации.")
+            return None
+
+        try:
+            request = self.service.files().get_media(fileId=file_id)
+
+            def _download():
+                buffer = io.BytesIO()
+                downloader = MediaIoBaseDownload(buffer, request)
+                done = False
+                while not done:
+                    status, done = downloader.next_chunk()
+                buffer.seek(0)
+                return buffer
+
+            buffer = await asyncio.to_thread(_download)
+            logger.info(f"Файл с ID '{file_id}' успешно загружен в память ({buffer.getbuffer().nbytes} байт).")
+            return buffer
+        except HttpError as error:
+            logger.error(f"Произошла ошибка HTTP при загрузке файла {file_id}: {error}")
+            raise
+        except Exception as e:
+            logger.error(f"Произошла непредвиденная ошибка при загрузке файла {file_id}: {e}")
+            return None
+
     @retry_on_http_error()
     async def upload_file(self, file_path: str, file_name: str, mime_type: str) -> str | None:
         """
@@ -1,5 +1,7 @@
 # START OF FILE handlers.py #
 
+import io
+import html
 import logging
 import os
 import asyncio
@@ -8,15 +10,18 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKe
 from telegram.ext import CallbackContext, ConversationHandler
 from telegram.error import BadRequest
 import mimetypes
+import time
 
 from config import (
     DOWNLOADS_DIR, VOICE_MESSAGES_DIR, CONVERSATION_HISTORY_DEPTH, LLM_HISTORY_SUMMARIZE_THRESHOLD,
-    ALLOWED_TELEGRAM_IDS, LOG_FILE_PATH, MAIN_KEYBOARD_MARKUP, GOOGLE_DRIVE_TOKEN_PATH, MAX_FILE_SIZE_MB, SEARCH_MODE
+    ALLOWED_TELEGRAM_IDS, LOG_FILE_PATH, MAIN_KEYBOARD_MARKUP, GOOGLE_DRIVE_TOKEN_PATH, MAX_FILE_SIZE_MB, SEARCH_MODE,
+    KB_INGEST_IN_MEMORY_MAX_MB
 )
 
 from google_drive_service import GoogleDriveService
 from file_parser_service import FileParserService
-from knowledge_base_service import KnowledgeBaseService
+from ingestion_queue import IngestionQueue, IngestionJob, STAGES, STAGE_TITLES, QUEUED, RUNNING, DONE
+from knowledge_base_manager import KnowledgeBaseManager, collection_name_for
 import generative_ai_service
 from generative_ai_service import GenerativeAIServiceFactory
 import speech_to_text_service
@@ -32,12 +37,13 @@ logger = logging.getLogger(__name__)
 # Глобальные сервисы
 drive_service: GoogleDriveService | None = None
 parser_service: FileParserService | None = None
-kb_service: KnowledgeBaseService | None = None
+kb_service: KnowledgeBaseManager | None = None
 ai_service: generative_ai_service.BaseGenerativeService | None = None
 stt_service: speech_to_text_service.BaseSpeechToTextService | None = None
 ext_knowledge_service: ExternalKnowledgeService | None = None
 status_service: StatusService | None = None
 settings_service: SettingsService | None = None
+ingestion_queue: IngestionQueue | None = None
 
 # Состояния для ConversationHandler
 (RESET_CHAT_CONFIRM, AWAITING_AUTH_CODE) = range(100, 102)
@@ -47,12 +53,60 @@ llm_stop_events: dict[int, asyncio.Event] = {}
 
 SUPPORTED_MIME_TYPES = {'application/pdf': '.pdf',
                         'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
-                        'text/plain': '.txt'}
+                        'text/plain': '.txt',
+                        'text/markdown': '.md',
+                        'application/vnd.openxmlformats-officedocument.presentationml.presentation': '.pptx',
+                        'text/html': '.html'}
+
+
+class IngestionProgress:
+    """
+    Показывает прогресс индексации в сообщении Telegram.
+    Экземпляр вызывается из рабочего потока (как progress_callback у kb_service.add_text)
+    и пересылает правки сообщения в цикл событий не чаще, чем раз в min_interval секунд.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, edit_text, file_name: str, min_interval: float = 2.0):
+        self.loop, self.edit_text, self.file_name, self.min_interval = loop, edit_text, file_name, min_interval
+        self._last_update = 0.0
+        self._pending = []
+
+    def __call__(self, done: int, total: int | None):
+        now = time.monotonic()
+        if (total is None or done < total) and now - self._last_update < self.min_interval:
+            return
+        self._last_update = now
+        if total is None:
+            # Документ еще читается, общее число фрагментов неизвестно
+            text = f"⏳ Индексирую знания из <b>{html.escape(self.file_name)}</b>: {done} фрагментов..."
+        else:
+            text = (f"⏳ Индексирую знания из <b>{html.escape(self.file_name)}</b>: "
+                    f"{done}/{total} фрагментов ({done * 100 // total}%)...")
+        self._pending.append(asyncio.run_coroutine_threadsafe(self._edit(text), self.loop))
+
+    async def _edit(self, text: str):
+        try:
+            await self.edit_text(text, parse_mode='HTML')
+        except BadRequest as e:
+            if "Message is not modified" not in str(e): logger.warning(f"Не удалось обновить прогресс: {e}")
+
+    async def drain(self):
+        """Дожидается отправленных правок, чтобы они не перезаписали итоговое сообщение."""
+        if self._pending:
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in self._pending), return_exceptions=True)
+            self._pending.clear()
 
 
-def set_global_services(ds, ps, kbs, ais, stts, eks, sts, sers):
+def set_global_services(ds, ps, kbs, ais, stts, eks, sts, sers, iqs=None):
     global drive_service, parser_service, kb_service, ai_service, stt_service, ext_knowledge_service, status_service, settings_service
+    global ingestion_queue
     drive_service, parser_service, kb_service, ai_service, stt_service, ext_knowledge_service, status_service, settings_service = ds, ps, kbs, ais, stts, eks, sts, sers
+    ingestion_queue = iqs
+
+
+def _collection(update: Update) -> str | None:
+    """Коллекция базы знаний, с которой работает автор обновления (см. KB_COLLECTION_SCOPE)."""
+    return collection_name_for(update.effective_user.id, update.effective_chat.id)
 
 
 async def animate_thinking_message(context: CallbackContext, message_to_edit, stop_event: asyncio.Event,
@@ -113,9 +167,15 @@ async def _process_question_logic(question: str, update: Update, context: Callba
 
         context_text, sources = "", []
 
-        if SEARCH_MODE in ['kb_then_web', 'kb_only'] and kb_service and kb_service.vector_store:
-            await thinking_message.edit_text("🔍 Ищу в базе знаний...")
-            search_results = await asyncio.to_thread(kb_service.search, question, k=4)
+        collection = _collection(update)
+        if (SEARCH_MODE in ['kb_then_web', 'kb_only'] and kb_service
+                and await asyncio.to_thread(kb_service.vector_count, collection) > 0):
+            # Если пользователь выбрал файл в списке базы знаний, ищем только в нем
+            scope = context.user_data.get('kb_scope')
+            source_ids = [scope['source_id']] if scope and scope['collection'] == collection else None
+            await thinking_message.edit_text("🔍 Ищу в выбранном файле..." if source_ids else "🔍 Ищу в базе знаний...")
+            search_results = await asyncio.to_thread(kb_service.search, question, k=4, source_ids=source_ids,
+                                                   collection=collection)
             if search_results:
                 context_text = "\n\n".join([doc.page_content for doc in search_results])
                 sources = sorted(list(set([doc.metadata.get('source', 'База знаний') for doc in search_results])))
@@ -183,60 +243,234 @@ async def start(update: Update, context: CallbackContext) -> None:
                                     reply_markup=MAIN_KEYBOARD_MARKUP)
 
 
+async def _reuse_known_source(keys: list, file_name: str, collection: str | None) -> bool:
+    """
+    Если файл с одним из ключей уже в базе знаний, только обновляет его имя и запоминает новые ключи.
+    :return: True, если файл узнан и обрабатывать его не нужно.
+    """
+    source_id = await ingestion_queue.run_blocking(kb_service.find_source, keys, collection=collection)
+    if not source_id:
+        return False
+    await ingestion_queue.run_blocking(kb_service.rename_source, source_id, file_name, collection=collection)
+    await ingestion_queue.run_blocking(kb_service.add_source_keys, source_id, keys, collection=collection)
+    logger.info(f"Файл '{file_name}' уже есть в базе знаний (source_id '{source_id}'), обновлено только имя.")
+    return True
+
+
+def _check_file_size(size_bytes: int):
+    """Проверяет размер файла (заявленный до скачивания или фактический) по MAX_FILE_SIZE_MB."""
+    file_size_mb = size_bytes / (1024 * 1024)
+    if file_size_mb > MAX_FILE_SIZE_MB:
+        raise ValueError(f"Файл слишком большой ({file_size_mb:.2f} МБ). "
+                         f"Максимальный размер: {MAX_FILE_SIZE_MB} МБ.")
+
+
+def _digest_keys(digests: dict) -> list:
+    return [f"{name}:{digest}" for name, digest in digests.items()]
+
+
+def _job_message_editor(bot, job: IngestionJob):
+    """Функция правки сообщения, в котором задача показывает ход обработки (как edit_text у сообщения)."""
+    async def edit_text(text: str, **kwargs):
+        if job.message_id is not None:
+            await bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.message_id, **kwargs)
+    return edit_text
+
+
+async def _show(edit_text, text: str):
+    try:
+        await edit_text(text, parse_mode='HTML')
+    except BadRequest as e:
+        if "Message is not modified" not in str(e): logger.warning(f"Не удалось обновить сообщение задачи: {e}")
+
+
+async def run_ingestion_job(bot, job: IngestionJob) -> str:
+    """
+    Выполняет задачу очереди загрузки: скачивает файл, извлекает текст и индексирует его,
+    отмечая этапы в очереди и показывая ход обработки в сообщении задачи.
+    :return: Краткий итог для /jobs.
+    """
+    edit_text = _job_message_editor(bot, job)
+    file_name, collection = job.file_name, job.collection
+    file_keys = [job.file_key] if job.file_key else []
+    known_message = f"✅ Файл <b>{html.escape(file_name)}</b> уже есть в базе знаний, повторная обработка не нужна."
+    download_path = ""
+    source = None
+    declared_size = 0
+    try:
+        ingestion_queue.update(job.job_id, 'download')
+        if job.origin == 'gdrive':
+            file_info = await ingestion_queue.run_blocking(lambda: drive_service.service.files().get(
+                fileId=job.file_ref, fields='name, size, md5Checksum, mimeType').execute())
+            file_name = file_info.get('name', file_name)
+            # Формат файла парсер определяет по расширению; на Google Drive его может не быть в имени
+            if not os.path.splitext(file_name)[1]:
+                file_name += SUPPORTED_MIME_TYPES.get(file_info.get('mimeType'), '')
+            # md5Checksum есть только у загруженных файлов (не у документов Google)
+            if file_info.get('md5Checksum'):
+                file_keys.append(f"md5:{file_info['md5Checksum']}")
+            declared_size = int(file_info.get('size', 0))
+            _check_file_size(declared_size)
+        # Уже загруженный файл узнается до скачивания: по file_unique_id в Telegram или md5Checksum в Google Drive
+        if file_keys and await _reuse_known_source(file_keys, file_name, collection):
+            await _show(edit_text, known_message)
+            return "уже в базе знаний"
+
+        # Текст файла мог уже разбираться (например, до очистки базы или смены модели эмбеддингов) -
+        # тогда он берется из кэша разбора без скачивания
+        blocks = None
+        cached_keys = await ingestion_queue.run_blocking(parser_service.find_cached_text, file_keys)
+        if cached_keys:
+            file_keys = list(dict.fromkeys(file_keys + cached_keys))
+            if await _reuse_known_source(file_keys, file_name, collection):
+                await _show(edit_text, known_message)
+                return "уже в базе знаний"
+            blocks = await ingestion_queue.run_blocking(parser_service.iter_cached_blocks, file_keys)
+
+        if blocks is None:
+            await _show(edit_text, f"⏳ Скачиваю <b>{html.escape(file_name)}</b>...")
+            if job.origin == 'telegram':
+                telegram_file = await bot.get_file(job.file_ref)
+                declared_size = telegram_file.file_size or 0
+                _check_file_size(declared_size)
+            # Небольшие файлы скачиваются и разбираются в памяти; на диск попадают только крупные
+            # и файлы без заявленного размера
+            if 0 < declared_size <= KB_INGEST_IN_MEMORY_MAX_MB * 1024 * 1024:
+                if job.origin == 'gdrive':
+                    source = await drive_service.download_to_memory(job.file_ref)
+                    if source is None:
+                        raise Exception("Не удалось скачать файл.")
+                else:
+                    source = io.BytesIO()
+                    await telegram_file.download_to_memory(out=source)
+                _check_file_size(source.getbuffer().nbytes)
+            else:
+                download_path = source = os.path.join(DOWNLOADS_DIR, f"{uuid4()}_{file_name}")
+                if job.origin == 'gdrive':
+                    if not await drive_service.download_file(job.file_ref, download_path):
+                        raise Exception("Не удалось скачать файл.")
+                else:
+                    await telegram_file.download_to_drive(download_path)
+                _check_file_size(os.path.getsize(download_path))
+
+            # Тот же файл мог прийти другим путем (например, с Google Drive) - тогда он узнается по содержимому
+            digests = await ingestion_queue.run_blocking(parser_service.file_digests, source)
+            file_keys = list(dict.fromkeys(file_keys + _digest_keys(digests)))
+            if await _reuse_known_source(file_keys, file_name, collection):
+                await _show(edit_text, known_message)
+                return "уже в базе знаний"
+            blocks = parser_service.iter_text_blocks(source, cache_keys=file_keys, file_name=file_name)
+
+        # Текст разбирается, режется на чанки и векторизуется потоком: документ целиком в памяти не собирается
+        ingestion_queue.update(job.job_id, 'parse')
+        await _show(edit_text, f"⏳ Извлекаю текст из <b>{html.escape(file_name)}</b> (это может занять время)...")
+        content_hash = next((key.split(':', 1)[1] for key in file_keys if key.startswith('sha256:')), None)
+        if content_hash is None:
+            # Текст из кэша разбора, записанный без хеша содержимого: файл не скачивался, посчитать хеш не из чего
+            if source is None:
+                raise ValueError(f"Не удалось определить хеш содержимого файла '{file_name}': "
+                                 "в кэше разобранного текста он не записан.")
+            digests = await ingestion_queue.run_blocking(parser_service.file_digests, source)
+            file_keys = list(dict.fromkeys(file_keys + _digest_keys(digests)))
+            content_hash = digests['sha256']
+        source_id = job.file_ref if job.origin == 'gdrive' else f"local_{content_hash[:32]}"
+        progress = IngestionProgress(asyncio.get_running_loop(), edit_text, file_name)
+
+        def report(done: int, total: int | None):
+            # Вызывается после каждой векторизованной порции: до первой задача остается на этапе 'parse'
+            ingestion_queue.update(job.job_id, 'embed', done, total or 0)
+            progress(done, total)
+
+        added = await ingestion_queue.run_blocking(kb_service.add_blocks, blocks,
+                                                   metadata={"source": file_name, "source_id": source_id},
+                                                   progress_callback=report, collection=collection)
+        await progress.drain()
+        if not added:
+            raise ValueError(
+                "Не удалось извлечь текст. Файл может быть пустым, содержать только изображения (сканы) или иметь защищенный/поврежденный формат.")
+        ingestion_queue.update(job.job_id, 'persist')
+        await ingestion_queue.run_blocking(kb_service.add_source_keys, source_id, file_keys, collection=collection)
+        await _show(edit_text,
+                    f"✅ Файл <b>{html.escape(file_name)}</b> успешно проиндексирован и добавлен в базу знаний!")
+        return "проиндексирован"
+    except ValueError as ve:
+        await _show(edit_text, f"❌ {html.escape(str(ve))}")
+        raise
+    except Exception as e:
+        await _show(edit_text, f"❌ Произошла ошибка при обработке файла <b>{html.escape(file_name)}</b>:\n\n"
+                               f"<pre>{html.escape(str(e))}</pre>")
+        raise
+    finally:
+        if download_path and os.path.exists(download_path):
+            try:
+                os.remove(download_path)
+            except OSError as e:
+                logger.error(f"Ошибка при удалении временного файла {download_path}: {e}")
+
+
+async def _enqueue_ingestion(update: Update, message, origin: str, file_ref: str, file_name: str,
+                             file_key: str | None = None):
+    """Ставит файл в очередь загрузки; ход обработки задача показывает в сообщении message."""
+    try:
+        ingestion_queue.submit(update.effective_user.id, update.effective_chat.id, _collection(update), origin,
+                               file_ref, file_name, file_key=file_key, message_id=message.message_id)
+    except ValueError as ve:
+        await message.edit_text(f"❌ {ve}")
+
+
 @authorized_only
 async def handle_telegram_document_upload(update: Update, context: CallbackContext):
     document = update.message.document
-    if not all([parser_service, kb_service]):
+    if not all([parser_service, kb_service, ingestion_queue]):
         await update.message.reply_text("❌ Сервис парсинга или базы знаний не инициализирован. Проверьте логи.")
         return
 
     file_name = document.file_name
     _, file_extension = os.path.splitext(file_name.lower())
-    supported_extensions = ['.pdf', '.docx', '.txt', '.md', '.pptx', '.html']
+    supported_extensions = ['.pdf', '.docx', '.txt', '.md', '.pptx', '.html', '.htm']
     if file_extension not in supported_extensions:
         await update.message.reply_text(f"❌ Формат файла '{file_extension}' не поддерживается.")
         return
 
-    thinking_message = await update.message.reply_text(f"⏳ Получил файл '{file_name}'. Начинаю обработку...")
-    download_path = os.path.join(DOWNLOADS_DIR, f"{uuid4()}_{file_name}")
-
+    # Слишком большой файл отклоняется сразу по размеру из сообщения, не дожидаясь очереди
     try:
-        telegram_file = await context.bot.get_file(document.file_id)
-        await telegram_file.download_to_drive(download_path)
-
-        file_size_mb = os.path.getsize(download_path) / (1024 * 1024)
-        if file_size_mb > MAX_FILE_SIZE_MB:
-            await thinking_message.edit_text(
-                f"❌ Файл слишком большой ({file_size_mb:.2f} МБ). Максимальный размер: {MAX_FILE_SIZE_MB} МБ.")
-            return
-
-        await thinking_message.edit_text(f"⏳ Извлекаю текст из '{file_name}' (это может занять время)...")
-        extracted_text = await asyncio.to_thread(parser_service.extract_text, download_path)
-
-        if not extracted_text:
-            raise Exception(
-                "Не удалось извлечь текст. Файл может быть пустым, содержать только изображения (сканы) или иметь защищенный/поврежденный формат.")
+        _check_file_size(document.file_size or 0)
+    except ValueError as ve:
+        await update.message.reply_text(f"❌ {ve}")
+        return
 
-        await thinking_message.edit_text(f"⏳ Индексирую знания из '{file_name}'...")
-        source_id = f"local_{uuid4()}"
-        await asyncio.to_thread(kb_service.add_text, extracted_text,
-                                metadata={"source": file_name, "source_id": source_id})
+    # Файл скачивается и обрабатывается в очереди; сообщение затем показывает ход обработки
+    message = await update.message.reply_text(f"📥 Файл '{file_name}' поставлен в очередь на обработку. "
+                                              f"Ход обработки: /jobs")
+    await _enqueue_ingestion(update, message, 'telegram', document.file_id, file_name,
+                             file_key=f"telegram:{document.file_unique_id}")
+
+
+def _format_job(job: IngestionJob) -> str:
+    if job.state == QUEUED:
+        status = "🕓 в очереди"
+    elif job.state == RUNNING:
+        stage = job.stage or STAGES[0]
+        status = f"⚙️ этап {STAGES.index(stage) + 1}/{len(STAGES)}: {STAGE_TITLES[stage]}"
+        if job.total:
+            status += f" {job.done}/{job.total} ({job.done * 100 // job.total}%)"
+        elif job.done:
+            status += f" {job.done} фрагментов"
+    elif job.state == DONE:
+        status = f"✅ {job.result or 'готово'}"
+    else:
+        status = f"❌ {html.escape(job.result or 'ошибка')}"
+    return f"#{job.job_id} <b>{html.escape(job.file_name)}</b> — {status}"
 
-        await thinking_message.edit_text(f"✅ Файл <b>{file_name}</b> успешно проиндексирован и добавлен в базу знаний!",
-                                         parse_mode='HTML')
 
-    except ValueError as ve:
-        await thinking_message.edit_text(f"❌ {ve}")
-    except Exception as e:
-        logger.error(f"Ошибка при прямой обработке файла '{file_name}': {e}", exc_info=True)
-        await thinking_message.edit_text(f"❌ Произошла ошибка при обработке файла:\n\n<pre>{e}</pre>",
-                                         parse_mode='HTML')
-    finally:
-        if os.path.exists(download_path):
-            try:
-                os.remove(download_path)
-            except OSError as e:
-                logger.error(f"Ошибка при удалении временного файла {download_path}: {e}")
+@authorized_only
+async def jobs_command(update: Update, context: CallbackContext) -> None:
+    if not ingestion_queue: await update.message.reply_text("❌ Очередь загрузки не инициализирована."); return
+    jobs = ingestion_queue.list_jobs(update.effective_user.id)
+    if not jobs:
+        await update.message.reply_text("📭 Вы еще не загружали файлы.")
+        return
+    await update.message.reply_html("<b>📥 Загрузка файлов:</b>\n" + "\n".join(_format_job(job) for job in jobs))
 
 
 @authorized_only
@@ -281,6 +515,7 @@ async def reset_chat_confirm(update: Update, context: CallbackContext) -> int:
     query = update.callback_query;
     await query.answer()
     context.user_data.pop('conversation_history', None)
+    context.user_data.pop('kb_scope', None)
     await query.edit_message_text("✅ Контекст диалога сброшен.")
     return ConversationHandler.END
 
@@ -323,34 +558,41 @@ async def list_indexed_files(update: Update, context: CallbackContext, page: int
         await query.edit_message_text("❌ Сервис базы знаний не инициализирован.")
         return
 
-    indexed_sources = await asyncio.to_thread(kb_service.get_indexed_sources)
+    total_sources = await asyncio.to_thread(kb_service.count_indexed_sources, collection=_collection(update))
 
-    if not indexed_sources:
+    if not total_sources:
         keyboard = [[InlineKeyboardButton("⬅️ Назад в меню", callback_data="kb_menu_back")]]
         await query.edit_message_text("ℹ️ Ваша база знаний пуста. Загрузите файлы, чтобы начать.",
                                       reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
     items_per_page = 5
-    start_index, end_index = page * items_per_page, start_index + items_per_page
-    paginated_sources = indexed_sources[start_index:end_index]
+    # После удаления последнего файла на странице возвращаемся на последнюю существующую страницу
+    page = min(page, (total_sources - 1) // items_per_page)
+    start_index = page * items_per_page
+    end_index = start_index + items_per_page
+    # Из каталога читается только текущая страница, новые файлы - первыми
+    paginated_sources = await asyncio.to_thread(kb_service.get_indexed_sources, offset=start_index,
+                                                limit=items_per_page, descending=True,
+                                                collection=_collection(update))
 
     keyboard = []
     for source in paginated_sources:
         file_name = source['source']
         display_name = (file_name[:40] + '...') if len(file_name) > 43 else file_name
-        keyboard.append([InlineKeyboardButton(f"📄 {display_name}", callback_data=f"kb_noop"),
+        keyboard.append([InlineKeyboardButton(f"📄 {display_name}", callback_data=f"kb_ask_{source['source_id']}"),
                          InlineKeyboardButton("🗑️ Удалить", callback_data=f"kb_delete_{source['source_id']}_{page}")])
 
     pg_btns = []
     if page > 0: pg_btns.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"kb_list_files_{page - 1}"))
-    if end_index < len(indexed_sources): pg_btns.append(
+    if end_index < total_sources: pg_btns.append(
         InlineKeyboardButton("Вперед ➡️", callback_data=f"kb_list_files_{page + 1}"))
     if pg_btns: keyboard.append(pg_btns)
 
     keyboard.append([InlineKeyboardButton("⬅️ Назад в меню", callback_data="kb_menu_back")])
 
-    await query.edit_message_text(f"🗂️ Проиндексированные файлы (Страница {page + 1}):",
+    await query.edit_message_text(f"🗂️ Проиндексированные файлы (Страница {page + 1}):\n"
+                                  "Нажмите на файл, чтобы задавать вопросы только по нему.",
                                   reply_markup=InlineKeyboardMarkup(keyboard))
 
 
@@ -369,7 +611,10 @@ async def handle_kb_callback(update: Update, context: CallbackContext) -> None:
         await query.answer()
         parts = data.split('_')
         source_id, page_to_return = parts[2], int(parts[3])
-        if kb_service and await asyncio.to_thread(kb_service.delete_by_source_id, source_id):
+        if kb_service and await asyncio.to_thread(kb_service.delete_by_source_id, source_id,
+                                                         collection=_collection(update)):
+            if context.user_data.get('kb_scope', {}).get('source_id') == source_id:
+                context.user_data.pop('kb_scope', None)
             await query.edit_message_text("✅ Файл успешно удален из базы знаний. Обновляю список...")
             await list_indexed_files(update, context, page=page_to_return)
         else:
@@ -388,7 +633,7 @@ async def handle_kb_callback(update: Update, context: CallbackContext) -> None:
     if data == "kb_clear_all_execute":
         await query.answer()
         if kb_service:
-            await asyncio.to_thread(kb_service.clear_all)
+            await asyncio.to_thread(kb_service.clear_all, collection=_collection(update))
             await query.edit_message_text("✅ База знаний полностью очищена.")
         else:
             await query.edit_message_text("❌ Сервис базы знаний не инициализирован.")
@@ -403,6 +648,20 @@ async def handle_kb_callback(update: Update, context: CallbackContext) -> None:
         await knowledge_base_menu(update.effective_message, context)
         return
 
+    if data.startswith("kb_ask_"):
+        await query.answer()
+        context.user_data['kb_scope'] = {'source_id': data[len("kb_ask_"):], 'collection': _collection(update)}
+        keyboard = [[InlineKeyboardButton("🌐 Искать по всей базе", callback_data="kb_scope_clear")]]
+        await query.edit_message_text("🎯 Теперь ответы ищутся только в выбранном файле. Задайте вопрос.",
+                                      reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    if data == "kb_scope_clear":
+        await query.answer()
+        context.user_data.pop('kb_scope', None)
+        await query.edit_message_text("🌐 Ответы снова ищутся по всей базе знаний.")
+        return
+
     if data == "kb_noop":
         await query.answer("Это просто название файла. Используйте кнопку 'Удалить' для действия.")
         return
@@ -440,8 +699,8 @@ async def list_drive_files_paginated(update: Update, context: CallbackContext, p
         return
     processable_files = [f for f in all_files if f.get('mimeType') in SUPPORTED_MIME_TYPES]
     if not processable_files:
-        text, reply_markup = "📂 На GDrive не найдено поддерживаемых документов (PDF, DOCX, TXT).", InlineKeyboardMarkup(
-            [[InlineKeyboardButton("❌ Отмена", callback_data="cancel_upload")]])
+        text = "📂 На GDrive не найдено поддерживаемых документов (PDF, DOCX, TXT, MD, PPTX, HTML)."
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="cancel_upload")]])
         if from_callback:
             await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
         else:
@@ -450,6 +709,8 @@ async def list_drive_files_paginated(update: Update, context: CallbackContext, p
     items_per_page = 5
     start_index, end_index = page * items_per_page, (page + 1) * items_per_page
     paginated_files = processable_files[start_index:end_index]
+    # Имена запоминаются, чтобы задача очереди сразу показывала выбранный файл по имени
+    context.user_data['gdrive_names'] = {f.get('id'): f.get('name', 'Без имени') for f in paginated_files}
     keyboard = [[InlineKeyboardButton(f"📄 {f.get('name', 'Без имени')}", callback_data=f"gdrive_select_{f.get('id')}")]
                 for f in paginated_files]
     pg_btns = []
@@ -470,44 +731,13 @@ async def handle_file_selection(update: Update, context: CallbackContext) -> Non
     query = update.callback_query
     await query.answer()
     file_id = query.data.split('_')[-1]
-    if not all([drive_service, parser_service, kb_service]): await query.edit_message_text(
+    if not all([drive_service, parser_service, kb_service, ingestion_queue]): await query.edit_message_text(
         "❌ Один из ключевых сервисов не инициализирован."); return
-    download_path = ""
-    try:
-        if not drive_service or not drive_service.service: await query.edit_message_text(
-            "❌ Сервис Google Drive не инициализирован."); return
-        file_info = await asyncio.to_thread(
-            lambda: drive_service.service.files().get(fileId=file_id, fields='name, size').execute())
-        file_name, file_size = file_info.get('name', file_id), int(file_info.get('size', 0)) / (1024 * 1024)
-        if file_size > MAX_FILE_SIZE_MB:
-            await query.edit_message_text(f"❌ Файл <b>{file_name}</b> ({file_size:.2f} МБ) > {MAX_FILE_SIZE_MB} МБ.",
-                                          parse_mode='HTML', reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Вернуться", callback_data=f"gdrive_page_0")]]))
-            return
-        await query.edit_message_text(f"⏳ Скачиваю и парсю <b>{file_name}</b>...", parse_mode='HTML')
-        download_path = os.path.join(DOWNLOADS_DIR, f"{uuid4()}_{file_name}")
-        if not await drive_service.download_file(file_id, download_path): raise Exception("Не удалось скачать файл.")
-        extracted_text = await asyncio.to_thread(parser_service.extract_text, download_path)
-        if not extracted_text:
-            await query.edit_message_text(f"❌ Не удалось извлечь текст из <b>{file_name}</b>.", parse_mode='HTML',
-                                          reply_markup=InlineKeyboardMarkup(
-                                              [[InlineKeyboardButton("🔙 Вернуться", callback_data=f"gdrive_page_0")]]))
-            return
-        await query.edit_message_text(f"⏳ Индексирую знания из <b>{file_name}</b>...", parse_mode='HTML')
-        await asyncio.to_thread(kb_service.add_text, extracted_text,
-                                metadata={"source": file_name, "source_id": file_id})
-        await query.edit_message_text(text=f"✅ Знания из файла <b>{file_name}</b> успешно добавлены.",
-                                      reply_markup=InlineKeyboardMarkup(
-                                          [[InlineKeyboardButton("🔙 Вернуться", callback_data="cancel_upload")]]))
-    except Exception as e:
-        logger.error(f"Ошибка при обработке файла {file_id}: {e}", exc_info=True)
-        await query.edit_message_text(f"❌ Не удалось обработать файл. Ошибка: {e}", parse_mode='HTML')
-    finally:
-        if download_path and os.path.exists(download_path):
-            try:
-                os.remove(download_path)
-            except OSError:
-                pass
+    if not drive_service.service: await query.edit_message_text("❌ Сервис Google Drive не инициализирован."); return
+    file_name = context.user_data.get('gdrive_names', {}).get(file_id, file_id)
+    await query.edit_message_text(f"📥 Файл <b>{html.escape(file_name)}</b> поставлен в очередь на обработку. "
+                                  f"Ход обработки: /jobs", parse_mode='HTML')
+    await _enqueue_ingestion(update, query.message, 'gdrive', file_id, file_name)
 
 
 @authorized_only
@@ -0,0 +1,165 @@
+# START OF FILE index_snapshot.py #
+
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+import faiss
+import numpy as np
+
+import vector_index
+from exact_vector_store import ExactVectorStore
+
+# Подмножество ANN-индекса до такого размера при поиске с фильтром перебирается точно
+EXACT_SUBSET_MAX = 50000
+
+
+class DeltaBuffer:
+    """
+    Векторы, добавленные после последнего перестроения базового индекса.
+    Буфер только дописывается: уже записанные строки не меняются, а при росте данные копируются
+    в новые массивы. Поэтому срез, выданный view(), остается неизменным, пока в буфер пишут дальше,
+    и его можно читать из других потоков без блокировок.
+    """
+
+    def __init__(self, dim: int, capacity: int = 1024):
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._vectors = np.empty((capacity, dim), dtype=np.float32)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, ids: np.ndarray, vectors: np.ndarray):
+        needed = self._size + len(ids)
+        if needed > len(self._ids):
+            capacity = max(needed, len(self._ids) * 2)
+            grown_ids = np.empty(capacity, dtype=np.int64)
+            grown_vectors = np.empty((capacity, self._vectors.shape[1]), dtype=np.float32)
+            grown_ids[:self._size] = self._ids[:self._size]
+            grown_vectors[:self._size] = self._vectors[:self._size]
+            self._ids, self._vectors = grown_ids, grown_vectors
+        self._ids[self._size:needed] = ids
+        self._vectors[self._size:needed] = vectors
+        self._size = needed
+
+    def view(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self._ids[:self._size], self._vectors[:self._size]
+
+    def without_prefix(self, count: int) -> 'DeltaBuffer':
+        """Новый буфер без первых count записей (они уже перенесены в базовый индекс)."""
+        rest = DeltaBuffer(self._vectors.shape[1], capacity=max(self._size - count, 1024))
+        rest.append(self._ids[count:self._size], self._vectors[count:self._size])
+        return rest
+
+
+@dataclass(frozen=True)
+class IndexSnapshot:
+    """
+    Опубликованная версия индекса базы знаний. Снимок неизменяем: писатели собирают следующую версию
+    отдельно и публикуют ее заменой ссылки, поэтому поиск идет без блокировок и всегда видит
+    согласованное состояние.
+
+    base - базовый индекс (FAISS, только для чтения), delta_* - векторы, добавленные после его построения
+    (ищутся полным перебором), tombstones - удаленные id, векторы которых еще лежат в base или в дельте.
+    """
+    base: faiss.Index | None = None
+    delta_ids: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    delta_vectors: np.ndarray = field(default_factory=lambda: np.empty((0, 0), dtype=np.float32))
+    tombstones: frozenset = frozenset()
+    version: int = 0
+    # Параметры поиска по base, отсекающие надгробия (None, если надгробий нет)
+    base_params: faiss.SearchParameters | None = None
+    # Сколько записей дельты помечены надгробиями: столько кандидатов дельты берется сверх k
+    delta_dead: int = 0
+    # Наибольший id, выданный к моменту публикации снимка
+    max_id: int = -1
+    # Точные векторы сжатого базового индекса (None - индекс хранит векторы без потерь)
+    # и во сколько раз больше k кандидатов берется из него для переранжирования
+    exact_vectors: ExactVectorStore | None = None
+    rerank_factor: int = 1
+
+    @property
+    def ntotal(self) -> int:
+        return (self.base.ntotal if self.base is not None else 0) + len(self.delta_ids)
+
+    @property
+    def live_count(self) -> int:
+        return self.ntotal - len(self.tombstones)
+
+    def search(self, query_vectors: np.ndarray, k: int,
+               include_ids: np.ndarray | None = None) -> List[List[Tuple[int, float]]]:
+        """
+        Ищет все запросы одним матричным поиском по базовому индексу и дельте.
+        :param include_ids: Если задано - искать только среди этих id (например, чанков одного файла).
+        :return: Для каждого запроса - пары (id, расстояние L2) до k ближайших живых векторов по возрастанию расстояния.
+        """
+        if include_ids is not None:
+            return self._search_subset(query_vectors, k, include_ids)
+        candidates = [[] for _ in range(len(query_vectors))]
+        if self.base is not None and self.base.ntotal:
+            _collect(candidates, *self._search_base(query_vectors, k, self.base_params))
+        if len(self.delta_ids):
+            fetch = min(len(self.delta_ids), k + self.delta_dead)
+            distances, positions = faiss.knn(query_vectors, self.delta_vectors, fetch)
+            for row, (row_distances, row_positions) in enumerate(zip(distances, positions)):
+                for distance, position in zip(row_distances, row_positions):
+                    index_id = int(self.delta_ids[position]) if position != -1 else -1
+                    if index_id != -1 and index_id not in self.tombstones:
+                        candidates[row].append((float(distance), index_id))
+        return [[(index_id, distance) for distance, index_id in sorted(row)[:k]] for row in candidates]
+
+    def _search_subset(self, query_vectors: np.ndarray, k: int,
+                       include_ids: np.ndarray) -> List[List[Tuple[int, float]]]:
+        """
+        Поиск среди заданных id. Фильтр применяется внутри FAISS до вычисления расстояний, поэтому
+        поиск с фильтром не дороже обычного. Небольшое подмножество ANN-индекса (IVF, HNSW) ищется
+        точным перебором его векторов: обход графа или nprobe кластеров нашел бы в нем лишь часть
+        подходящих векторов.
+        """
+        candidates = [[] for _ in range(len(query_vectors))]
+        # Id новее снимка (их чанки уже записаны, но векторы еще не опубликованы) отбрасываются:
+        # все остальные id, которых нет в дельте, лежат в базовом индексе
+        include_ids = include_ids[include_ids <= self.max_id]
+        if self.tombstones:
+            include_ids = include_ids[~np.isin(include_ids, np.fromiter(self.tombstones, dtype=np.int64))]
+        in_delta = np.isin(self.delta_ids, include_ids)
+        subset_ids = [self.delta_ids[in_delta]]
+        subset_vectors = [self.delta_vectors[in_delta]]
+        if self.base is not None and self.base.ntotal:
+            base_ids = np.setdiff1d(include_ids, subset_ids[0])
+            if vector_index.index_kind(self.base) == vector_index.INDEX_FLAT or len(base_ids) > EXACT_SUBSET_MAX:
+                params = vector_index.search_params(self.base, base_ids, exclude=False)
+                _collect(candidates, *self._search_base(query_vectors, k, params))
+            elif len(base_ids):
+                subset_ids.append(base_ids)
+                subset_vectors.append(self._base_vectors(base_ids))
+        ids = np.concatenate(subset_ids)
+        if len(ids):
+            distances, positions = faiss.knn(query_vectors, np.vstack(subset_vectors), min(k, len(ids)))
+            for row, (row_distances, row_positions) in enumerate(zip(distances, positions)):
+                candidates[row].extend((float(d), int(ids[p])) for d, p in zip(row_distances, row_positions) if p != -1)
+        return [[(index_id, distance) for distance, index_id in sorted(row)[:k]] for row in candidates]
+
+    def _search_base(self, query_vectors: np.ndarray, k: int,
+                     params: faiss.SearchParameters | None) -> Tuple[np.ndarray, np.ndarray]:
+        """Поиск по базовому индексу; выдача сжатого индекса переранжируется по точным векторам."""
+        if self.exact_vectors is None:
+            return self.base.search(query_vectors, k, params=params)
+        distances, ids = self.base.search(query_vectors, k * self.rerank_factor, params=params)
+        return self.exact_vectors.rerank(query_vectors, distances, ids, k)
+
+    def _base_vectors(self, ids: np.ndarray) -> np.ndarray:
+        if self.exact_vectors is None:
+            return self.base.reconstruct_batch(ids)
+        vectors = self.exact_vectors.get(ids)
+        missing = np.isnan(vectors[:, 0])
+        if missing.any():
+            vectors[missing] = self.base.reconstruct_batch(ids[missing])
+        return vectors
+
+
+def _collect(candidates: List[List[Tuple[float, int]]], distances: np.ndarray, ids: np.ndarray):
+    for row, (row_distances, row_ids) in enumerate(zip(distances, ids)):
+        candidates[row].extend((float(d), int(i)) for d, i in zip(row_distances, row_ids) if i != -1)
+
+# END OF FILE index_snapshot.py #
@@ -0,0 +1,196 @@
+# START OF FILE ingestion_queue.py #
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Awaitable, Callable, List
+
+from config import KB_INGEST_JOBS_PATH, KB_INGEST_WORKERS, KB_INGEST_MAX_JOBS_PER_USER, KB_INGEST_MAX_PENDING
+
+logger = logging.getLogger(__name__)
+
+# Этапы загрузки файла в базу знаний в порядке выполнения. Текст разбирается, режется на фрагменты
+# и векторизуется одним потоком, поэтому после первых векторов разбор продолжается на этапе 'embed'
+STAGES = ('download', 'parse', 'embed', 'persist')
+STAGE_TITLES = {'download': 'скачивание', 'parse': 'извлечение текста', 'embed': 'разбор и векторизация',
+                'persist': 'сохранение'}
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+# Завершенные задачи хранятся неделю, чтобы их было видно в /jobs
+_FINISHED_RETENTION_SECONDS = 7 * 24 * 3600
+
+_JOB_COLUMNS = ("job_id, user_id, chat_id, message_id, collection, origin, file_ref, file_key, file_name, "
+                "state, stage, done, total, result, created_at, updated_at")
+
+
+@dataclass(frozen=True)
+class IngestionJob:
+    job_id: int
+    user_id: int
+    chat_id: int
+    message_id: int | None  # Сообщение, в котором показывается ход обработки
+    collection: str | None
+    origin: str  # 'telegram' или 'gdrive'
+    file_ref: str  # file_id в Telegram или Google Drive
+    file_key: str | None  # Ключ файла, известный до скачивания (см. ChunkStore.find_source)
+    file_name: str
+    state: str
+    stage: str | None
+    done: int
+    total: int
+    result: str | None  # Итог обработки или текст ошибки
+    created_at: float
+    updated_at: float
+
+
+class IngestionQueue:
+    """
+    Очередь загрузки файлов в базу знаний. Обработчики Telegram только ставят задачу и сразу отвечают,
+    а скачивают, разбирают и индексируют файлы `workers` фоновых исполнителей. Синхронные шаги задач
+    выполняются в собственном пуле потоков очереди (run_blocking), поэтому большие загрузки не занимают
+    пул по умолчанию, в котором готовятся ответы на вопросы.
+
+    Состояние задач хранится в SQLite: задачи, не завершенные к остановке бота, после перезапуска
+    выполняются заново с начала.
+    """
+
+    def __init__(self, db_path: str = KB_INGEST_JOBS_PATH, workers: int = KB_INGEST_WORKERS,
+                 max_jobs_per_user: int = KB_INGEST_MAX_JOBS_PER_USER, max_pending: int = KB_INGEST_MAX_PENDING):
+        self.workers = max(1, workers)
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+                "chat_id INTEGER NOT NULL, message_id INTEGER, collection TEXT, origin TEXT NOT NULL, "
+                "file_ref TEXT NOT NULL, file_key TEXT, file_name TEXT NOT NULL, state TEXT NOT NULL, stage TEXT, "
+                "done INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, result TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user_id ON jobs(user_id, job_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state, job_id)")
+        self._queue: asyncio.Queue | None = None
+        self._runner: Callable[[IngestionJob], Awaitable[str | None]] | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._tasks: List[asyncio.Task] = []
+
+    def submit(self, user_id: int, chat_id: int, collection: str | None, origin: str, file_ref: str, file_name: str,
+               file_key: str | None = None, message_id: int | None = None) -> IngestionJob:
+        """
+        Ставит файл в очередь.
+        :raises ValueError: У пользователя слишком много незавершенных задач или очередь переполнена.
+        """
+        with self._lock, self._conn:
+            active = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE user_id = ? AND state IN (?, ?)",
+                                        (user_id, QUEUED, RUNNING)).fetchone()[0]
+            if active >= self.max_jobs_per_user:
+                raise ValueError(f"У вас уже {active} файлов в обработке. Дождитесь их завершения (/jobs).")
+            pending = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+            if pending >= self.max_pending:
+                raise ValueError("Очередь загрузки переполнена, попробуйте позже.")
+            now = time.time()
+            job_id = self._conn.execute(
+                "INSERT INTO jobs (user_id, chat_id, message_id, collection, origin, file_ref, file_key, file_name, "
+                "state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, message_id, collection, origin, file_ref, file_key, file_name, QUEUED, now,
+                 now)).lastrowid
+        if self._queue is not None:
+            self._queue.put_nowait(job_id)
+        logger.info(f"Задача загрузки #{job_id} ('{file_name}') поставлена в очередь.")
+        return self.get(job_id)
+
+    async def start(self, runner: Callable[[IngestionJob], Awaitable[str | None]]):
+        """
+        Запускает исполнителей в текущем цикле событий и возвращает в очередь незавершенные задачи.
+        :param runner: Корутина, выполняющая задачу; возвращает краткий итог для /jobs.
+        """
+        self._runner = runner
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='ingestion')
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?",
+                               (DONE, FAILED, time.time() - _FINISHED_RETENTION_SECONDS))
+            # Задачи, прерванные остановкой бота, начинаются заново
+            self._conn.execute("UPDATE jobs SET state = ?, stage = NULL, done = 0, total = 0 WHERE state = ?",
+                               (QUEUED, RUNNING))
+            restored = [row[0] for row in self._conn.execute(
+                "SELECT job_id FROM jobs WHERE state = ? ORDER BY job_id", (QUEUED,))]
+        for job_id in restored:
+            self._queue.put_nowait(job_id)
+        if restored:
+            logger.info(f"Очередь загрузки: восстановлено незавершенных задач: {len(restored)}.")
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+        Останавливает исполнителей. Прерванные задачи выполнятся заново после перезапуска, но синхронный шаг,
+        уже идущий в пуле потоков (например, запись в коллекцию), дорабатывает: после stop() базу можно закрывать.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+    async def run_blocking(self, func: Callable, *args, **kwargs) -> Any:
+        """Выполняет синхронный шаг задачи в пуле потоков очереди."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def update(self, job_id: int, stage: str, done: int = 0, total: int = 0):
+        """Отмечает этап задачи и его прогресс; можно вызывать из любого потока."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET stage = ?, done = ?, total = ?, updated_at = ? WHERE job_id = ?",
+                               (stage, done, total, time.time(), job_id))
+
+    def _finish(self, job_id: int, state: str, result: str | None = None):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET state = ?, result = ?, updated_at = ? WHERE job_id = ?",
+                               (state, result, time.time(), job_id))
+
+    def get(self, job_id: int) -> IngestionJob | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return IngestionJob(*row) if row else None
+
+    def list_jobs(self, user_id: int, limit: int = 10) -> List[IngestionJob]:
+        """Последние задачи пользователя, новые первыми."""
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE user_id = ? ORDER BY job_id DESC LIMIT ?",
+                                      (user_id, limit)).fetchall()
+        return [IngestionJob(*row) for row in rows]
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            job = self.get(job_id)
+            if job is None or job.state != QUEUED:
+                continue
+            with self._lock, self._conn:
+                self._conn.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE job_id = ?",
+                                   (RUNNING, time.time(), job_id))
+            try:
+                result = await self._runner(job)
+            except asyncio.CancelledError:
+                raise  # Задача останется в состоянии running и будет выполнена после перезапуска
+            except Exception as e:
+                logger.error(f"Задача загрузки #{job_id} ('{job.file_name}') завершилась ошибкой: {e}", exc_info=True)
+                self._finish(job_id, FAILED, str(e))
+            else:
+                self._finish(job_id, DONE, result)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# END OF FILE ingestion_queue.py #
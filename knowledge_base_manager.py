@@ -0,0 +1,234 @@
+# START OF FILE knowledge_base_manager.py #
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from langchain_core.documents import Document
+
+from config import KB_COLLECTION_SCOPE, KB_COLLECTIONS_DIR, KB_COLLECTIONS_MAX_LOADED, KB_COLLECTIONS_MEMORY_MB
+from knowledge_base_service import EmbeddingResources, KnowledgeBaseService
+
+logger = logging.getLogger(__name__)
+
+_COLLECTION_NAME_RE = re.compile(r'[\w-]{1,64}', re.ASCII)
+
+
+def collection_name_for(user_id: int, chat_id: int) -> str | None:
+    """Коллекция, с которой работает пользователь в чате, согласно KB_COLLECTION_SCOPE (None - общая база)."""
+    if KB_COLLECTION_SCOPE == 'user':
+        return f"user_{user_id}"
+    if KB_COLLECTION_SCOPE == 'chat':
+        return f"chat_{chat_id}"
+    return None
+
+
+class KnowledgeBaseManager:
+    """
+    Набор независимых баз знаний (коллекций) - например, по пользователям, чатам или проектам.
+    У каждой коллекции свой индекс, хранилище чанков и журнал в папке KB_COLLECTIONS_DIR/<имя>;
+    коллекция None - общая база по прежним путям. Модель встраивания и ее кэши одни на все коллекции.
+
+    Коллекция загружается при первом обращении. Когда загруженных коллекций больше max_loaded или их
+    индексы занимают больше memory_budget_mb, давно не использованные коллекции выгружаются
+    (их данные остаются на диске). Коллекции, с которыми сейчас идет работа, не выгружаются.
+    """
+
+    def __init__(self, resources: EmbeddingResources | None = None, collections_dir: str = KB_COLLECTIONS_DIR,
+                 max_loaded: int = KB_COLLECTIONS_MAX_LOADED, memory_budget_mb: int = KB_COLLECTIONS_MEMORY_MB):
+        # Модель встраивания, созданная менеджером, освобождается вместе с ним (см. close)
+        self._owns_resources = resources is None
+        self._resources = resources or EmbeddingResources()
+        self._collections_dir = collections_dir
+        self._max_loaded = max(max_loaded, 1)
+        self._memory_budget_bytes = memory_budget_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        # Загруженные коллекции в порядке последнего использования (последняя - самая свежая)
+        self._services: OrderedDict[str | None, KnowledgeBaseService] = OrderedDict()
+        self._in_use: Dict[str | None, int] = {}
+        # Загрузка и выгрузка одной коллекции идут под ее собственной блокировкой, чтобы файлы
+        # коллекции никогда не были открыты двумя сервисами сразу
+        self._load_locks: Dict[str | None, threading.Lock] = {}
+        # Потоки, закрывающие вытесненные коллекции
+        self._closing: List[threading.Thread] = []
+
+    def _store_dir(self, collection: str | None) -> str | None:
+        if collection is None:
+            return None
+        if not _COLLECTION_NAME_RE.fullmatch(collection):
+            raise ValueError(f"Некорректное имя коллекции: {collection!r}")
+        return os.path.join(self._collections_dir, collection)
+
+    def _load_lock(self, collection: str | None) -> threading.Lock:
+        with self._lock:
+            return self._load_locks.setdefault(collection, threading.Lock())
+
+    @contextmanager
+    def _use(self, collection: str | None) -> Iterator[KnowledgeBaseService]:
+        """Выдает сервис коллекции (загружая его при необходимости) и не дает выгрузить его до выхода из блока."""
+        store_dir = self._store_dir(collection)
+        with self._load_lock(collection):
+            with self._lock:
+                service = self._services.get(collection)
+                if service is not None:
+                    self._services.move_to_end(collection)
+                self._in_use[collection] = self._in_use.get(collection, 0) + 1
+            if service is None:
+                try:
+                    logger.info(f"Загрузка коллекции базы знаний '{collection or 'общая'}'...")
+                    if store_dir is not None:
+                        os.makedirs(store_dir, exist_ok=True)
+                    service = KnowledgeBaseService(self._resources, store_dir=store_dir)
+                except Exception:
+                    with self._lock:
+                        self._release(collection)
+                    raise
+                with self._lock:
+                    self._services[collection] = service
+        try:
+            yield service
+        finally:
+            with self._lock:
+                self._release(collection)
+            self._evict()
+
+    def _release(self, collection: str | None):
+        self._in_use[collection] -= 1
+        if not self._in_use[collection]:
+            del self._in_use[collection]
+
+    def _over_budget(self) -> bool:
+        if len(self._services) > self._max_loaded:
+            return True
+        return sum(service.memory_bytes() for service in self._services.values()) > self._memory_budget_bytes
+
+    def _evict(self):
+        """
+        Выгружает давно не использованные коллекции, пока не уложится в ограничения. Выгруженные коллекции
+        закрываются в фоне: закрытие ждет компактизацию индекса, а вытеснение идет по ходу чужого запроса.
+        """
+        while True:
+            with self._lock:
+                if not self._over_budget():
+                    return
+                # Последняя использованная коллекция остается, даже если одна не помещается в бюджет:
+                # иначе она выгружалась бы после каждого вопроса
+                candidates = [key for key in list(self._services)[:-1] if key not in self._in_use]
+            if not any(self._unload(key, wait=False) for key in candidates):
+                return
+
+    def _unload(self, collection: str | None, wait: bool = True) -> bool:
+        load_lock = self._load_lock(collection)
+        if not load_lock.acquire(blocking=False):
+            return False  # Коллекцию как раз загружают или выгружают в другом потоке
+        with self._lock:
+            service = None if collection in self._in_use else self._services.pop(collection, None)
+        if service is None:
+            load_lock.release()
+            return False
+        if wait:
+            self._close_service(collection, service, load_lock)
+        else:
+            thread = threading.Thread(target=self._close_service, args=(collection, service, load_lock),
+                                      name=f"kb-unload-{collection or 'default'}")
+            with self._lock:
+                self._closing = [t for t in self._closing if t.is_alive()] + [thread]
+            thread.start()
+        return True
+
+    def _close_service(self, collection: str | None, service: KnowledgeBaseService, load_lock: threading.Lock):
+        # Блокировка загрузки держится до конца закрытия: повторная загрузка коллекции дождется его
+        try:
+            service.close()
+            logger.info(f"Коллекция базы знаний '{collection or 'общая'}' выгружена из памяти.")
+        finally:
+            load_lock.release()
+
+    def loaded_collections(self) -> List[str | None]:
+        with self._lock:
+            return list(self._services)
+
+    def close(self):
+        """
+        Выгружает все коллекции, дожидается закрытия вытесненных ранее и затем останавливает
+        пул векторизации, если модель встраивания создавал сам менеджер.
+        """
+        for collection in self.loaded_collections():
+            self._unload(collection)
+        with self._lock:
+            closing, self._closing = self._closing, []
+        for thread in closing:
+            thread.join()
+        if self._owns_resources:
+            self._resources.close()
+
+    def add_text(self, text: str, metadata: Dict[str, Any],
+                 progress_callback: Callable[[int, int | None], None] | None = None,
+                 collection: str | None = None) -> int:
+        with self._use(collection) as service:
+            return service.add_text(text, metadata, progress_callback=progress_callback)
+
+    def add_blocks(self, blocks: Iterable[str], metadata: Dict[str, Any],
+                   progress_callback: Callable[[int, int | None], None] | None = None,
+                   collection: str | None = None) -> int:
+        with self._use(collection) as service:
+            return service.add_blocks(blocks, metadata, progress_callback=progress_callback)
+
+    def delete_by_source_id(self, source_id: str, collection: str | None = None) -> bool:
+        with self._use(collection) as service:
+            return service.delete_by_source_id(source_id)
+
+    def clear_all(self, collection: str | None = None):
+        with self._use(collection) as service:
+            service.clear_all()
+
+    def search(self, query: str, k: int = 4, source_ids: Iterable[str] | None = None,
+               collection: str | None = None) -> List[Document]:
+        with self._use(collection) as service:
+            return service.search(query, k=k, source_ids=source_ids)
+
+    def search_batch(self, queries: List[str], k: int = 4, source_ids: Iterable[str] | None = None,
+                     collection: str | None = None) -> List[List[Tuple[Document, float]]]:
+        with self._use(collection) as service:
+            return service.search_batch(queries, k=k, source_ids=source_ids)
+
+    def vector_count(self, collection: str | None = None) -> int:
+        with self._use(collection) as service:
+            return service.vector_count
+
+    def get_indexed_sources(self, offset: int = 0, limit: int | None = None, order_by: str = 'ingested_at',
+                            descending: bool = False, collection: str | None = None) -> List[Dict[str, Any]]:
+        with self._use(collection) as service:
+            return service.get_indexed_sources(offset=offset, limit=limit, order_by=order_by, descending=descending)
+
+    def count_indexed_sources(self, collection: str | None = None) -> int:
+        with self._use(collection) as service:
+            return service.count_indexed_sources()
+
+    def find_source(self, keys: List[str], collection: str | None = None) -> str | None:
+        with self._use(collection) as service:
+            return service.find_source(keys)
+
+    def add_source_keys(self, source_id: str, keys: List[str], collection: str | None = None):
+        with self._use(collection) as service:
+            service.add_source_keys(source_id, keys)
+
+    def rename_source(self, source_id: str, name: str, collection: str | None = None) -> bool:
+        with self._use(collection) as service:
+            return service.rename_source(source_id, name)
+
+    def get_cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Кэш эмбеддингов запросов общий, статистика кэшей результатов суммируется по загруженным коллекциям."""
+        with self._lock:
+            services = list(self._services.values())
+        result_stats = [service.get_cache_stats()['search_results'] for service in services]
+        hits, misses = sum(s['hits'] for s in result_stats), sum(s['misses'] for s in result_stats)
+        return {'query_embeddings': self._resources.query_embedding_cache.stats(),
+                'search_results': {'entries': sum(s['entries'] for s in result_stats), 'hits': hits, 'misses': misses,
+                                   'hit_rate': hits / (hits + misses) if hits + misses else 0.0}}
+
+# END OF FILE knowledge_base_manager.py #
@@ -3,138 +3,976 @@
 import os
 import logging
 import json
-from typing import List, Dict, Any, Tuple
-import shutil
+import time
+import pickle
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Dict, Any, Tuple, Callable, Iterator, Iterable
+from uuid import uuid4
 
-from langchain_community.vectorstores import FAISS
+import faiss
+import numpy as np
+from langchain_core.documents import Document
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-from config import VECTOR_STORE_PATH, SOURCE_MAP_PATH, EMBEDDING_MODEL_NAME
+from config import (
+    VECTOR_STORE_PATH, SOURCE_MAP_PATH, CHUNK_STORE_PATH, KB_INDEX_MMAP, EMBEDDING_MODEL_NAME,
+    KB_WAL_COMPACT_SIZE_MB, KB_WAL_COMPACT_INTERVAL_SECONDS,
+    EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_MB, EMBEDDING_BATCH_SIZE, EMBEDDING_WORKERS,
+    KB_INDEX_TYPE, KB_INDEX_PROMOTE_THRESHOLD, KB_INDEX_TARGET_RECALL, KB_IVF_NLIST, KB_IVF_PQ_M, KB_HNSW_M,
+    KB_VECTOR_COMPRESSION, KB_RERANK_FACTOR, KB_CHUNK_DEDUP,
+    KB_TOMBSTONE_COMPACT_RATIO, KB_TOMBSTONE_COMPACT_MIN, KB_DELTA_MERGE_SIZE,
+    KB_HYBRID_LEXICAL_WEIGHT, KB_HYBRID_CANDIDATES, KB_RRF_K, KB_LEXICAL_MAX_TERM_CHUNKS,
+    KB_QUERY_EMBEDDING_CACHE_SIZE, KB_SEARCH_RESULT_CACHE_SIZE, KB_SEARCH_BATCH_WINDOW_MS, KB_SEARCH_BATCH_MAX_SIZE
+)
+from vector_store_log import VectorStoreLog
+from embedding_cache import EmbeddingCache
+from chunk_store import ChunkStore
+from index_snapshot import IndexSnapshot, DeltaBuffer
+from exact_vector_store import ExactVectorStore
+from query_cache import LRUCache
+from micro_batcher import MicroBatcher
+from streaming_splitter import iter_chunks, batched
+import vector_index
+from vector_index import INDEX_FLAT
 
 logger = logging.getLogger(__name__)
 
+# Модель встраивания внутри процесса пула (каждый процесс загружает свою копию)
+_worker_embeddings: HuggingFaceEmbeddings | None = None
+
+
+def _init_embedding_worker(model_name: str):
+    global _worker_embeddings
+    _worker_embeddings = HuggingFaceEmbeddings(model_name=model_name)
+
+
+def _embed_texts_in_worker(texts: List[str]) -> np.ndarray:
+    return np.asarray(_worker_embeddings.embed_documents(texts), dtype=np.float32)
+
+
+def normalize_query(query: str) -> str:
+    """Приводит вопрос к виду, в котором повторы совпадают: нижний регистр, одиночные пробелы."""
+    return " ".join(query.lower().split())
+
+
+def _source_filter(source_ids: Iterable[str] | None) -> Tuple[str, ...] | None:
+    """Фильтр по источникам в виде, пригодном для ключа кэша (None - без фильтра)."""
+    return tuple(sorted(set(source_ids))) if source_ids is not None else None
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], weights: List[float], k: int,
+                           rrf_k: int = 60) -> List[Tuple[int, float]]:
+    """
+    Объединяет несколько ранжированных выдач (Reciprocal Rank Fusion): элемент получает
+    сумму weight / (rrf_k + место) по всем выдачам, где он встретился. Сравниваются только места,
+    поэтому несопоставимые оценки (расстояние L2 и BM25) приводить к одной шкале не нужно.
+    :return: Пары (элемент, оценка RRF) по убыванию оценки.
+    """
+    scores: Dict[int, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        if weight <= 0:
+            continue
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + weight / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda entry: -entry[1])[:k]
+
+
+class EmbeddingResources:
+    """
+    Модель встраивания и все, что с ней связано: разбиение на чанки, дисковый кэш эмбеддингов,
+    пул векторизации и кэш векторов запросов. Создается один раз на процесс и разделяется
+    всеми коллекциями базы знаний.
+    """
 
-class KnowledgeBaseService:
     def __init__(self):
         self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, length_function=len)
         logger.info("Инициализация модели встраивания... Это может занять некоторое время.")
         self.embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
         logger.info("Модель встраивания успешно загружена.")
-        self.vector_store = self._load_vector_store()
-        self.source_id_to_faiss_ids_map: Dict[str, List[str]] = self._load_source_map()
-
-    def _load_vector_store(self) -> FAISS | None:
-        folder_path, index_name = os.path.dirname(VECTOR_STORE_PATH), os.path.basename(VECTOR_STORE_PATH)
-        if os.path.exists(f"{VECTOR_STORE_PATH}.faiss"):
-            try:
-                logger.info(f"Загрузка существующей базы знаний из {VECTOR_STORE_PATH}")
-                return FAISS.load_local(folder_path=folder_path, index_name=index_name, embeddings=self.embeddings,
-                                        allow_dangerous_deserialization=True)
-            except Exception as e:
-                logger.error(f"Ошибка при загрузке базы знаний: {e}. Будет создана новая база.", exc_info=True)
-                if os.path.exists(f"{VECTOR_STORE_PATH}.faiss"): os.remove(f"{VECTOR_STORE_PATH}.faiss")
-                if os.path.exists(f"{VECTOR_STORE_PATH}.pkl"): os.remove(f"{VECTOR_STORE_PATH}.pkl")
-                return None
-        logger.info("Существующая база знаний не найдена. Будет создана новая при добавлении данных.")
-        return None
-
-    def _load_source_map(self) -> Dict[str, List[str]]:
-        if os.path.exists(SOURCE_MAP_PATH):
-            try:
-                with open(SOURCE_MAP_PATH, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.error(f"Ошибка при загрузке карты источников {SOURCE_MAP_PATH}: {e}", exc_info=True)
-                if os.path.exists(SOURCE_MAP_PATH): os.remove(SOURCE_MAP_PATH)
-        return {}
-
-    def _save_source_map(self):
-        os.makedirs(os.path.dirname(SOURCE_MAP_PATH), exist_ok=True)
+        self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_MODEL_NAME, EMBEDDING_CACHE_MAX_MB)
+        self.embedding_pool: ProcessPoolExecutor | None = None
+        if EMBEDDING_WORKERS > 0:
+            # spawn, а не fork: форк процесса с уже запущенными потоками torch может зависнуть
+            self.embedding_pool = ProcessPoolExecutor(max_workers=EMBEDDING_WORKERS,
+                                                      mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=_init_embedding_worker,
+                                                      initargs=(EMBEDDING_MODEL_NAME,))
+            logger.info(f"Пул векторизации запущен: {EMBEDDING_WORKERS} процесс(ов).")
+        self.query_embedding_cache = LRUCache(KB_QUERY_EMBEDDING_CACHE_SIZE)
+
+    def close(self):
+        """Останавливает пул векторизации и закрывает кэш эмбеддингов. Коллекции к этому моменту закрыты."""
+        if self.embedding_pool is not None:
+            self.embedding_pool.shutdown(wait=True, cancel_futures=True)
+            self.embedding_pool = None
+        self.embedding_cache.close()
+
+
+class KnowledgeBaseService:
+    def __init__(self, resources: EmbeddingResources | None = None, store_dir: str | None = None):
+        """
+        :param resources: Общая модель встраивания; если не передана, сервис создает свою.
+        :param store_dir: Папка коллекции. None - общая база знаний по прежним путям из config.
+        """
+        resources = resources or EmbeddingResources()
+        self.text_splitter = resources.text_splitter
+        self.embeddings = resources.embeddings
+        self.embedding_cache = resources.embedding_cache
+        self._embedding_pool = resources.embedding_pool
+        self._query_embedding_cache = resources.query_embedding_cache
+        if store_dir is None:
+            self._vector_store_path, self._chunk_store_path = VECTOR_STORE_PATH, CHUNK_STORE_PATH
+            self._source_map_path: str | None = SOURCE_MAP_PATH
+        else:
+            self._vector_store_path = os.path.join(store_dir, 'faiss_index')
+            self._chunk_store_path = os.path.join(store_dir, 'chunk_store.sqlite3')
+            self._source_map_path = None  # Коллекции появились позже карты источников
+        # Ключ - (нормализованный запрос, k, версия снимка): после любой публикации старые записи не находятся
+        self._search_result_cache = LRUCache(KB_SEARCH_RESULT_CACHE_SIZE)
+        self._search_batcher: MicroBatcher | None = None
+        if KB_SEARCH_BATCH_WINDOW_MS > 0:
+            self._search_batcher = MicroBatcher(self._search_requests, KB_SEARCH_BATCH_WINDOW_MS / 1000,
+                                                max_batch_size=KB_SEARCH_BATCH_MAX_SIZE)
+        # Поиск читает только опубликованный снимок индекса (self._snapshot) и блокировок не берет.
+        # _lock упорядочивает писателей (журнал, хранилище чанков, базовый индекс, дельта, надгробия),
+        # _snapshot_lock не дает перестраивать базовый индекс и писать снимок на диск одновременно
+        self._lock = threading.RLock()
+        self._snapshot_lock = threading.Lock()
+        self._compaction_thread: threading.Thread | None = None
+        self.wal = VectorStoreLog(f"{self._vector_store_path}.wal")
+        self.chunk_store = ChunkStore(self._chunk_store_path)
+        self._recover_snapshot()
+        # Состояние писателей. Базовый индекс после публикации не меняется: новые векторы копятся в дельте,
+        # а фоновые перестроения собирают новый базовый индекс из копии и подменяют его целиком
+        self._base: faiss.Index | None = None
+        self._base_mmapped = False
+        self._delta: DeltaBuffer | None = None
+        # Надгробия: id удаленных чанков, векторы которых еще физически лежат в индексе
+        self._tombstones: frozenset = frozenset()
+        # Точные векторы базового индекса, если он хранит их со сжатием (KB_VECTOR_COMPRESSION, IVF-PQ)
+        self._exact_vectors: ExactVectorStore | None = None
+        self._snapshot = IndexSnapshot()
+        self._load_index()
+        self._next_index_id = self._max_used_index_id() + 1
+        self._replay_log()
+        self._publish()
+
+    @property
+    def index(self) -> faiss.Index | None:
+        """Опубликованный базовый индекс. Векторы, добавленные после его построения, лежат в дельте снимка."""
+        return self._snapshot.base
+
+    @property
+    def vector_count(self) -> int:
+        """Число живых (не удаленных) векторов в опубликованной версии базы."""
+        return self._snapshot.live_count
+
+    def memory_bytes(self) -> int:
+        """
+        Оценка памяти, занятой индексом базы. Отображенный из файла индекс не учитывается:
+        его страницы при нехватке памяти вытесняет сама ОС.
+        """
+        snapshot = self._snapshot
+        base_bytes = 0
+        if snapshot.base is not None and not self._base_mmapped:
+            base_bytes = vector_index.memory_bytes(snapshot.base)
+        exact_bytes = snapshot.exact_vectors.memory_bytes if snapshot.exact_vectors is not None else 0
+        return base_bytes + exact_bytes + snapshot.delta_ids.nbytes + snapshot.delta_vectors.nbytes
+
+    def close(self):
+        """
+        Выгружает базу из памяти: дожидается фоновой компактизации и закрывает файлы.
+        Изменения, не вошедшие в снимок, остаются в журнале и применятся при следующей загрузке.
+        """
+        compaction_thread = self._compaction_thread
+        if compaction_thread is not None:
+            compaction_thread.join()
+        with self._lock:
+            self.wal.close()
+            self.chunk_store.close()
+
+    def _snapshot_files(self) -> List[str]:
+        return [f"{self._vector_store_path}{suffix}" for suffix in ('.faiss', '.tombstones', '.vector_ids', '.vectors')]
+
+    def _recover_snapshot(self):
+        """
+        Доводит до конца или откатывает запись снимка, прерванную сбоем.
+        Снимок пишется во временные файлы `*.next`; маркер `.commit` появляется только после того,
+        как все они сброшены на диск, поэтому при наличии маркера переименование безопасно повторить.
+        Повернутый журнал при этом уже вошел в снимок и удаляется, чтобы не применить его дважды.
+        """
+        commit_marker = f"{self._vector_store_path}.commit"
+        if os.path.exists(commit_marker):
+            logger.warning("Обнаружен незавершенный снимок базы знаний. Завершаю его применение.")
+            for path in self._snapshot_files():
+                if os.path.exists(f"{path}.next"):
+                    os.replace(f"{path}.next", path)
+            self.wal.discard_rotated()
+            os.remove(commit_marker)
+        else:
+            for path in self._snapshot_files():
+                if os.path.exists(f"{path}.next"):
+                    logger.warning(f"Удаляю неполный файл снимка {path}.next")
+                    os.remove(f"{path}.next")
+
+    def _load_index(self):
+        index_path = f"{self._vector_store_path}.faiss"
+        if not os.path.exists(index_path):
+            logger.info("Существующая база знаний не найдена. Будет создана новая при добавлении данных.")
+            return
+        try:
+            logger.info(f"Загрузка существующей базы знаний из {self._vector_store_path}"
+                        f"{' (индекс отображается из файла)' if KB_INDEX_MMAP else ''}")
+            self._base, self._base_mmapped = vector_index.read_index(index_path, mmap=KB_INDEX_MMAP)
+            if os.path.exists(f"{self._vector_store_path}.tombstones"):
+                tombstones = np.fromfile(f"{self._vector_store_path}.tombstones", dtype=np.int64)
+                self._tombstones = frozenset(tombstones.tolist())
+            if os.path.exists(f"{self._vector_store_path}.pkl"):
+                self._import_legacy_docstore()
+            # Карта источников старого формата больше не нужна: источники чанков знает хранилище
+            if self._source_map_path:
+                for path in (self._source_map_path, f"{self._source_map_path}.next"):
+                    if os.path.exists(path): os.remove(path)
+            migrated = vector_index.ensure_id_mapped(self._base)
+            if migrated is not self._base:
+                self._base, self._base_mmapped = migrated, False
+            if vector_index.is_lossy(self._base) and os.path.exists(f"{self._vector_store_path}.vector_ids"):
+                self._exact_vectors = ExactVectorStore.open(self._vector_store_path, self._base.d)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке базы знаний: {e}. Будет создана новая база.", exc_info=True)
+            self._base, self._base_mmapped = None, False
+            self._tombstones = frozenset()
+            self._exact_vectors = None
+            self.chunk_store.clear()
+            if os.path.exists(index_path): os.remove(index_path)
+            for suffix in ('.tombstones', '.pkl'):
+                if os.path.exists(f"{self._vector_store_path}{suffix}"): os.remove(f"{self._vector_store_path}{suffix}")
+            ExactVectorStore.remove_files(self._vector_store_path)
+
+    def _max_used_index_id(self) -> int:
+        # Id удаленного чанка нельзя выдавать повторно, пока его вектор лежит в базовом индексе
+        # и числится в надгробиях: новый чанк оказался бы скрыт надгробием или удален вместе со старым вектором
+        max_id = max(self.chunk_store.max_index_id(), max(self._tombstones, default=-1))
+        if self._base is not None and self._base.ntotal:
+            max_id = max(max_id, int(vector_index.index_ids(self._base).max()))
+        return max_id
+
+    def _import_legacy_docstore(self):
+        """
+        Переносит чанки из снимка старого формата (pickle с docstore LangChain) в хранилище чанков.
+        Перенос идемпотентен, поэтому сбой до удаления .pkl просто повторит его при следующем запуске.
+        """
+        legacy_path = f"{self._vector_store_path}.pkl"
+        with open(legacy_path, 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        index_ids = list(index_to_docstore_id)
+        doc_ids = [index_to_docstore_id[index_id] for index_id in index_ids]
+        # Чанки группируются по источнику, чтобы метаданные источника сохранились один раз
+        by_source: Dict[str, Tuple[Dict[str, Any], List[int], List[str], List[str]]] = {}
+        for index_id, doc_id in zip(index_ids, doc_ids):
+            document = docstore.search(doc_id)
+            key = json.dumps(document.metadata, sort_keys=True, ensure_ascii=False)
+            group = by_source.setdefault(key, (document.metadata, [], [], []))
+            group[1].append(index_id)
+            group[2].append(doc_id)
+            group[3].append(document.page_content)
+        for metadata, group_index_ids, group_doc_ids, texts in by_source.values():
+            self.chunk_store.add(group_index_ids, group_doc_ids, texts, metadata)
+        self.chunk_store.flush()
+        os.remove(legacy_path)
+        logger.info(f"Чанки снимка старого формата ({len(doc_ids)}) перенесены в хранилище чанков.")
+
+    def _replay_log(self):
+        """
+        Применяет к загруженному снимку изменения из журнала, которые еще не вошли в снимок.
+        Хранилище чанков обновляется сразу и может опережать снимок индекса, поэтому записи журнала
+        несут id в индексе, а повторная запись чанков в хранилище ничего не меняет.
+        """
+        replayed = 0
         try:
-            with open(SOURCE_MAP_PATH, 'w', encoding='utf-8') as f:
-                json.dump(self.source_id_to_faiss_ids_map, f, indent=4)
+            for record in self.wal.replay():
+                payload = record.payload
+                if record.op == 'add':
+                    doc_ids, texts, vectors = payload['ids'], payload['texts'], record.vectors
+                    index_ids = payload.get('index_ids')
+                    if index_ids is None:
+                        # Запись старого формата: id в индексе назначаются заново, известные чанки пропускаются
+                        known = self.chunk_store.index_ids_for(doc_ids)
+                        keep = [i for i, doc_id in enumerate(doc_ids) if doc_id not in known]
+                        doc_ids, texts, vectors = [doc_ids[i] for i in keep], [texts[i] for i in keep], vectors[keep]
+                        index_ids = self._allocate_index_ids(len(doc_ids))
+                    self._apply_add(index_ids, doc_ids, texts, payload['metadata'], vectors,
+                                    payload.get('source_info', {}))
+                elif record.op == 'share':
+                    self.chunk_store.add_refs(payload['index_ids'], payload['metadata'],
+                                              **payload.get('source_info', {}))
+                elif record.op == 'delete':
+                    index_ids = payload.get('index_ids')
+                    if index_ids is None:
+                        index_ids = list(self.chunk_store.index_ids_for(payload['ids']).values())
+                    self._apply_delete(index_ids, payload.get('source_id'))
+                elif record.op == 'clear':
+                    self._apply_clear()
+                replayed += 1
         except Exception as e:
-            logger.error(f"Ошибка при сохранении карты источников в {SOURCE_MAP_PATH}: {e}", exc_info=True)
+            logger.error(f"Ошибка при воспроизведении журнала базы знаний: {e}", exc_info=True)
+        if replayed:
+            logger.info(f"Из журнала базы знаний восстановлено операций: {replayed}.")
+
+    def _allocate_index_ids(self, count: int) -> List[int]:
+        index_ids = list(range(self._next_index_id, self._next_index_id + count))
+        self._next_index_id += count
+        return index_ids
+
+    def _apply_add(self, index_ids: List[int], doc_ids: List[str], texts: List[str], metadata: Dict[str, Any],
+                   vectors: np.ndarray, source_info: Dict[str, Any]):
+        """Изменения писателей становятся видны поиску только после self._publish()."""
+        if not index_ids:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self._delta is None:
+            self._delta = DeltaBuffer(vectors.shape[1])
+        # Чанки сохраняются раньше векторов, чтобы поиск не нашел id без текста
+        self.chunk_store.add(index_ids, doc_ids, texts, metadata, **source_info)
+        self._delta.append(np.asarray(index_ids, dtype=np.int64), vectors)
+        self._next_index_id = max(self._next_index_id, max(index_ids) + 1)
+
+    def _apply_delete(self, index_ids: List[int], source_id: str | None = None):
+        """
+        Логическое удаление: id становятся надгробиями и сразу исключаются из поиска, а векторы
+        физически удаляет фоновая компактизация (_purge_tombstones), не задерживая пользователя.
+        :param source_id: Если задан, сначала снимаются все ссылки источника; index_ids - его чанки,
+                          на которые не ссылаются другие источники.
+        """
+        if source_id:
+            self.chunk_store.remove_source(source_id)
+        if not index_ids:
+            return
+        self._tombstones = self._tombstones.union(index_ids)
+        self.chunk_store.delete(index_ids)
 
-    def add_text(self, text: str, metadata: Dict[str, Any]):
+    def _apply_clear(self):
+        self._base, self._base_mmapped = None, False
+        self._exact_vectors = None
+        self._delta = None
+        self._tombstones = frozenset()
+        self.chunk_store.clear()
+
+    def _publish(self):
+        """
+        Публикует текущее состояние писателей как новую версию для поиска (вызывается под self._lock).
+        Дельта передается срезом, который последующие добавления не меняют, а параметры поиска
+        по базовому индексу пересобираются, только если поменялись сам индекс или надгробия.
+        """
+        previous = self._snapshot
+        delta_ids, delta_vectors = self._delta.view() if self._delta is not None else (
+            np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32))
+        tombstone_array = self._tombstone_array()
+        base_params = previous.base_params
+        if self._base is not previous.base or self._tombstones is not previous.tombstones:
+            base_params = (vector_index.search_params(self._base, tombstone_array)
+                           if self._base is not None and self._tombstones else None)
+        delta_dead = int(np.isin(delta_ids, tombstone_array).sum()) if self._tombstones else 0
+        self._snapshot = IndexSnapshot(base=self._base, delta_ids=delta_ids, delta_vectors=delta_vectors,
+                                       tombstones=self._tombstones, version=previous.version + 1,
+                                       base_params=base_params, delta_dead=delta_dead,
+                                       max_id=self._next_index_id - 1, exact_vectors=self._exact_vectors,
+                                       rerank_factor=KB_RERANK_FACTOR)
+
+    def _tombstone_array(self) -> np.ndarray:
+        return np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+
+    def add_text(self, text: str, metadata: Dict[str, Any],
+                 progress_callback: Callable[[int, int | None], None] | None = None) -> int:
+        """Добавляет в базу знаний текст целиком (см. add_blocks)."""
+        return self.add_blocks([text], metadata, progress_callback=progress_callback)
+
+    def add_blocks(self, blocks: Iterable[str], metadata: Dict[str, Any],
+                   progress_callback: Callable[[int, int | None], None] | None = None) -> int:
+        """
+        Потоково добавляет документ, заданный последовательностью блоков текста (страниц, абзацев).
+        Блоки разбиваются на чанки по мере чтения, а чанки векторизуются и попадают в индекс и журнал
+        батчами по EMBEDDING_BATCH_SIZE, поэтому в памяти одновременно находятся лишь несколько батчей,
+        а не весь документ. При ошибке уже добавленная часть документа удаляется, а ошибка пробрасывается.
+        :param progress_callback: Необязательная функция (обработано_чанков, всего_чанков), вызывается
+                                  из рабочего потока после каждого батча; всего_чанков - None, пока
+                                  документ еще читается.
+        :return: Число чанков документа.
+        """
         source_id = metadata.get('source_id')
-        if source_id and source_id in self.source_id_to_faiss_ids_map:
+        if source_id and self.chunk_store.has_source(source_id):
             logger.info(f"Обнаружены существующие данные для source_id '{source_id}'. Удаляю старые чанки.")
             self.delete_by_source_id(source_id)
 
-        chunks = self.text_splitter.split_text(text)
-        if not chunks:
-            logger.warning("Текст не содержит чанков для добавления в базу знаний.")
-            return
+        # Размер и хеш документа считаются по ходу чтения и попадают в каталог в конце загрузки
+        content_hash, stream = hashlib.sha256(), {'bytes': 0, 'chunks': 0, 'exhausted': False}
+        source_info = {'byte_size': None, 'ingested_at': time.time(), 'content_hash': None}
+
+        def read_blocks() -> Iterator[str]:
+            for i, block in enumerate(blocks):
+                encoded = (f"\n{block}" if i else block).encode('utf-8')
+                content_hash.update(encoded)
+                stream['bytes'] += len(encoded)
+                yield block
 
-        metadatas = [metadata] * len(chunks)
+        def count_chunks(chunks: Iterable[str]) -> Iterator[str]:
+            for chunk in chunks:
+                stream['chunks'] += 1
+                yield chunk
+            stream['exhausted'] = True
+
+        chunk_batches = batched(count_chunks(iter_chunks(self.text_splitter, read_blocks())), EMBEDDING_BATCH_SIZE)
+        seen: set = set()
+        processed, added_index_ids = 0, []
         try:
-            if self.vector_store:
-                faiss_doc_ids = self.vector_store.add_texts(texts=chunks, metadatas=metadatas)
+            if KB_CHUNK_DEDUP and source_id:
+                chunk_batches = (self._share_near_duplicates(batch, metadata, source_info, seen)
+                                 for batch in chunk_batches)
             else:
-                self.vector_store = FAISS.from_texts(texts=chunks, embedding=self.embeddings, metadatas=metadatas)
-                faiss_doc_ids = list(self.vector_store.docstore._dict.keys())
-
+                chunk_batches = ((batch, 0) for batch in chunk_batches)
+            for batch, vectors, shared_count in self._iter_embedded_batches(chunk_batches):
+                if batch:
+                    doc_ids = [str(uuid4()) for _ in batch]
+                    with self._lock:
+                        index_ids = self._allocate_index_ids(len(batch))
+                        self.wal.append('add', {'source_id': source_id, 'ids': doc_ids, 'index_ids': index_ids,
+                                                'texts': batch, 'metadata': metadata, 'source_info': source_info},
+                                        vectors)
+                        self._apply_add(index_ids, doc_ids, batch, metadata, vectors, source_info)
+                        self._publish()
+                    added_index_ids.extend(index_ids)
+                processed += len(batch) + shared_count
+                if progress_callback:
+                    progress_callback(processed, stream['chunks'] if stream['exhausted'] else None)
+                self._schedule_compaction_if_needed()
+            if not stream['chunks']:
+                logger.warning("Текст не содержит чанков для добавления в базу знаний.")
+                return 0
             if source_id:
-                self.source_id_to_faiss_ids_map[source_id] = faiss_doc_ids
-            self.save_vector_store()
+                self.chunk_store.update_source(source_id, stream['bytes'], content_hash.hexdigest())
+            return stream['chunks']
         except Exception as e:
             logger.error(f"Ошибка при добавлении текста в FAISS: {e}", exc_info=True)
+            # Не оставляем в базе половину документа
+            if source_id:
+                self._delete_source(source_id)
+            elif added_index_ids:
+                with self._lock:
+                    self.wal.append('delete', {'source_id': source_id, 'index_ids': added_index_ids})
+                    self._apply_delete(added_index_ids)
+                    self._publish()
+            raise
 
-    def delete_by_source_id(self, source_id: str) -> bool:
-        if not self.vector_store or source_id not in self.source_id_to_faiss_ids_map:
-            return False
+    def _share_near_duplicates(self, batch: List[str], metadata: Dict[str, Any], source_info: Dict[str, Any],
+                               seen: set) -> Tuple[List[str], int]:
+        """
+        Делает общими с другими источниками чанки батча, почти дубликаты которых уже есть в базе,
+        и отбрасывает точные повторы внутри документа (seen - хеши уже встреченных чанков).
+        :return: (чанки, которые нужно векторизовать, число обработанных без векторизации).
+        """
+        new_chunks, shared = [], {}
+        for chunk, match in zip(batch, self.chunk_store.find_near_duplicates(batch)):
+            if match is not None:
+                shared.setdefault(match, chunk)
+                continue
+            digest = hashlib.blake2b(chunk.encode('utf-8'), digest_size=16).digest()
+            if digest not in seen:
+                seen.add(digest)
+                new_chunks.append(chunk)
+        if shared:
+            with self._lock:
+                self.wal.append('share', {'source_id': metadata['source_id'], 'index_ids': list(shared),
+                                          'metadata': metadata, 'source_info': source_info})
+                gone = self.chunk_store.add_refs(list(shared), metadata, **source_info)
+                self._publish()
+            # Чанки, удаленные из базы уже после поиска дубликатов, добавляются как новые
+            new_chunks.extend(shared[index_id] for index_id in gone)
+            logger.info(f"Почти дубликаты: {len(shared) - len(gone)} чанков уже есть в базе "
+                        f"и будут общими с другими источниками.")
+        return new_chunks, len(batch) - len(new_chunks)
+
+    def _iter_embedded_batches(self, batches: Iterable[Tuple[List[str], int]]
+                               ) -> Iterator[Tuple[List[str], np.ndarray, int]]:
+        """
+        Векторизует поток пар (батч чанков, число пропущенных чанков) и отдает тройки
+        (батч, векторы, число пропущенных) в исходном порядке. С пулом процессов несколько батчей
+        считаются параллельно; окно упреждения ограничено, чтобы память не росла вместе с размером документа.
+        """
+        window = EMBEDDING_WORKERS * 2 if self._embedding_pool else 1
+        pending: deque = deque()
+        cache_hits = total = 0
+        for batch, skipped in batches:
+            total += len(batch)
+            pending.append((self._submit_batch(batch), skipped))
+            if len(pending) >= window:
+                submitted, skipped = pending.popleft()
+                batch, vectors, hits = self._collect_batch(*submitted)
+                cache_hits += hits
+                yield batch, vectors, skipped
+        while pending:
+            submitted, skipped = pending.popleft()
+            batch, vectors, hits = self._collect_batch(*submitted)
+            cache_hits += hits
+            yield batch, vectors, skipped
+        if cache_hits:
+            logger.info(f"Кэш эмбеддингов: {cache_hits} из {total} чанков уже были вычислены ранее.")
+
+    def _submit_batch(self, batch: List[str]) -> Tuple[List[str], Dict[int, np.ndarray], List[int], Future | None]:
+        """Ищет батч в кэше и, если есть пул процессов, отправляет в него недостающие чанки."""
+        cached = self.embedding_cache.get_many(batch)
+        missing = [i for i in range(len(batch)) if i not in cached]
+        future = None
+        if missing and self._embedding_pool:
+            future = self._embedding_pool.submit(_embed_texts_in_worker, [batch[i] for i in missing])
+        return batch, cached, missing, future
 
-        faiss_ids_to_delete = self.source_id_to_faiss_ids_map.pop(source_id)
+    def _collect_batch(self, batch: List[str], cached: Dict[int, np.ndarray], missing: List[int],
+                       future: Future | None) -> Tuple[List[str], np.ndarray, int]:
+        if not batch:
+            return batch, np.empty((0, 0), dtype=np.float32), 0
+        vectors: List[np.ndarray | None] = [cached.get(i) for i in range(len(batch))]
+        if missing:
+            missing_texts = [batch[i] for i in missing]
+            if future is not None:
+                computed = future.result()
+            else:
+                computed = np.asarray(self.embeddings.embed_documents(missing_texts), dtype=np.float32)
+            self.embedding_cache.put_many(missing_texts, computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        return batch, np.vstack(vectors).astype(np.float32, copy=False), len(cached)
+
+    def delete_by_source_id(self, source_id: str) -> bool:
         try:
-            self.vector_store.delete(faiss_ids_to_delete)
-            self.save_vector_store()
-            logger.info(f"Успешно удалено {len(faiss_ids_to_delete)} чанков для source_id '{source_id}'.")
+            if not self.chunk_store.has_source(source_id):
+                return False
+            removed = self._delete_source(source_id)
+            self._schedule_compaction_if_needed()
+            logger.info(f"Успешно удалено {removed} чанков для source_id '{source_id}'.")
             return True
         except Exception as e:
             logger.error(f"Ошибка при удалении чанков для source_id '{source_id}': {e}", exc_info=True)
-            self.source_id_to_faiss_ids_map[source_id] = faiss_ids_to_delete  # Rollback
             return False
 
+    def _delete_source(self, source_id: str) -> int:
+        """
+        Снимает ссылки источника и удаляет чанки, на которые больше никто не ссылается.
+        Общие с другими источниками чанки остаются в индексе.
+        :return: Число удаленных чанков.
+        """
+        with self._lock:
+            index_ids = self.chunk_store.orphaned_by_source(source_id)
+            self.wal.append('delete', {'source_id': source_id, 'index_ids': index_ids})
+            self._apply_delete(index_ids, source_id)
+            self._publish()
+        return len(index_ids)
+
+    def _schedule_compaction_if_needed(self):
+        """
+        Запускает фоновую компактизацию, если журнал вырос сверх порога по размеру или возрасту,
+        индекс пора перевести на ANN, в нем накопилось много удаленных векторов или дельта
+        стала слишком большой для поиска полным перебором.
+        """
+        wal_size_mb = self.wal.size_bytes / (1024 * 1024)
+        if (wal_size_mb < KB_WAL_COMPACT_SIZE_MB and self.wal.age_seconds < KB_WAL_COMPACT_INTERVAL_SECONDS
+                and not self._needs_index_promotion() and not self._needs_tombstone_purge()
+                and len(self._snapshot.delta_ids) < KB_DELTA_MERGE_SIZE):
+            return
+        with self._lock:
+            if self._compaction_thread and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(target=self._compact_in_background,
+                                                       name="kb-compaction", daemon=True)
+            self._compaction_thread.start()
+
+    def _compact_in_background(self):
+        try:
+            logger.info("Начинаю фоновую компактизацию журнала базы знаний.")
+            self._promote_index()
+            self._purge_tombstones()
+            self.save_vector_store()
+        except Exception as e:
+            logger.error(f"Ошибка при фоновой компактизации базы знаний: {e}", exc_info=True)
+
+    def _needs_index_promotion(self) -> bool:
+        snapshot = self._snapshot
+        return (KB_INDEX_TYPE != INDEX_FLAT and snapshot.ntotal > 0
+                and (snapshot.base is None or vector_index.index_kind(snapshot.base) == INDEX_FLAT)
+                and snapshot.live_count >= KB_INDEX_PROMOTE_THRESHOLD)
+
+    def _needs_tombstone_purge(self) -> bool:
+        snapshot = self._snapshot
+        dead = len(snapshot.tombstones)
+        return dead > 0 and dead >= KB_TOMBSTONE_COMPACT_MIN and dead >= KB_TOMBSTONE_COMPACT_RATIO * snapshot.ntotal
+
+    def _promote_index(self):
+        """
+        Переводит плоский индекс на ANN-индекс KB_INDEX_TYPE: обучает его, подбирает nprobe/efSearch
+        по recall относительно точного поиска и подменяет базовый индекс. Построение идет без блокировки
+        по опубликованному снимку; удаленные векторы в новый индекс не попадают.
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                if not self._needs_index_promotion():
+                    return
+                snapshot, purged = self._snapshot, self._tombstone_array()
+
+            ids, vectors = self._live_vectors(snapshot, purged)
+            logger.info(f"Число чанков ({len(ids)}) достигло порога {KB_INDEX_PROMOTE_THRESHOLD}. "
+                        f"Строю индекс {KB_INDEX_TYPE} вместо плоского...")
+            started = time.monotonic()
+            new_index = vector_index.build_ann_index(KB_INDEX_TYPE, ids, vectors, nlist=KB_IVF_NLIST,
+                                                     pq_m=KB_IVF_PQ_M, hnsw_m=KB_HNSW_M)
+            search_param, recall = vector_index.tune_search_params(new_index, ids, vectors,
+                                                                   target_recall=KB_INDEX_TARGET_RECALL)
+            # IVF-PQ хранит векторы приближенно: точные остаются для переранжирования
+            exact_vectors = (ExactVectorStore(vectors.shape[1]).with_vectors(ids, vectors)
+                             if vector_index.is_lossy(new_index) else None)
+            del vectors
+
+            with self._lock:
+                self._install_base(new_index, snapshot, purged, exact_vectors)
+            logger.info(f"Индекс {KB_INDEX_TYPE} построен за {time.monotonic() - started:.1f} с: "
+                        f"параметр поиска={search_param}, recall@10 относительно точного поиска={recall:.3f}.")
+
+    def _purge_tombstones(self):
+        """
+        Физически удаляет из индекса векторы удаленных чанков. Удаление (для HNSW - перестроение графа)
+        идет на копии базового индекса без блокировки, а поиск все это время работает с прежним снимком.
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                if not self._needs_tombstone_purge():
+                    return
+                snapshot, tombstones = self._snapshot, self._tombstone_array()
+
+            started = time.monotonic()
+            new_base, purged, exact_vectors = self._build_merged_base(snapshot, tombstones, purge_base=True)
+            with self._lock:
+                self._install_base(new_base, snapshot, purged, exact_vectors)
+            logger.info(f"Из индекса физически удалено {len(purged)} векторов за {time.monotonic() - started:.1f} с.")
+
+    def _build_merged_base(self, snapshot: IndexSnapshot, tombstones: np.ndarray, purge_base: bool
+                           ) -> Tuple[faiss.Index, np.ndarray, ExactVectorStore | None]:
+        """
+        Собирает (без блокировки) новый базовый индекс: копию базы снимка с живыми векторами его дельты.
+        Плоский индекс, сжатый не так, как задает KB_VECTOR_COMPRESSION, вместо этого строится заново.
+        :param purge_base: Удалить из копии и векторы надгробий базового индекса.
+        :return: (индекс, надгробия, векторов которых в новом индексе уже нет,
+                  точные векторы для переранжирования или None, если индекс хранит векторы без потерь)
+        """
+        if self._needs_recompression(snapshot):
+            return self._build_compressed_base(snapshot, tombstones)
+        live = ~np.isin(snapshot.delta_ids, tombstones)
+        purged = snapshot.delta_ids[~live]
+        dead_in_base = np.setdiff1d(tombstones, purged) if purge_base else np.empty(0, dtype=np.int64)
+        if snapshot.base is None:
+            new_base = vector_index.create_flat_index(snapshot.delta_vectors.shape[1])
+        elif not live.any() and not len(dead_in_base):
+            return snapshot.base, purged, snapshot.exact_vectors
+        else:
+            new_base = vector_index.copy_to_memory(snapshot.base)
+        if len(dead_in_base):
+            new_base = vector_index.remove_ids(new_base, dead_in_base)
+            purged = tombstones
+        if live.any():
+            new_base.add_with_ids(snapshot.delta_vectors[live], snapshot.delta_ids[live])
+        exact_vectors = None
+        if vector_index.is_lossy(new_base):
+            exact_vectors = (snapshot.exact_vectors or ExactVectorStore(new_base.d)).with_vectors(
+                snapshot.delta_ids[live], snapshot.delta_vectors[live])
+        return new_base, purged, exact_vectors
+
+    def _needs_recompression(self, snapshot: IndexSnapshot) -> bool:
+        if snapshot.base is not None and vector_index.index_kind(snapshot.base) != INDEX_FLAT:
+            return False  # ANN-индекс хранит векторы по KB_INDEX_TYPE
+        return (vector_index.flat_compression(snapshot.base) != KB_VECTOR_COMPRESSION
+                and snapshot.live_count >= max(1, vector_index.compression_min_size(KB_VECTOR_COMPRESSION)))
+
+    def _build_compressed_base(self, snapshot: IndexSnapshot, tombstones: np.ndarray
+                               ) -> Tuple[faiss.Index, np.ndarray, ExactVectorStore | None]:
+        """Строит плоский индекс со сжатием KB_VECTOR_COMPRESSION и пишет в лог, сколько он теряет в recall."""
+        ids, vectors = self._live_vectors(snapshot, tombstones)
+        started = time.monotonic()
+        new_base = vector_index.build_flat_index(KB_VECTOR_COMPRESSION, ids, vectors, pq_m=KB_IVF_PQ_M)
+        if not vector_index.is_lossy(new_base):
+            logger.info("Плоский индекс пересобран без сжатия векторов.")
+            return new_base, tombstones, None
+        recall, reranked_recall = vector_index.compression_recall(new_base, ids, vectors, KB_RERANK_FACTOR)
+        full_mb = len(ids) * (vectors.shape[1] * 4 + 16) / 1024 / 1024
+        logger.info(f"Плоский индекс пересобран со сжатием {KB_VECTOR_COMPRESSION} "
+                    f"за {time.monotonic() - started:.1f} с: "
+                    f"{vector_index.memory_bytes(new_base) / 1024 / 1024:.1f} МБ в памяти вместо {full_mb:.1f} МБ, "
+                    f"recall@10 относительно точного поиска {recall:.3f}, "
+                    f"после переранжирования x{KB_RERANK_FACTOR} кандидатов {reranked_recall:.3f}.")
+        return new_base, tombstones, ExactVectorStore(vectors.shape[1]).with_vectors(ids, vectors)
+
+    def _live_vectors(self, snapshot: IndexSnapshot, tombstones: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Id и векторы всех живых записей снимка. Векторы сжатого индекса берутся точные, если они есть."""
+        parts = []
+        if snapshot.base is not None:
+            ids, vectors = vector_index.export_vectors(snapshot.base)
+            if snapshot.exact_vectors is not None:
+                exact = snapshot.exact_vectors.get(ids)
+                known = ~np.isnan(exact[:, 0])
+                vectors[known] = exact[known]
+            parts.append((ids, vectors))
+        if len(snapshot.delta_ids):
+            parts.append((snapshot.delta_ids, snapshot.delta_vectors))
+        ids, vectors = np.concatenate([p[0] for p in parts]), np.vstack([p[1] for p in parts])
+        live = ~np.isin(ids, tombstones)
+        return ids[live], np.ascontiguousarray(vectors[live])
+
+    def _install_base(self, new_base: faiss.Index, snapshot: IndexSnapshot, purged: np.ndarray,
+                      exact_vectors: ExactVectorStore | None):
+        """
+        Подменяет базовый индекс перестроенным по снимку snapshot и публикует результат (под self._lock).
+        Новый индекс уже содержит дельту снимка, поэтому из дельты уходят только эти записи,
+        а добавленное после снимка остается в ней.
+        """
+        if self._delta is not None:
+            self._delta = self._delta.without_prefix(len(snapshot.delta_ids))
+        if new_base is not self._base:
+            self._base, self._base_mmapped = new_base, False
+        self._exact_vectors = exact_vectors
+        if len(purged):
+            self._tombstones = self._tombstones.difference(purged.tolist())
+        self._publish()
+
     def save_vector_store(self):
-        if self.vector_store:
-            folder_path, index_name = os.path.dirname(VECTOR_STORE_PATH), os.path.basename(VECTOR_STORE_PATH)
-            os.makedirs(folder_path, exist_ok=True)
-            self.vector_store.save_local(folder_path=folder_path, index_name=index_name)
-            self._save_source_map()
+        """
+        Записывает полный снимок базы знаний и очищает журнал изменений. Дельта при этом вливается
+        в базовый индекс. Под блокировкой только фиксируется опубликованная версия и поворачивается журнал,
+        сборка индекса и запись на диск идут без нее.
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                snapshot, tombstones = self._snapshot, self._tombstone_array()
+                if snapshot.ntotal == 0:
+                    return
+                self.wal.rotate()
+
+            new_base, purged, exact_vectors = self._build_merged_base(snapshot, tombstones, purge_base=False)
+            with self._lock:
+                self._install_base(new_base, snapshot, purged, exact_vectors)
+            contents = {f"{self._vector_store_path}.faiss": faiss.serialize_index(new_base).tobytes(),
+                        f"{self._vector_store_path}.tombstones": np.setdiff1d(tombstones, purged).tobytes()}
+            if exact_vectors is not None:
+                # Точные векторы пишутся только для записей индекса и по возрастанию id - для поиска по ним
+                base_ids = np.sort(vector_index.index_ids(new_base))
+                contents[f"{self._vector_store_path}.vector_ids"] = base_ids.tobytes()
+                contents[f"{self._vector_store_path}.vectors"] = exact_vectors.iter_bytes(base_ids)
+
+            self._write_snapshot(contents)
+            if exact_vectors is None:
+                ExactVectorStore.remove_files(self._vector_store_path)
+            else:
+                self._reopen_exact_vectors(exact_vectors, new_base.d)
+            if KB_INDEX_MMAP:
+                self._remap_index(new_base)
+            logger.info("Снимок базы знаний сохранен, журнал изменений очищен.")
+
+    def _write_snapshot(self, contents: Dict[str, bytes | Iterable[bytes]]):
+        """:param contents: Содержимое файлов снимка: байты или итератор кусков (для больших файлов)."""
+        os.makedirs(os.path.dirname(self._vector_store_path), exist_ok=True)
+        for path, data in contents.items():
+            with open(f"{path}.next", 'wb') as f:
+                for chunk in ([data] if isinstance(data, bytes) else data):
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        # Хранилище чанков не входит в снимок, но его последние изменения покрывает журнал, который сейчас удалится
+        self.chunk_store.flush()
+        commit_marker = f"{self._vector_store_path}.commit"
+        with open(commit_marker, 'wb') as f:
+            os.fsync(f.fileno())
+        for path in contents:
+            os.replace(f"{path}.next", path)
+        # Журнал удаляется до маркера: после сбоя на этом месте восстановление удалит его само
+        self.wal.discard_rotated()
+        os.remove(commit_marker)
+
+    def _reopen_exact_vectors(self, saved: ExactVectorStore, dim: int):
+        """Заменяет точные векторы в памяти отображением только что записанного файла снимка."""
+        with self._lock:
+            if self._exact_vectors is not saved:
+                return
+            self._exact_vectors = ExactVectorStore.open(self._vector_store_path, dim)
+            self._publish()
+
+    def _remap_index(self, saved_base: faiss.Index):
+        """Заменяет собранный в памяти базовый индекс отображением только что записанного снимка."""
+        with self._lock:
+            if self._base is not saved_base or self._base_mmapped:
+                return  # Базовый индекс уже перестроен заново
+            self._base, self._base_mmapped = vector_index.read_index(f"{self._vector_store_path}.faiss", mmap=True)
+            self._publish()
 
     def clear_all(self):
-        self.vector_store = None
-        self.source_id_to_faiss_ids_map = {}
-        if os.path.exists(f"{VECTOR_STORE_PATH}.faiss"): os.remove(f"{VECTOR_STORE_PATH}.faiss")
-        if os.path.exists(f"{VECTOR_STORE_PATH}.pkl"): os.remove(f"{VECTOR_STORE_PATH}.pkl")
-        if os.path.exists(SOURCE_MAP_PATH): os.remove(SOURCE_MAP_PATH)
+        with self._snapshot_lock, self._lock:
+            # Запись 'clear' гарантирует, что после сбоя посреди удаления файлов база не "воскреснет"
+            self.wal.append('clear', {})
+            self._apply_clear()
+            self._publish()
+            if os.path.exists(f"{self._vector_store_path}.faiss"): os.remove(f"{self._vector_store_path}.faiss")
+            for suffix in ('.tombstones', '.pkl'):
+                if os.path.exists(f"{self._vector_store_path}{suffix}"): os.remove(f"{self._vector_store_path}{suffix}")
+            ExactVectorStore.remove_files(self._vector_store_path)
+            self.wal.reset()
         logger.info("База знаний полностью очищена.")
 
-    def search(self, query: str, k: int = 4) -> list:
-        if not self.vector_store: return []
+    def search(self, query: str, k: int = 4, source_ids: Iterable[str] | None = None) -> List[Document]:
+        """
+        Гибридный поиск: векторная выдача объединяется с полнотекстовой (BM25) с весом KB_HYBRID_LEXICAL_WEIGHT.
+        Векторный поиск идет по опубликованному снимку без блокировок: одновременная загрузка документов
+        не задерживает его и не меняет видимое ему состояние посреди запроса.
+        Повторный вопрос к неизменившейся базе берется из кэша результатов без обращения к модели.
+        При включенном KB_SEARCH_BATCH_WINDOW_MS одновременные вопросы ищутся одним пакетом.
+        :param source_ids: Если задано - искать только в этих источниках (например, в одном файле).
+        """
+        sources = _source_filter(source_ids)
         try:
-            return self.vector_store.similarity_search(query, k=k)
+            if self._search_batcher is not None:
+                hits = self._search_batcher.submit((query, k, sources))
+            else:
+                hits = self._search_hits([query], k, sources)[0]
+            return [document for document, _ in self._load_documents([hits])[0]]
         except Exception as e:
             logger.error(f"Ошибка при поиске в базе знаний: {e}", exc_info=True)
             return []
 
-    def get_indexed_sources(self) -> List[Dict[str, str]]:
-        """Возвращает список уникальных источников, которые есть в базе знаний."""
-        if not self.vector_store:
-            return []
+    def search_batch(self, queries: List[str], k: int = 4,
+                     source_ids: Iterable[str] | None = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Ищет несколько запросов сразу: все непрокэшированные запросы векторизуются одним вызовом модели
+        и ищутся одним матричным поиском.
+        :param source_ids: Если задано - искать только в этих источниках.
+        :return: Для каждого запроса - пары (чанк, оценка), от наиболее релевантного. Оценка тем больше,
+                 чем релевантнее чанк: при гибридном поиске это оценка RRF,
+                 при чисто векторном - 1 / (1 + расстояние L2).
+        """
+        try:
+            return self._load_documents(self._search_hits(queries, k, _source_filter(source_ids)))
+        except Exception as e:
+            logger.error(f"Ошибка при пакетном поиске в базе знаний: {e}", exc_info=True)
+            return [[] for _ in queries]
+
+    def _search_requests(self, requests: List[Tuple[str, int, Tuple[str, ...] | None]]
+                         ) -> List[Tuple[Tuple[int, float], ...]]:
+        """Обработчик микропакета: запросы с разными k или фильтрами ищутся отдельными пакетами."""
+        results: List[Tuple[Tuple[int, float], ...] | None] = [None] * len(requests)
+        positions_by_params: Dict[Tuple[int, Tuple[str, ...] | None], List[int]] = {}
+        for position, (_, k, sources) in enumerate(requests):
+            positions_by_params.setdefault((k, sources), []).append(position)
+        for (k, sources), positions in positions_by_params.items():
+            for position, hits in zip(positions, self._search_hits([requests[p][0] for p in positions], k, sources)):
+                results[position] = hits
+        return results
+
+    def _search_hits(self, queries: List[str], k: int,
+                     sources: Tuple[str, ...] | None = None) -> List[Tuple[Tuple[int, float], ...]]:
+        """:return: Для каждого запроса - пары (id чанка, оценка), берутся из кэша результатов или ищутся пакетом."""
+        snapshot = self._snapshot
+        if snapshot.live_count <= 0:
+            return [() for _ in queries]
+        normalized_queries = [normalize_query(query) for query in queries]
+        results = [self._search_result_cache.get((query, k, sources, snapshot.version)) for query in normalized_queries]
+        missing = list(dict.fromkeys(query for query, hits in zip(normalized_queries, results) if hits is None))
+        if missing:
+            computed = dict(zip(missing, self._search_snapshot(snapshot, missing, k, sources)))
+            for query, hits in computed.items():
+                self._search_result_cache.put((query, k, sources, snapshot.version), hits)
+            results = [hits if hits is not None else computed[query]
+                       for query, hits in zip(normalized_queries, results)]
+        return results
+
+    def _search_snapshot(self, snapshot: IndexSnapshot, normalized_queries: List[str], k: int,
+                         sources: Tuple[str, ...] | None = None) -> List[Tuple[Tuple[int, float], ...]]:
+        include_ids = None
+        if sources is not None:
+            # Фильтр по источникам превращается в набор id, который FAISS проверяет при самом поиске
+            include_ids = np.array(self.chunk_store.index_ids_for_sources(list(sources)), dtype=np.int64)
+            if not len(include_ids):
+                return [() for _ in normalized_queries]
+        query_vectors = self._embed_queries(normalized_queries)
+        if KB_HYBRID_LEXICAL_WEIGHT <= 0:
+            return [tuple((index_id, 1.0 / (1.0 + distance)) for index_id, distance in row)
+                    for row in snapshot.search(query_vectors, k, include_ids)]
+        candidates = max(k, KB_HYBRID_CANDIDATES)
+        results = []
+        for query, dense in zip(normalized_queries, snapshot.search(query_vectors, candidates, include_ids)):
+            # Полнотекстовый индекс живой, а не снимок: чанки, записанные после публикации снимка
+            # или помеченные в нем надгробиями, отсекаются, чтобы обе половины видели одну версию
+            lexical = self.chunk_store.lexical_search(query, candidates, max_term_chunks=KB_LEXICAL_MAX_TERM_CHUNKS,
+                                                      source_ids=list(sources) if sources is not None else None,
+                                                      max_index_id=snapshot.max_id)
+            lexical = [index_id for index_id in lexical if index_id not in snapshot.tombstones]
+            results.append(tuple(reciprocal_rank_fusion(
+                [[index_id for index_id, _ in dense], lexical],
+                [1.0 - KB_HYBRID_LEXICAL_WEIGHT, KB_HYBRID_LEXICAL_WEIGHT], k, rrf_k=KB_RRF_K)))
+        return results
+
+    def _embed_queries(self, normalized_queries: List[str]) -> np.ndarray:
+        """Векторы запросов: из кэша или одним вызовом модели для всех недостающих."""
+        vectors = [self._query_embedding_cache.get(query) for query in normalized_queries]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Модель создается без отдельных настроек для запросов: embed_documents дает те же векторы, что embed_query
+            computed = np.asarray(self.embeddings.embed_documents([normalized_queries[i] for i in missing]),
+                                  dtype=np.float32)
+            for i, vector in zip(missing, computed):
+                # Один и тот же массив отдается всем попаданиям в кэш, поэтому он только для чтения
+                vector.setflags(write=False)
+                self._query_embedding_cache.put(normalized_queries[i], vector)
+                vectors[i] = vector
+        return np.vstack(vectors)
+
+    def _load_documents(self, hits_per_query: List[Tuple[Tuple[int, float], ...]]
+                        ) -> List[List[Tuple[Document, float]]]:
+        # Из хранилища одним запросом читаются только найденные чанки
+        chunks = self.chunk_store.get(list({index_id for hits in hits_per_query for index_id, _ in hits}))
+        return [[(Document(page_content=chunks[index_id][0], metadata=dict(chunks[index_id][1])), score)
+                 for index_id, score in hits if index_id in chunks] for hits in hits_per_query]
+
+    def get_cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Заполненность и доля попаданий кэшей поиска (для статуса и мониторинга)."""
+        return {'query_embeddings': self._query_embedding_cache.stats(),
+                'search_results': self._search_result_cache.stats()}
+
+    def get_indexed_sources(self, offset: int = 0, limit: int | None = None, order_by: str = 'ingested_at',
+                            descending: bool = False) -> List[Dict[str, Any]]:
+        """
+        Возвращает страницу каталога источников базы знаний.
+        Каталог хранится отдельно от чанков, поэтому запрос не зависит от их числа.
+        :param order_by: Поле сортировки: name, chunk_count, byte_size или ingested_at.
+        """
+        sources = self.chunk_store.list_sources(offset=offset, limit=limit, order_by=order_by, descending=descending)
+        for source in sources:
+            source['source'] = source['source'] or 'Неизвестное имя файла'
+        return sources
+
+    def count_indexed_sources(self) -> int:
+        return self.chunk_store.count_sources()
+
+    def find_source(self, keys: List[str]) -> str | None:
+        """Ищет уже загруженный источник по ключам исходного файла (хеш содержимого, id файла в Telegram/Drive)."""
+        return self.chunk_store.find_source(keys)
 
-        sources = {}
-        for doc_id in self.vector_store.docstore._dict:
-            metadata = self.vector_store.docstore._dict[doc_id].metadata
-            source_id = metadata.get('source_id')
-            if source_id and source_id not in sources:
-                sources[source_id] = {
-                    'source_id': source_id,
-                    'source': metadata.get('source', 'Неизвестное имя файла')
-                }
+    def add_source_keys(self, source_id: str, keys: List[str]):
+        self.chunk_store.add_source_keys(source_id, keys)
 
-        return list(sources.values())
+    def rename_source(self, source_id: str, name: str) -> bool:
+        """Меняет отображаемое имя источника без повторной индексации."""
+        with self._lock:
+            renamed = self.chunk_store.rename_source(source_id, name)
+            if renamed:
+                # Новая версия сбрасывает закэшированные результаты поиска со старым именем
+                self._publish()
+        return renamed
 
-# END OF FILE knowledge_base_service.py #
\ No newline at end of file
+# END OF FILE knowledge_base_service.py #
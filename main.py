@@ -4,6 +4,7 @@ import logging
 import asyncio
 import os
 import sys
+from functools import partial
 from telegram import Update, BotCommandScopeAllPrivateChats
 from telegram.ext import (
     Application,
@@ -25,7 +26,7 @@ from handlers import (
     handle_kb_callback, reset_chat, reset_chat_confirm, reset_chat_cancel,
     knowledge_base_menu, handle_text_or_voice, settings_and_status_command,
     upload_file_start, set_global_services, stop_llm_generation,
-    handle_telegram_document_upload
+    handle_telegram_document_upload, jobs_command, run_ingestion_job
 )
 
 from settings_service import (
@@ -37,7 +38,8 @@ from handlers import RESET_CHAT_CONFIRM, AWAITING_AUTH_CODE
 
 from google_drive_service import GoogleDriveService
 from file_parser_service import FileParserService
-from knowledge_base_service import KnowledgeBaseService
+from ingestion_queue import IngestionQueue
+from knowledge_base_manager import KnowledgeBaseManager
 from generative_ai_service import GenerativeAIServiceFactory
 from speech_to_text_service import get_stt_service
 from external_knowledge_service import ExternalKnowledgeService
@@ -48,6 +50,9 @@ logging.basicConfig(format=LOG_FORMAT, level=LOG_LEVEL,
 logger = logging.getLogger(__name__)
 
 settings_service_instance = None
+ingestion_queue_instance = None
+parser_service_instance = None
+kb_service_instance = None
 
 
 async def post_init(application: Application) -> None:
@@ -56,6 +61,7 @@ async def post_init(application: Application) -> None:
         ("upload", "📚 Загрузить с Google Drive"),
         ("upload_from_pc", "📥 Загрузить с ПК/телефона"),
         ("kb", "📂 Управление Базой Знаний"),
+        ("jobs", "📥 Ход загрузки файлов"),
         ("reset_chat", "🔄 Сбросить диалог"),
         ("status", "⚙️ Настройки и Статус"),
         ("connect_google_drive", "🔗 Подключить Google Drive"),
@@ -65,6 +71,17 @@ async def post_init(application: Application) -> None:
     ]
     await application.bot.set_my_commands(commands, scope=BotCommandScopeAllPrivateChats())
     logger.info("Команды меню Telegram успешно установлены.")
+    # Очередь загрузки работает в цикле событий бота; незавершенные до перезапуска задачи продолжаются
+    await ingestion_queue_instance.start(partial(run_ingestion_job, application.bot))
+
+
+async def post_shutdown(application: Application) -> None:
+    # Порядок важен: сначала дожидаемся шагов загрузки, которые еще пишут в коллекции,
+    # затем закрываем коллекции и только потом пул векторизации
+    await ingestion_queue_instance.stop()
+    ingestion_queue_instance.close()
+    parser_service_instance.close()
+    kb_service_instance.close()
 
 
 async def restart_command(update: Update, context: CallbackContext) -> None:
@@ -79,20 +96,23 @@ async def restart_command(update: Update, context: CallbackContext) -> None:
 def main() -> None:
     logger.info("Инициализация приложения...")
     if not TELEGRAM_BOT_TOKEN: logger.critical("TELEGRAM_BOT_TOKEN не найден."); sys.exit(1)
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).post_shutdown(
+        post_shutdown).build()
 
     drive_service = GoogleDriveService()
-    parser_service = FileParserService()
-    kb_service = KnowledgeBaseService()
+    global parser_service_instance, kb_service_instance
+    parser_service = parser_service_instance = FileParserService()
+    kb_service = kb_service_instance = KnowledgeBaseManager()
     ai_service = GenerativeAIServiceFactory.get_service()
     stt_service = get_stt_service()
     ext_knowledge_service = ExternalKnowledgeService()
     status_service = StatusService(drive_service, ai_service, stt_service, ext_knowledge_service, kb_service)
-    global settings_service_instance
+    global settings_service_instance, ingestion_queue_instance
     settings_service_instance = SettingsService()
+    ingestion_queue_instance = IngestionQueue()
 
     set_global_services(drive_service, parser_service, kb_service, ai_service, stt_service, ext_knowledge_service,
-                        status_service, settings_service_instance)
+                        status_service, settings_service_instance, ingestion_queue_instance)
 
     settings_handler = ConversationHandler(
         entry_points=[
@@ -151,6 +171,7 @@ def main() -> None:
     application.add_handler(CommandHandler("upload", upload_file_start))
     application.add_handler(MessageHandler(filters.Regex("^📂 Управление Базой Знаний$"), knowledge_base_menu))
     application.add_handler(CommandHandler("kb", knowledge_base_menu))
+    application.add_handler(CommandHandler("jobs", jobs_command))
     application.add_handler(MessageHandler(filters.Regex("^📥 Загрузить файл с ПК/телефона$"),
                                            lambda u, c: u.message.reply_text(
                                                "Просто отправьте мне файл (PDF, DOCX, TXT), который вы хотите добавить в базу знаний.")))
@@ -0,0 +1,48 @@
+# START OF FILE micro_batcher.py #
+
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Tuple
+
+
+class MicroBatcher:
+    """
+    Склеивает вызовы из разных потоков, пришедшие в пределах короткого окна, в один пакетный вызов.
+    Первый вызов в окне становится ведущим: ждет окно (или пока пакет не заполнится), забирает
+    накопившиеся запросы, выполняет handler для всех сразу и раздает результаты остальным.
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], List[Any]], window_seconds: float, max_batch_size: int = 32):
+        """
+        :param handler: Функция, принимающая список запросов и возвращающая список результатов в том же порядке.
+        """
+        self._handler = handler
+        self._window_seconds = window_seconds
+        self._max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[Any, Future]] = []
+        self._batch_full = threading.Event()
+
+    def submit(self, item: Any) -> Any:
+        """Выполняет запрос в составе ближайшего пакета и возвращает его результат (блокирующий вызов)."""
+        future: Future = Future()
+        with self._lock:
+            self._pending.append((item, future))
+            is_leader = len(self._pending) == 1
+            if len(self._pending) >= self._max_batch_size:
+                self._batch_full.set()
+        if is_leader:
+            self._batch_full.wait(self._window_seconds)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._batch_full.clear()
+            try:
+                results = self._handler([pending_item for pending_item, _ in batch])
+                for (_, pending_future), result in zip(batch, results):
+                    pending_future.set_result(result)
+            except Exception as e:
+                for _, pending_future in batch:
+                    pending_future.set_exception(e)
+        return future.result()
+
+# END OF FILE micro_batcher.py #
@@ -0,0 +1,61 @@
+# START OF FILE near_duplicates.py #
+
+import hashlib
+import re
+from typing import Set, Tuple
+
+import numpy as np
+
+# Почти дубликаты: отпечатки SimHash отличаются не более чем в MAX_DISTANCE битах из 64,
+# а доля общих шинглов (коэффициент Жаккара) не меньше MIN_SIMILARITY
+MAX_DISTANCE = 3
+MIN_SIMILARITY = 0.9
+# 64 бита делятся на BANDS полос по 16 бит. Если отпечатки различаются не более чем в 3 битах,
+# хотя бы одна полоса у них совпадает целиком, поэтому кандидатов можно искать по точному равенству полос
+BANDS = 4
+_BAND_BITS = 64 // BANDS
+_SHINGLE_SIZE = 3
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def shingles(text: str) -> Set[str]:
+    """Шинглы - последовательности из трех соседних слов (без учета регистра и пунктуации)."""
+    tokens = _TOKEN_RE.findall(text.lower())
+    if len(tokens) <= _SHINGLE_SIZE:
+        return {' '.join(tokens)} if tokens else set()
+    return {' '.join(tokens[i:i + _SHINGLE_SIZE]) for i in range(len(tokens) - _SHINGLE_SIZE + 1)}
+
+
+def simhash(text: str) -> int | None:
+    """
+    64-битный отпечаток SimHash по шинглам текста: у похожих текстов отличается в немногих битах.
+    :return: Отпечаток как знаковое int64 (так его хранит SQLite) или None для текста без слов.
+    """
+    text_shingles = shingles(text)
+    if not text_shingles:
+        return None
+    hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little')
+                       for s in text_shingles], dtype=np.uint64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    # Бит отпечатка равен 1, если у большинства шинглов этот бит равен 1
+    fingerprint = np.packbits(bits.sum(axis=0) * 2 > len(hashes), bitorder='little').view(np.uint64)[0]
+    return int(fingerprint.view(np.int64))
+
+
+def bands(fingerprint: int) -> Tuple[int, ...]:
+    unsigned = fingerprint & 0xFFFFFFFFFFFFFFFF
+    return tuple((unsigned >> (i * _BAND_BITS)) & ((1 << _BAND_BITS) - 1) for i in range(BANDS))
+
+
+def distance(first: int, second: int) -> int:
+    """Расстояние Хэмминга между отпечатками."""
+    return ((first ^ second) & 0xFFFFFFFFFFFFFFFF).bit_count()
+
+
+def similarity(first: Set[str], second: Set[str]) -> float:
+    """Коэффициент Жаккара двух наборов шинглов."""
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+# END OF FILE near_duplicates.py #
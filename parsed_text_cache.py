@@ -0,0 +1,170 @@
+# START OF FILE parsed_text_cache.py #
+
+import os
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+from typing import Iterable, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+# Сколько блоков читается из кэша за один запрос
+_READ_BATCH = 32
+
+
+class ParsedTextCache:
+    """
+    Дисковый кэш извлеченного из файлов текста. Текст хранится блоками (страницы PDF, абзацы DOCX),
+    каждый сжат zlib, поэтому границы страниц сохраняются. Документ адресуется ключами файла
+    (как в ChunkStore.find_source: sha256:/md5: содержимого, telegram:<file_unique_id>) вместе
+    с версией парсера: после изменения разбора старые записи просто перестают находиться и вытесняются.
+    Объем ограничен `max_size_mb`; при переполнении вытесняются давно не использованные документы (LRU).
+    """
+
+    def __init__(self, db_path: str, parser_version: int, max_size_mb: int):
+        self.parser_version = parser_version
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents (doc_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "complete INTEGER NOT NULL DEFAULT 0, blocks INTEGER NOT NULL DEFAULT 0, "
+                "size_bytes INTEGER NOT NULL DEFAULT 0, last_used REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_last_used ON documents(last_used)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (doc_id INTEGER NOT NULL, position INTEGER NOT NULL, "
+                "data BLOB NOT NULL, PRIMARY KEY (doc_id, position)) WITHOUT ROWID")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS document_keys (key TEXT PRIMARY KEY, doc_id INTEGER NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_document_keys_doc_id ON document_keys(doc_id)")
+            # Документы, запись которых прервалась (остановка бота посреди разбора), не годятся
+            for (doc_id,) in self._conn.execute("SELECT doc_id FROM documents WHERE complete = 0").fetchall():
+                self._delete_document(doc_id)
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM documents").fetchone()[0]
+
+    def _key(self, key: str) -> str:
+        return f"v{self.parser_version}:{key}"
+
+    def find(self, keys: List[str]) -> List[str] | None:
+        """
+        Ищет разобранный документ по любому из ключей файла и запоминает за ним остальные ключи.
+        :return: Все ключи найденного документа или None, если текста в кэше нет.
+        """
+        if not keys:
+            return None
+        prefixed = [self._key(key) for key in keys]
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                f"SELECT k.doc_id FROM document_keys k JOIN documents d ON d.doc_id = k.doc_id "
+                f"WHERE d.complete = 1 AND k.key IN ({','.join('?' * len(prefixed))}) LIMIT 1", prefixed).fetchone()
+            if row is None:
+                return None
+            doc_id = row[0]
+            self._conn.executemany("INSERT OR IGNORE INTO document_keys (key, doc_id) VALUES (?, ?)",
+                                   [(key, doc_id) for key in prefixed])
+            self._conn.execute("UPDATE documents SET last_used = ? WHERE doc_id = ?", (time.time(), doc_id))
+            stored = [key for (key,) in self._conn.execute(
+                "SELECT key FROM document_keys WHERE doc_id = ? ORDER BY key", (doc_id,))]
+        prefix_length = len(self._key(''))
+        return [key[prefix_length:] for key in stored]
+
+    def iter_blocks(self, keys: List[str]) -> Iterator[str] | None:
+        """
+        Блоки текста документа, найденного по ключам, в исходном порядке. Блоки читаются порциями
+        по мере потребления, а не все сразу.
+        :return: Итератор блоков или None, если текста в кэше нет.
+        """
+        if not self.find(keys):
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT d.doc_id, d.blocks FROM document_keys k JOIN documents d "
+                                     "ON d.doc_id = k.doc_id WHERE k.key = ?", (self._key(keys[0]),)).fetchone()
+        if row is None:
+            return None
+        return self._read_blocks(*row)
+
+    def _read_blocks(self, doc_id: int, block_count: int) -> Iterator[str]:
+        for start in range(0, block_count, _READ_BATCH):
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT data FROM blocks WHERE doc_id = ? AND position >= ? AND position < ? ORDER BY position",
+                    (doc_id, start, start + _READ_BATCH)).fetchall()
+            if len(rows) != min(_READ_BATCH, block_count - start):
+                # Документ вытеснили, пока его читали: отдать обрезанный текст нельзя
+                raise RuntimeError("Разобранный текст файла был вытеснен из кэша во время чтения.")
+            for (data,) in rows:
+                yield zlib.decompress(data).decode('utf-8')
+
+    def store(self, keys: List[str], blocks: Iterable[str]) -> Iterator[str]:
+        """
+        Пропускает блоки разбираемого документа, по пути сохраняя их в кэш. Документ становится
+        доступен только после того, как блоки прочитаны до конца; при ошибке разбора или прерванном
+        чтении сохраненная часть удаляется.
+        """
+        with self._lock, self._conn:
+            doc_id = self._conn.execute("INSERT INTO documents (last_used) VALUES (?)", (time.time(),)).lastrowid
+        position = size = 0
+        finished = False
+        try:
+            for block in blocks:
+                data = zlib.compress(block.encode('utf-8'), 6)
+                with self._lock, self._conn:
+                    self._conn.execute("INSERT INTO blocks (doc_id, position, data) VALUES (?, ?, ?)",
+                                       (doc_id, position, data))
+                position += 1
+                size += len(data)
+                yield block
+            finished = True
+        finally:
+            with self._lock, self._conn:
+                if not finished or size > self.max_size_bytes:
+                    self._delete_document(doc_id)
+                else:
+                    self._conn.execute("UPDATE documents SET complete = 1, blocks = ?, size_bytes = ?, last_used = ? "
+                                       "WHERE doc_id = ?", (position, size, time.time(), doc_id))
+                    # Ключи переходят к новому документу: прежняя запись с тем же ключом больше не нужна
+                    self._conn.executemany("INSERT OR REPLACE INTO document_keys (key, doc_id) VALUES (?, ?)",
+                                           [(self._key(key), doc_id) for key in keys])
+                    self._size_bytes += size
+                    self._delete_unreferenced()
+                    if self._size_bytes > self.max_size_bytes:
+                        self._evict()
+
+    def _delete_document(self, doc_id: int):
+        self._conn.execute("DELETE FROM blocks WHERE doc_id = ?", (doc_id,))
+        self._conn.execute("DELETE FROM document_keys WHERE doc_id = ?", (doc_id,))
+        self._conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+
+    def _delete_unreferenced(self):
+        rows = self._conn.execute(
+            "SELECT doc_id, size_bytes FROM documents WHERE complete = 1 AND doc_id NOT IN "
+            "(SELECT doc_id FROM document_keys)").fetchall()
+        for doc_id, size_bytes in rows:
+            self._delete_document(doc_id)
+            self._size_bytes -= size_bytes
+
+    def _evict(self):
+        # Освобождаем с запасом (до 90% лимита), чтобы не вытеснять по документу на каждую запись
+        target = int(self.max_size_bytes * 0.9)
+        rows = self._conn.execute(
+            "SELECT doc_id, size_bytes FROM documents WHERE complete = 1 ORDER BY last_used").fetchall()
+        evicted = 0
+        for doc_id, size_bytes in rows:
+            if self._size_bytes <= target:
+                break
+            self._delete_document(doc_id)
+            self._size_bytes -= size_bytes
+            evicted += 1
+        logger.info(f"Кэш разобранного текста переполнен: вытеснено документов: {evicted}.")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# END OF FILE parsed_text_cache.py #
@@ -0,0 +1,207 @@
+# START OF FILE parser_sandbox.py #
+
+import signal
+import logging
+import weakref
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+
+try:
+    import resource
+except ImportError:  # Windows: лимиты ресурсов недоступны, остаются только таймауты
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Процессорное время на задачу; задается при запуске процесса песочницы
+_cpu_limit_seconds = 0
+# Сколько процесс зависшего пула ждет завершения по SIGTERM, прежде чем его убьют
+_KILL_GRACE_SECONDS = 5
+
+
+class ParseLimitExceeded(BaseException):
+    """
+    Разбор файла превысил лимит времени или процессорного времени и был прерван.
+    Наследуется от BaseException, чтобы его не перехватили обработчики `except Exception` внутри парсеров.
+    """
+
+
+def _raise_cpu_limit(signum, frame):
+    raise ParseLimitExceeded("Превышен лимит процессорного времени на разбор файла.")
+
+
+def _raise_timeout(signum, frame):
+    raise ParseLimitExceeded("Превышено время разбора файла.")
+
+
+def _init_worker(memory_limit_mb: int, cpu_limit_seconds: int, max_tasks: int):
+    """
+    Выполняется при запуске процесса песочницы: ограничивает адресное пространство процесса
+    и его суммарное процессорное время. Мягкий лимит CPU выставляется на каждую задачу (см. run_limited),
+    жесткий - на все задачи процесса до его замены, с запасом: его достижение завершает процесс.
+    """
+    global _cpu_limit_seconds
+    _cpu_limit_seconds = cpu_limit_seconds
+    if resource is None:
+        return
+    if memory_limit_mb > 0:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if cpu_limit_seconds > 0:
+        hard = cpu_limit_seconds * (max(max_tasks, 1) + 1) if max_tasks > 0 else resource.RLIM_INFINITY
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        signal.signal(signal.SIGXCPU, _raise_cpu_limit)
+
+
+def run_limited(timeout: float, func: Callable, *args) -> Any:
+    """
+    Выполняется в процессе песочницы: вызывает func с лимитом процессорного времени на задачу
+    и таймером (SIGALRM) на timeout секунд (0 - без таймера, если func ставит свои таймеры).
+    """
+    use_cpu_limit = resource is not None and _cpu_limit_seconds > 0
+    if use_cpu_limit:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = int(usage.ru_utime + usage.ru_stime) + _cpu_limit_seconds
+        resource.setrlimit(resource.RLIMIT_CPU, (min(soft, hard) if hard != resource.RLIM_INFINITY else soft, hard))
+    use_alarm = timeout > 0 and hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if use_cpu_limit:
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+class ParserSandbox:
+    """
+    Пул процессов для разбора файлов. Поврежденный или специально подготовленный файл может заставить
+    парсер бесконечно работать или занять всю память; в отдельном процессе это ограничено лимитами
+    памяти (RLIMIT_AS), процессорного времени (RLIMIT_CPU) и таймаутом, а бот при этом не теряет
+    ни GIL, ни потоки. Процесс заменяется новым после `max_tasks` задач, чтобы память, набранная
+    парсером, не копилась. Процессы запускаются при первой задаче.
+    """
+
+    def __init__(self, workers: int, memory_limit_mb: int, cpu_limit_seconds: int, timeout_seconds: float,
+                 max_tasks: int):
+        self.workers = workers
+        self.memory_limit_mb = memory_limit_mb
+        self.cpu_limit_seconds = cpu_limit_seconds
+        self.timeout_seconds = timeout_seconds
+        self.max_tasks = max_tasks
+        self._pool: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+        self._future_pools: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def submit(self, func: Callable, *args, timeout: float | None = None) -> Future:
+        """
+        Ставит func(*args) в пул. func и аргументы должны сериализоваться (функция уровня модуля).
+        :param timeout: Таймер задачи в процессе; по умолчанию timeout_seconds, 0 - без таймера.
+        """
+        timeout = self.timeout_seconds if timeout is None else timeout
+        pool = self._get_pool()
+        try:
+            future = pool.submit(run_limited, timeout, func, *args)
+        except BrokenProcessPool:
+            # Процесс пула был убит лимитом памяти или CPU - пул больше не принимает задачи
+            self._reset(pool)
+            pool = self._get_pool()
+            future = pool.submit(run_limited, timeout, func, *args)
+        # Пул запоминается за задачей: если она зависнет, заменить нужно именно его
+        with self._lock:
+            self._future_pools[future] = pool
+        return future
+
+    def result(self, future: Future, timeout: float | None = None) -> Any:
+        """
+        Ждет результат задачи. Процесс, убитый лимитом памяти или процессорного времени, ломает пул;
+        он пересоздается при постановке следующей задачи. Задача, не завершившаяся за timeout секунд,
+        считается зависшей: процессы ее пула завершаются, а новые задачи идут в новый пул.
+        :raises ValueError: Разбор прерван лимитом.
+        :raises TimeoutError: Задача не завершилась за timeout секунд.
+        """
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            with self._lock:
+                pool = self._future_pools.get(future)
+            self._reset(pool)
+            raise
+        except BrokenProcessPool:
+            raise ValueError("Процесс разбора файла аварийно завершился: вероятно, превышен лимит памяти "
+                             "или процессорного времени. Файл может быть поврежден.")
+        except MemoryError:
+            raise ValueError(f"Разбор файла превысил лимит памяти ({self.memory_limit_mb} МБ).")
+        except ParseLimitExceeded as e:
+            raise ValueError(str(e))
+
+    def run(self, func: Callable, *args) -> Any:
+        """Выполняет func(*args) в песочнице и ждет результат не дольше timeout_seconds (с запасом)."""
+        future = self.submit(func, *args)
+        try:
+            return self.result(future, self.wait_timeout(self.timeout_seconds))
+        except TimeoutError:
+            # Таймер в процессе не сработал (процесс занят в C-коде или заблокирован)
+            raise ValueError(f"Разбор файла не завершился за {self.timeout_seconds:.0f} с и был прерван.")
+
+    @staticmethod
+    def wait_timeout(timeout: float) -> float | None:
+        # Ожидание дольше таймера в процессе: сначала должен сработать он
+        return timeout + 30 if timeout > 0 else None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(self.memory_limit_mb, self.cpu_limit_seconds, self.max_tasks),
+                    max_tasks_per_child=self.max_tasks or None)
+                logger.info(f"Песочница разбора файлов запущена: {self.workers} процесс(ов), "
+                            f"лимит памяти {self.memory_limit_mb} МБ.")
+            return self._pool
+
+    def _reset(self, pool: ProcessPoolExecutor | None):
+        # Пул заменяется, только если его еще не заменила другая задача. Зависший процесс сам не завершится
+        # (разбор, ждущий без нагрузки на CPU, не достигает RLIMIT_CPU), поэтому процессы старого пула
+        # завершаются принудительно; задачи других файлов в нем прерываются ошибкой
+        with self._lock:
+            if pool is not None and self._pool is pool:
+                _shutdown_in_background(self._pool, cancel_futures=False, kill=True)
+                self._pool = None
+                logger.warning("Песочница разбора файлов перезапущена.")
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                _shutdown_in_background(self._pool, cancel_futures=True)
+                self._pool = None
+
+
+def _shutdown_in_background(pool: ProcessPoolExecutor, cancel_futures: bool, kill: bool = False):
+    # shutdown(wait=False) в Python 3.11 гонится с заменой процессов (max_tasks_per_child): поток управления
+    # пулом может запустить замену уже после закрытия пула. Поэтому пул закрывается с ожиданием,
+    # но в отдельном потоке, чтобы не ждать зависший процесс
+    def shutdown():
+        if kill:
+            processes = list((pool._processes or {}).values())
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join(_KILL_GRACE_SECONDS)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+        pool.shutdown(wait=True, cancel_futures=cancel_futures)
+
+    threading.Thread(target=shutdown, name='parser-sandbox-shutdown', daemon=True).start()
+
+# END OF FILE parser_sandbox.py #
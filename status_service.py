@@ -1,10 +1,12 @@
 # START OF FILE status_service.py #
 
+import asyncio
 import logging
 import os
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, \
     InlineKeyboardMarkup  # Добавлены InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext
+from knowledge_base_manager import collection_name_for
 from config import (
     TEXT_AI_PROVIDER,
     VOICE_AI_PROVIDER,  # Добавлен импорт VOICE_AI_PROVIDER
@@ -42,8 +44,15 @@ class StatusService:
 
         # Детализация статуса Базы Знаний
         kb_docs_count = 0
-        if self.kb_service and self.kb_service.source_id_to_faiss_ids_map:
-            kb_docs_count = len(self.kb_service.source_id_to_faiss_ids_map)
+        search_cache_text = ""
+        if self.kb_service:
+            collection = collection_name_for(user.id, update.effective_chat.id)
+            # Обращение к коллекции может загрузить ее с диска - это делается вне цикла событий
+            kb_docs_count = await asyncio.to_thread(self.kb_service.count_indexed_sources, collection=collection)
+            cache_stats = await asyncio.to_thread(self.kb_service.get_cache_stats)
+            search_cache_text = (f"⚡ <b>Кэш поиска:</b> эмбеддинги запросов "
+                                 f"{cache_stats['query_embeddings']['hit_rate']:.0%}, "
+                                 f"результаты {cache_stats['search_results']['hit_rate']:.0%} попаданий\n")
 
         kb_status_text = "Пуста"
         if kb_docs_count > 0:
@@ -60,7 +69,8 @@ class StatusService:
             f"🎤 <b>AI-голос:</b> {VOICE_AI_PROVIDER or 'не настроен'} {voice_status_icon}\n"
             f"🌐 <b>Поиск в интернете:</b> {'Включен' if web_search_status_icon == '✅' else 'Выключен'} {web_search_status_icon}\n"
             f"📂 <b>Google Drive:</b> {'Подключен' if drive_status_icon == '✅' else 'Не подключен'} {drive_status_icon}\n"
-            f"🧠 <b>База знаний:</b> {kb_status_text} {kb_status_icon}\n\n"
+            f"🧠 <b>База знаний:</b> {kb_status_text} {kb_status_icon}\n"
+            f"{search_cache_text}\n"
             f"💾 <b>Файл client_secret.json:</b> {'Найден' if os.path.exists(GOOGLE_DRIVE_CREDENTIALS_PATH) else 'Отсутствует'}\n\n"
             "💡 Используйте кнопки ниже для навигации или <b>'⚙️ Перейти к настройкам'</b> для детальной настройки."
         )
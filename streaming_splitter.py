@@ -0,0 +1,55 @@
+# START OF FILE streaming_splitter.py #
+
+from itertools import islice
+from typing import Iterable, Iterator, List, TypeVar
+
+from langchain.text_splitter import TextSplitter
+
+T = TypeVar('T')
+
+# Сколько символов копится перед очередным разбиением: несколько чанков, чтобы сплиттер
+# выбирал границы так же, как на цельном тексте
+DEFAULT_BUFFER_CHARS = 16000
+
+
+def iter_chunks(text_splitter: TextSplitter, blocks: Iterable[str], buffer_chars: int = DEFAULT_BUFFER_CHARS,
+                separator: str = "\n") -> Iterator[str]:
+    """
+    Разбивает поток блоков текста (страниц, абзацев) на чанки, не собирая документ целиком.
+    Блоки копятся в буфере; когда он превышает buffer_chars, буфер разбивается сплиттером и все чанки,
+    кроме последнего, отдаются. Последний чанк начинает следующий буфер, поэтому перекрытие соседних
+    чанков сохраняется и на границах блоков.
+    :param separator: Чем соединяются соседние блоки (как при "\\n".join всего документа).
+    """
+    # Части буфера соединяются только перед разбиением, иначе каждый блок копировал бы весь буфер
+    parts: List[str] = []
+    length = 0
+    for block in blocks:
+        parts.append(block)
+        length += len(block) + len(separator)
+        if length < buffer_chars:
+            continue
+        buffer = separator.join(parts)
+        chunks = text_splitter.split_text(buffer)
+        if len(chunks) >= 2:
+            yield from chunks[:-1]
+            buffer = buffer[buffer.rfind(chunks[-1]):]
+        parts, length = [buffer], len(buffer)
+    buffer = separator.join(parts)
+    if buffer:
+        yield from text_splitter.split_text(buffer)
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Группирует поток в списки по size элементов. Следующий список читается до выдачи текущего,
+    поэтому к выдаче последнего списка поток уже исчерпан.
+    """
+    iterator = iter(items)
+    batch = list(islice(iterator, size))
+    while batch:
+        next_batch = list(islice(iterator, size))
+        yield batch
+        batch = next_batch
+
+# END OF FILE streaming_splitter.py #
@@ -0,0 +1,160 @@
+# START OF FILE tests/test_chunk_store.py #
+
+import json
+import sqlite3
+from chunk_store import ChunkStore
+
+
+def test_source_metadata_is_stored_once_and_removed_with_last_chunk(tmp_path):
+    """
+    Проверяет, что чанки одного источника делят одну запись метаданных,
+    а после удаления последнего чанка источник пропадает из списка.
+    """
+    # 1. Подготовка
+    store = ChunkStore(str(tmp_path / "chunks.sqlite3"))
+    metadata = {"source": "doc.txt", "source_id": "doc"}
+    store.add([0, 1], ["a", "b"], ["первый чанк", "второй чанк"], metadata)
+    store.add([2], ["c"], ["третий чанк"], metadata)
+
+    # 2. Действие
+    found = store.get([2, 0, 99])
+    metadata_rows = store._conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+    store.delete([0, 1, 2])
+
+    # 3. Проверка
+    assert found == {0: ("первый чанк", metadata), 2: ("третий чанк", metadata)}
+    assert metadata_rows == 1
+    assert store.list_sources() == [] and store.count_sources() == 0
+    assert not store.has_source("doc")
+
+
+def test_first_format_store_is_migrated(tmp_path):
+    """Проверяет, что хранилище первой версии (метаданные в каждом чанке) переводится на текущую схему."""
+    # 1. Подготовка
+    db_path = str(tmp_path / "chunks.sqlite3")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE chunks (index_id INTEGER PRIMARY KEY, doc_id TEXT NOT NULL UNIQUE, "
+                 "source_id TEXT, text TEXT NOT NULL, metadata TEXT NOT NULL)")
+    body = json.dumps({"source_id": "doc", "source": "doc.txt"}, ensure_ascii=False)
+    conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?)",
+                     [(0, "a", "doc", "первый чанк", body), (1, "b", "doc", "второй чанк", body)])
+    conn.commit()
+    conn.close()
+
+    # 2. Действие
+    store = ChunkStore(db_path)
+
+    # 3. Проверка
+    assert store.get([1]) == {1: ("второй чанк", {"source_id": "doc", "source": "doc.txt"})}
+    assert sorted(store.index_ids_for_source("doc")) == [0, 1]
+    assert store.index_ids_for(["b"]) == {"b": 1}
+    assert store.list_sources() == [{'source_id': "doc", 'source': "doc.txt", 'chunk_count': 2, 'byte_size': None,
+                                     'ingested_at': None, 'content_hash': None}]
+    assert store.lexical_search("второй", limit=5) == [1]
+
+
+def test_source_catalog_tracks_chunks_and_pages_sorted(tmp_path):
+    """
+    Проверяет, что каталог источников считает чанки при добавлении, повторной записи и удалении,
+    и отдает отсортированные страницы.
+    """
+    # 1. Подготовка
+    store = ChunkStore(str(tmp_path / "chunks.sqlite3"))
+    for i, name in enumerate(["b.txt", "c.txt", "a.txt"]):
+        metadata = {"source": name, "source_id": f"s{i}"}
+        store.add([i * 10, i * 10 + 1], [f"{i}a", f"{i}b"], ["x", "y"], metadata,
+                  byte_size=100 * (i + 1), ingested_at=1000.0 + i, content_hash=f"hash{i}")
+    # Повторная запись тех же чанков (воспроизведение журнала) не меняет счетчики
+    store.add([0, 1], ["0a", "0b"], ["x", "y"], {"source": "b.txt", "source_id": "s0"}, byte_size=100)
+
+    # 2. Действие
+    store.delete([21])
+    newest_first = store.list_sources(limit=2, descending=True)
+    by_name = store.list_sources(offset=1, order_by='name')
+
+    # 3. Проверка
+    assert store.count_sources() == 3
+    assert [s['source_id'] for s in newest_first] == ["s2", "s1"]
+    assert newest_first[0] == {'source_id': "s2", 'source': "a.txt", 'chunk_count': 1, 'byte_size': 300,
+                               'ingested_at': 1002.0, 'content_hash': "hash2"}
+    assert [s['source'] for s in by_name] == ["b.txt", "c.txt"]
+    assert store.get_source("s0")['chunk_count'] == 2
+
+def test_lexical_search_ranks_by_bm25_and_follows_deletes(tmp_path):
+    """
+    Проверяет, что полнотекстовый индекс находит чанки по точным кодам и словам без учета регистра,
+    ставит выше чанки с большим числом слов запроса и забывает удаленные чанки.
+    """
+    # 1. Подготовка
+    store = ChunkStore(str(tmp_path / "chunks.sqlite3"))
+    metadata = {"source": "price.txt", "source_id": "price"}
+    store.add([0, 1, 2], ["a", "b", "c"],
+              ["Артикул XK-4471: кабель питания", "Кабель HDMI, артикул XK-9000", "Скидка на мониторы"], metadata)
+
+    # 2. Действие
+    by_code = store.lexical_search("xk-4471", limit=5)
+    by_words = store.lexical_search("КАБЕЛЬ питания", limit=5)
+    store.delete([0])
+    after_delete = store.lexical_search("кабель", limit=5)
+
+    # 3. Проверка
+    assert by_code[0] == 0
+    assert by_words == [0, 1]
+    assert after_delete == [1]
+    assert store.lexical_search("!!!", limit=5) == []
+    # Слишком частое слово не участвует в поиске
+    assert store.lexical_search("кабель", limit=5, max_term_chunks=0) == []
+
+def test_near_duplicate_chunk_is_shared_between_sources(tmp_path):
+    """
+    Проверяет, что почти дубликат находится по отпечатку, а общий чанк удаляется
+    только вместе с последним источником, который на него ссылается.
+    """
+    # 1. Подготовка
+    store = ChunkStore(str(tmp_path / "chunks.sqlite3"))
+    text = ("Сотрудник подает заявление на отпуск руководителю не позднее чем за две недели до его начала, "
+            "после чего отдел кадров готовит приказ и знакомит с ним сотрудника под подпись.")
+    store.add([0, 1], ["a", "b"], [text, "Оплата отпуска производится за три дня."],
+              {"source": "a.txt", "source_id": "a"})
+
+    # 2. Действие
+    matches = store.find_near_duplicates([text.replace("Сотрудник", "Работник", 1).upper(), "Совсем другой текст."])
+    gone = store.add_refs([0, 99], {"source": "b.txt", "source_id": "b"})
+    orphans = store.orphaned_by_source("a")
+    store.remove_source("a")
+    store.delete(orphans)
+
+    # 3. Проверка
+    assert matches == [0, None]
+    assert gone == [99]
+    assert orphans == [1]
+    assert store.get([0, 1]) == {0: (text, {"source": "b.txt", "source_id": "b"})}
+    assert [(s['source_id'], s['chunk_count']) for s in store.list_sources()] == [("b", 1)]
+    assert store.index_ids_for_sources(["a"]) == [] and store.index_ids_for_sources(["b"]) == [0]
+
+
+def test_source_is_found_by_file_keys_and_renamed(tmp_path):
+    """
+    Проверяет, что источник находится по ключу исходного файла, переименовывается без повторной записи
+    чанков, а его ключи забываются вместе с ним.
+    """
+    # 1. Подготовка
+    store = ChunkStore(str(tmp_path / "chunks.sqlite3"))
+    store.add([0, 1], ["a", "b"], ["первый чанк", "второй чанк"], {"source": "old.pdf", "source_id": "doc"})
+    store.add_source_keys("doc", ["telegram:AQAD", "sha256:abc"])
+
+    # 2. Действие
+    found = store.find_source(["md5:zzz", "sha256:abc"])
+    renamed = store.rename_source("doc", "new.pdf")
+    chunks = store.get([0, 1])
+    store.delete([0, 1])
+
+    # 3. Проверка
+    assert found == "doc" and renamed
+    assert {metadata["source"] for _, metadata in chunks.values()} == {"new.pdf"}
+    assert store._conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] == 0
+    assert store.find_source(["telegram:AQAD"]) is None
+    assert not store.rename_source("doc", "other.pdf")
+
+
+# END OF FILE tests/test_chunk_store.py #
@@ -0,0 +1,55 @@
+# START OF FILE tests/test_embedding_cache.py #
+
+import numpy as np
+import pytest
+from embedding_cache import EmbeddingCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    """Кэш на 1 МБ во временной папке."""
+    return EmbeddingCache(str(tmp_path / "cache.sqlite3"), "test-model", max_size_mb=1)
+
+
+def test_roundtrip_and_model_isolation(cache, tmp_path):
+    """
+    Проверяет, что сохраненные векторы находятся по тексту,
+    а кэш другой модели их не видит.
+    """
+    # 1. Подготовка
+    vectors = np.array([[1.0, 2.0], [3.0, 4.0]], dtype=np.float32)
+    cache.put_many(["альфа", "бета"], vectors)
+    other_model = EmbeddingCache(str(tmp_path / "cache.sqlite3"), "other-model", max_size_mb=1)
+
+    # 2. Действие
+    found = cache.get_many(["бета", "гамма", "альфа"])
+
+    # 3. Проверка
+    assert set(found) == {0, 2}
+    np.testing.assert_array_equal(found[0], vectors[1])
+    np.testing.assert_array_equal(found[2], vectors[0])
+    assert other_model.get_many(["альфа"]) == {}
+
+
+def test_lru_eviction_keeps_recently_used(cache):
+    """
+    Проверяет, что при превышении лимита вытесняются давно не использованные записи,
+    а недавно прочитанные остаются.
+    """
+    # 1. Подготовка: каждая запись занимает 64 КБ, лимит - 1 МБ
+    vector = np.zeros((1, 16384), dtype=np.float32)
+    cache.put_many(["горячий"], vector)
+    for i in range(10):
+        cache.put_many([f"холодный {i}"], vector)
+    cache.get_many(["горячий"])
+
+    # 2. Действие
+    for i in range(10, 20):
+        cache.put_many([f"холодный {i}"], vector)
+
+    # 3. Проверка
+    assert cache.get_many(["горячий"])
+    assert not cache.get_many(["холодный 0"])
+    assert cache._size_bytes <= cache.max_size_bytes
+
+# END OF FILE tests/test_embedding_cache.py #
@@ -1,16 +1,24 @@
 # START OF FILE tests/test_file_parser_service.py #
 
+import io
 import os
+import time
+import zipfile
 import pytest
-from file_parser_service import FileParserService
+from pypdf import PageObject
+from file_parser_service import FileParserService, _extract_pdf_pages
+from parser_sandbox import ParserSandbox
 
 
 # Фикстура - это функция, которая подготавливает данные для тестов.
 # Pytest автоматически найдет ее и передаст в тесты, которые ее запрашивают.
 @pytest.fixture
-def parser_service():
-    """Возвращает экземпляр FileParserService для каждого теста."""
-    return FileParserService()
+def parser_service(tmp_path, mocker):
+    """Возвращает экземпляр FileParserService для каждого теста (кэш разбора - во временной папке)."""
+    mocker.patch('file_parser_service.PARSED_TEXT_CACHE_PATH', str(tmp_path / 'parsed_text_cache.sqlite3'))
+    service = FileParserService()
+    yield service
+    service.close()
 
 
 # Тестовая функция должна начинаться с "test_"
@@ -63,4 +71,333 @@ def test_unsupported_file_type(parser_service, tmp_path):
     # 3. Проверка
     assert result is None
 
+
+def test_txt_is_read_in_blocks(parser_service, tmp_path, mocker):
+    """
+    Проверяет, что TXT файл отдается несколькими блоками, которые через перевод строки
+    складываются в исходный текст.
+    """
+    # 1. Подготовка
+    mocker.patch('file_parser_service._TXT_BLOCK_CHARS', 20)
+    test_content = "".join(f"Строка номер {i}\n" for i in range(10))
+    file_path = tmp_path / "long.txt"
+    file_path.write_text(test_content, encoding='utf-8')
+
+    # 2. Действие
+    blocks = list(parser_service.iter_text_blocks(str(file_path)))
+
+    # 3. Проверка
+    assert len(blocks) > 1
+    assert "\n".join(blocks) == test_content
+
+
+def _write_pdf(path, page_texts):
+    """Собирает минимальный PDF, в котором каждая страница содержит одну строку текста."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in page_texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    data, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{body}\nendobj\n".encode('latin-1')
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('latin-1')
+    data += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode('latin-1')
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode('latin-1')
+    path.write_bytes(data)
+
+
+def _use_sandbox(parser_service, workers):
+    """Заменяет песочницу сервиса: workers процессов без лимитов памяти и CPU (0 - разбор в текущем потоке)."""
+    parser_service.sandbox = ParserSandbox(workers, 0, 0, 60, 0) if workers else None
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_pdf_pages_are_parsed_in_pool_in_order(parser_service, tmp_path, mocker, workers):
+    """
+    Проверяет, что страницы PDF, разобранные диапазонами в пуле процессов, отдаются в исходном
+    порядке, и что без песочницы (PARSER_WORKERS=0) результат тот же.
+    """
+    # 1. Подготовка
+    _use_sandbox(parser_service, workers)
+    mocker.patch('file_parser_service.PDF_PAGES_PER_TASK', 2)
+    page_texts = [f"Page number {i}" for i in range(7)]
+    file_path = tmp_path / "pages.pdf"
+    _write_pdf(file_path, page_texts)
+
+    # 2. Действие
+    try:
+        blocks = list(parser_service.iter_text_blocks(str(file_path)))
+    finally:
+        parser_service.close()
+
+    # 3. Проверка
+    assert [block.strip() for block in blocks] == page_texts
+
+
+def test_hung_pdf_range_is_skipped_and_other_ranges_are_resubmitted(parser_service, tmp_path, mocker):
+    """
+    Проверяет, что диапазон страниц, не вернувшийся за отведенное время, пропускается, а диапазоны,
+    стоявшие в том же пуле (песочница завершает его процессы), ставятся заново и извлекаются.
+    """
+    # 1. Подготовка
+    _use_sandbox(parser_service, 1)
+    mocker.patch('file_parser_service.PDF_PAGES_PER_TASK', 1)
+    file_path = tmp_path / "hung.pdf"
+    _write_pdf(file_path, ["First", "Hung", "Third"])
+    sandbox = parser_service.sandbox
+    original_result = sandbox.result
+    calls = []
+
+    def result(future, timeout=None):
+        calls.append(future)
+        # Первый вызов - подсчет страниц, дальше по диапазону на страницу; зависает страница "Hung"
+        if len(calls) == 3:
+            future.result()
+            sandbox._reset(sandbox._pool)  # Так песочница поступает с пулом зависшей задачи
+            raise TimeoutError()
+        return original_result(future, timeout)
+
+    mocker.patch.object(sandbox, 'result', side_effect=result)
+
+    # 2. Действие
+    try:
+        blocks = list(parser_service.iter_text_blocks(str(file_path)))
+    finally:
+        parser_service.close()
+
+    # 3. Проверка
+    assert [block.strip() for block in blocks] == ["First", "Third"]
+    assert len(calls) == 4
+
+
+def test_pdf_page_over_timeout_is_skipped(tmp_path, mocker):
+    """Проверяет, что страница, разбор которой превысил таймаут, пропускается, а остальные извлекаются."""
+    # 1. Подготовка
+    file_path = tmp_path / "slow.pdf"
+    _write_pdf(file_path, ["First", "Slow", "Third"])
+    original = PageObject.extract_text
+
+    def extract_text(page, *args, **kwargs):
+        text = original(page, *args, **kwargs)
+        if "Slow" in text:
+            time.sleep(5)
+        return text
+
+    mocker.patch.object(PageObject, 'extract_text', extract_text)
+
+    # 2. Действие
+    texts, skipped = _extract_pdf_pages(str(file_path), 0, 3, 0.2)
+
+    # 3. Проверка
+    assert [text.strip() for text in texts] == ["First", "", "Third"]
+    assert skipped == [1]
+
+
+def test_parsed_text_is_reused_by_file_keys(parser_service, tmp_path, mocker):
+    """
+    Проверяет, что текст, полностью разобранный один раз, при повторной загрузке берется из кэша
+    без разбора, в том числе по другому ключу того же файла.
+    """
+    # 1. Подготовка
+    file_path = tmp_path / "cached.pdf"
+    _write_pdf(file_path, ["Cached first", "Cached second"])
+    _use_sandbox(parser_service, 0)
+    first = list(parser_service.iter_text_blocks(str(file_path), cache_keys=["md5:abc", "sha256:def"]))
+    parse = mocker.patch.object(parser_service, '_iter_pdf_pages')
+
+    # 2. Действие
+    again = list(parser_service.iter_text_blocks(str(file_path), cache_keys=["sha256:def"]))
+    keys = parser_service.find_cached_text(["md5:abc", "telegram:u1"])
+
+    # 3. Проверка
+    assert again == first and len(first) == 2
+    parse.assert_not_called()
+    assert sorted(keys) == ["md5:abc", "sha256:def", "telegram:u1"]
+    assert list(parser_service.iter_cached_blocks(["telegram:u1"])) == first
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_file_in_memory_is_parsed_like_file_on_disk(parser_service, tmp_path, mocker, workers):
+    """
+    Проверяет, что содержимое файла в памяти (BytesIO, bytes) разбирается так же, как файл на диске,
+    и дает те же хеши.
+    """
+    # 1. Подготовка
+    _use_sandbox(parser_service, workers)
+    mocker.patch('file_parser_service.PDF_PAGES_PER_TASK', 2)
+    pdf_path = tmp_path / "pages.pdf"
+    _write_pdf(pdf_path, [f"Page number {i}" for i in range(5)])
+    txt_content = "Первая строка.\nВторая строка.\n"
+
+    # 2. Действие
+    from_disk = list(parser_service.iter_text_blocks(str(pdf_path)))
+    buffer = io.BytesIO(pdf_path.read_bytes())
+    digests = parser_service.file_digests(buffer)
+    from_memory = list(parser_service.iter_text_blocks(buffer, file_name="pages.pdf"))
+    txt = parser_service.extract_text(txt_content.encode('utf-8'), file_name="notes.txt")
+
+    # 3. Проверка
+    assert from_memory == from_disk and len(from_disk) == 5
+    assert digests == parser_service.file_digests(str(pdf_path))
+    assert txt == txt_content
+    assert not buffer.closed
+
+
+def test_markdown_is_split_by_headings_without_markup(parser_service, tmp_path):
+    """Проверяет, что Markdown отдается разделами по заголовкам, без разметки, а код остается как есть."""
+    # 1. Подготовка
+    file_path = tmp_path / "notes.md"
+    file_path.write_text("# Введение\nТекст со **ссылкой** на [сайт](https://example.com).\n\n"
+                         "## Код\n```python\n# не заголовок\nx = 1\n```\n", encoding='utf-8')
+
+    # 2. Действие
+    blocks = list(parser_service.iter_text_blocks(str(file_path)))
+
+    # 3. Проверка
+    assert blocks == ["Введение\nТекст со ссылкой на сайт.", "Код\n# не заголовок\nx = 1"]
+
+
+def test_markdown_single_long_line_is_read_in_pieces(parser_service, tmp_path, mocker):
+    """
+    Проверяет, что Markdown из одной огромной строки (без переводов строк) читается кусками
+    и отдается несколькими блоками, а не загружается целиком.
+    """
+    # 1. Подготовка
+    mocker.patch('file_parser_service._TXT_BLOCK_CHARS', 60)
+    words = [f"слово{i}" for i in range(300)]
+    file_path = tmp_path / "flat.md"
+    file_path.write_text(" ".join(words) + " # не заголовок", encoding='utf-8')
+
+    # 2. Действие
+    blocks = list(parser_service.iter_text_blocks(str(file_path)))
+
+    # 3. Проверка
+    assert len(blocks) > 10
+    assert all(len(block) <= 200 for block in blocks)
+    assert "".join(block.replace("\n", "") for block in blocks) == " ".join(words) + " # не заголовок"
+
+
+def test_html_is_parsed_incrementally(parser_service, tmp_path, mocker):
+    """
+    Проверяет, что HTML разбирается порциями и отдается несколькими блоками видимого текста:
+    без скриптов и стилей, с кодировкой из <meta charset>.
+    """
+    # 1. Подготовка
+    mocker.patch('file_parser_service._HTML_READ_BYTES', 64)
+    mocker.patch('file_parser_service._TXT_BLOCK_CHARS', 60)
+    paragraphs = [f"Абзац номер {i} &amp; продолжение" for i in range(10)]
+    html = ('<html><head><meta charset="windows-1251"><title>Отчет</title><style>p {color: red}</style></head>'
+            '<body><script>var x = "<p>скрыто</p>";</script>'
+            + "".join(f"<p>{p}</p>" for p in paragraphs) + "</body></html>")
+    file_path = tmp_path / "report.html"
+    file_path.write_bytes(html.encode('cp1251'))
+
+    # 2. Действие
+    blocks = list(parser_service.iter_text_blocks(str(file_path)))
+
+    # 3. Проверка
+    assert len(blocks) > 1
+    assert "\n".join(blocks).split("\n") == ["Отчет"] + [p.replace("&amp;", "&") for p in paragraphs]
+
+
+def test_html_text_without_block_tags_is_split_into_blocks(parser_service, tmp_path, mocker):
+    """
+    Проверяет, что длинный текст без блочных тегов (один <span>) не копится в одну строку,
+    а отдается несколькими блоками без разрезанных слов.
+    """
+    # 1. Подготовка
+    mocker.patch('file_parser_service._HTML_READ_BYTES', 64)
+    mocker.patch('file_parser_service._TXT_BLOCK_CHARS', 60)
+    words = [f"слово{i}" for i in range(500)]
+    file_path = tmp_path / "flat.html"
+    file_path.write_text(f"<html><body><span>{' '.join(words)}</span></body></html>", encoding='utf-8')
+
+    # 2. Действие
+    blocks = list(parser_service.iter_text_blocks(str(file_path)))
+
+    # 3. Проверка
+    assert len(blocks) > 10
+    assert all(len(block) < 200 for block in blocks)
+    assert " ".join(blocks).split() == words
+
+
+def _write_pptx(path, slides):
+    """Собирает минимальный PPTX: слайды лежат в архиве в обратном порядке относительно показа."""
+    a = 'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"'
+    p = 'xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main"'
+    r = 'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+    count = len(slides)
+    with zipfile.ZipFile(path, 'w') as archive:
+        ids = "".join(f'<p:sldId id="{256 + i}" r:id="rId{i}"/>' for i in range(count))
+        archive.writestr('ppt/presentation.xml',
+                         f'<p:presentation {p} {r}><p:sldIdLst>{ids}</p:sldIdLst></p:presentation>')
+        rels = "".join(f'<Relationship Id="rId{i}" Target="slides/slide{count - i}.xml"/>' for i in range(count))
+        archive.writestr('ppt/_rels/presentation.xml.rels',
+                         f'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                         f'{rels}</Relationships>')
+        for i, paragraphs in enumerate(slides):
+            body = "".join(f'<a:p><a:r><a:t>{text}</a:t></a:r></a:p>' for text in paragraphs)
+            archive.writestr(f'ppt/slides/slide{count - i}.xml', f'<p:sld {a} {p}><p:txBody>{body}</p:txBody></p:sld>')
+
+
+def test_pptx_is_read_slide_by_slide_in_show_order(parser_service, tmp_path):
+    """Проверяет, что PPTX отдается по слайдам в порядке показа, а не в порядке файлов в архиве."""
+    # 1. Подготовка
+    file_path = tmp_path / "deck.pptx"
+    _write_pptx(file_path, [["Титульный слайд", "Подзаголовок"], [], ["Итоги"]])
+
+    # 2. Действие
+    blocks = list(parser_service.iter_text_blocks(str(file_path)))
+
+    # 3. Проверка
+    assert blocks == ["Титульный слайд\nПодзаголовок", "Итоги"]
+
+
+def test_txt_encoding_is_detected_and_decoded_incrementally(parser_service, tmp_path, mocker):
+    """
+    Проверяет, что TXT в cp1251 определяется по фрагментам файла (в том числе когда начало - только ASCII),
+    а UTF-8 с переводами строк \\r\\n декодируется порциями без порчи символов на границах порций.
+    """
+    # 1. Подготовка
+    mocker.patch('file_parser_service._TXT_READ_BYTES', 7)
+    mocker.patch('file_parser_service._TXT_BLOCK_CHARS', 40)
+    mocker.patch('file_parser_service._ENCODING_SAMPLE_BYTES', 100)
+    russian = "".join(f"Строка номер {i}: съешь же ещё этих мягких французских булок.\n" for i in range(20))
+    cp1251_path = tmp_path / "cp1251.txt"
+    cp1251_path.write_bytes(("header line\n" * 30 + russian).encode('cp1251'))
+    utf8_path = tmp_path / "crlf.txt"
+    utf8_path.write_bytes(russian.replace("\n", "\r\n").encode('utf-8'))
+
+    # 2. Действие
+    cp1251_blocks = list(parser_service.iter_text_blocks(str(cp1251_path)))
+    utf8_blocks = list(parser_service.iter_text_blocks(str(utf8_path)))
+
+    # 3. Проверка
+    assert "\n".join(cp1251_blocks) == "header line\n" * 30 + russian
+    assert len(utf8_blocks) > 1
+    assert "\n".join(utf8_blocks) == russian
+
+@pytest.mark.parametrize("encoding", ["cp1251", "koi8_r", "cp866"])
+def test_short_cyrillic_txt_encoding_is_detected(parser_service, tmp_path, encoding):
+    """
+    Проверяет, что короткий русский текст в однобайтовой кодировке не принимается за азиатскую
+    кодировку (charset_normalizer определяет "Привет" в cp1251 как big5).
+    """
+    # 1. Подготовка
+    file_path = tmp_path / "short.txt"
+    file_path.write_bytes("Привет".encode(encoding))
+
+    # 2. Действие
+    text = parser_service.extract_text(str(file_path))
+
+    # 3. Проверка
+    assert text == "Привет"
+
 # END OF FILE tests/test_file_parser_service.py #
\ No newline at end of file
@@ -0,0 +1,130 @@
+# START OF FILE tests/test_ingestion_queue.py #
+
+import asyncio
+import threading
+import pytest
+from ingestion_queue import IngestionQueue, QUEUED, DONE, FAILED
+
+
+async def _wait_finished(queue: IngestionQueue, user_id: int, count: int):
+    for _ in range(200):
+        jobs = queue.list_jobs(user_id)
+        if len(jobs) >= count and all(job.state in (DONE, FAILED) for job in jobs):
+            return jobs
+        await asyncio.sleep(0.01)
+    raise AssertionError("Задачи не завершились")
+
+
+async def test_jobs_run_in_queue_threads_and_report_stages(tmp_path):
+    """
+    Проверяет, что задачи выполняются исполнителями очереди, синхронные шаги идут в ее собственном
+    пуле потоков, а этапы, прогресс и итог задачи сохраняются.
+    """
+    # 1. Подготовка
+    queue = IngestionQueue(str(tmp_path / "jobs.sqlite3"), workers=2, max_jobs_per_user=5, max_pending=10)
+    threads = []
+
+    async def runner(job):
+        threads.append(await queue.run_blocking(lambda: threading.current_thread().name))
+        queue.update(job.job_id, 'embed', 3, 4)
+        if job.file_name == "bad.pdf":
+            raise RuntimeError("поврежденный файл")
+        return "проиндексирован"
+
+    await queue.start(runner)
+
+    # 2. Действие
+    queue.submit(1, 10, None, 'telegram', "file-a", "a.pdf")
+    queue.submit(1, 10, None, 'telegram', "file-b", "bad.pdf")
+    jobs = await _wait_finished(queue, 1, 2)
+    await queue.stop()
+
+    # 3. Проверка
+    by_name = {job.file_name: job for job in jobs}
+    assert by_name["a.pdf"].state == DONE and by_name["a.pdf"].result == "проиндексирован"
+    assert by_name["bad.pdf"].state == FAILED and by_name["bad.pdf"].result == "поврежденный файл"
+    assert (by_name["a.pdf"].stage, by_name["a.pdf"].done, by_name["a.pdf"].total) == ('embed', 3, 4)
+    assert all(name.startswith("ingestion") for name in threads)
+
+
+async def test_stop_waits_for_running_blocking_step(tmp_path):
+    """
+    Проверяет, что остановка очереди дожидается синхронного шага, который уже выполняется
+    (например, записи в коллекцию), чтобы после нее базу можно было закрыть.
+    """
+    # 1. Подготовка
+    queue = IngestionQueue(str(tmp_path / "jobs.sqlite3"), workers=1, max_jobs_per_user=5, max_pending=10)
+    step_started, finished = threading.Event(), []
+
+    def slow_step():
+        step_started.set()
+        threading.Event().wait(0.3)
+        finished.append(True)
+
+    async def runner(job):
+        await queue.run_blocking(slow_step)
+
+    await queue.start(runner)
+    queue.submit(1, 10, None, 'telegram', "file-a", "a.pdf")
+    await asyncio.to_thread(step_started.wait, 5)
+
+    # 2. Действие
+    await queue.stop()
+
+    # 3. Проверка
+    assert finished == [True]
+    queue.close()
+
+
+def test_per_user_and_queue_limits(tmp_path):
+    """Проверяет, что лимит незавершенных задач пользователя и размер очереди ограничивают постановку задач."""
+    # 1. Подготовка
+    queue = IngestionQueue(str(tmp_path / "jobs.sqlite3"), workers=1, max_jobs_per_user=2, max_pending=3)
+    queue.submit(1, 10, None, 'telegram', "f1", "1.pdf")
+    queue.submit(1, 10, None, 'telegram', "f2", "2.pdf")
+
+    # 2. Действие и 3. Проверка
+    with pytest.raises(ValueError, match="в обработке"):
+        queue.submit(1, 10, None, 'telegram', "f3", "3.pdf")
+    queue.submit(2, 20, None, 'gdrive', "f4", "4.pdf")
+    with pytest.raises(ValueError, match="переполнена"):
+        queue.submit(3, 30, None, 'gdrive', "f5", "5.pdf")
+
+
+async def test_unfinished_jobs_resume_after_restart(tmp_path):
+    """Проверяет, что задачи, не завершенные до остановки бота, выполняются после перезапуска."""
+    # 1. Подготовка: первая задача прерывается посреди выполнения, вторая ждет в очереди
+    db_path = str(tmp_path / "jobs.sqlite3")
+    queue = IngestionQueue(db_path, workers=1)
+    started = asyncio.Event()
+
+    async def hanging_runner(job):
+        started.set()
+        await asyncio.sleep(60)
+
+    await queue.start(hanging_runner)
+    first = queue.submit(1, 10, "user_1", 'telegram', "f1", "1.pdf", file_key="telegram:u1", message_id=5)
+    queue.submit(1, 10, "user_1", 'telegram', "f2", "2.pdf")
+    await started.wait()
+    await queue.stop()
+    queue.close()
+
+    # 2. Действие
+    restarted = IngestionQueue(db_path, workers=1)
+    resumed = []
+
+    async def runner(job):
+        resumed.append(job)
+        return "готово"
+
+    await restarted.start(runner)
+    jobs = await _wait_finished(restarted, 1, 2)
+    await restarted.stop()
+
+    # 3. Проверка
+    assert [job.file_name for job in resumed] == ["1.pdf", "2.pdf"]
+    assert resumed[0].job_id == first.job_id and resumed[0].state == QUEUED
+    assert (resumed[0].collection, resumed[0].file_key, resumed[0].message_id) == ("user_1", "telegram:u1", 5)
+    assert all(job.state == DONE for job in jobs)
+
+# END OF FILE tests/test_ingestion_queue.py #
@@ -0,0 +1,139 @@
+# START OF FILE tests/test_knowledge_base_manager.py #
+
+import hashlib
+import threading
+import pytest
+from unittest.mock import MagicMock, patch
+from langchain_core.embeddings import Embeddings
+
+with patch('langchain_huggingface.HuggingFaceEmbeddings') as mock_embeddings:
+    mock_embeddings.return_value = MagicMock()
+    from knowledge_base_manager import KnowledgeBaseManager
+    from knowledge_base_service import EmbeddingResources
+
+
+class FakeEmbeddings(Embeddings):
+    """Детерминированные "эмбеддинги": мешок слов, разложенный по хешам в 16 измерений."""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = [0.0] * 16
+        for word in text.lower().split():
+            vector[hashlib.md5(word.encode('utf-8')).digest()[0] % 16] += 1.0
+        return vector
+
+
+@pytest.fixture
+def manager_factory(mocker, tmp_path):
+    """Возвращает функцию, создающую KnowledgeBaseManager с коллекциями во временной папке."""
+    mocker.patch('knowledge_base_service.VECTOR_STORE_PATH', str(tmp_path / 'faiss_index'))
+    mocker.patch('knowledge_base_service.SOURCE_MAP_PATH', str(tmp_path / 'source_map.json'))
+    mocker.patch('knowledge_base_service.CHUNK_STORE_PATH', str(tmp_path / 'chunk_store.sqlite3'))
+    mocker.patch('knowledge_base_service.EMBEDDING_CACHE_PATH', str(tmp_path / 'embedding_cache.sqlite3'))
+    mocker.patch('knowledge_base_service.HuggingFaceEmbeddings', return_value=FakeEmbeddings())
+    managers = []
+
+    def create(**kwargs):
+        manager = KnowledgeBaseManager(EmbeddingResources(), collections_dir=str(tmp_path / 'collections'), **kwargs)
+        managers.append(manager)
+        return manager
+
+    yield create
+    for manager in managers:
+        manager.close()
+
+
+def test_collections_are_loaded_lazily_and_isolated(manager_factory):
+    """
+    Проверяет, что коллекция загружается только при первом обращении,
+    а документы одной коллекции не видны в поиске другой.
+    """
+    # 1. Подготовка
+    manager = manager_factory()
+    assert manager.loaded_collections() == []
+
+    # 2. Действие
+    manager.add_text("Артикул ZX-4410 поставляется в синем корпусе.", {"source": "a.txt", "source_id": "a"},
+                     collection="user_1")
+    manager.add_text("Отпуск оформляется за две недели.", {"source": "b.txt", "source_id": "b"},
+                     collection="user_2")
+
+    # 3. Проверка
+    assert manager.loaded_collections() == ["user_1", "user_2"]
+    assert [doc.metadata['source'] for doc in manager.search("ZX-4410", k=4, collection="user_1")] == ["a.txt"]
+    assert all(doc.metadata['source'] == "b.txt" for doc in manager.search("ZX-4410", k=4, collection="user_2"))
+    assert manager.count_indexed_sources(collection="user_1") == 1
+    # Общая база (коллекция None) при этом не создавалась и осталась пустой
+    assert manager.vector_count() == 0
+
+
+def test_least_recently_used_collection_is_evicted_and_reloaded(manager_factory):
+    """
+    Проверяет, что при превышении числа загруженных коллекций выгружается давно не использованная,
+    а ее данные остаются на диске и снова доступны после повторной загрузки.
+    """
+    # 1. Подготовка
+    manager = manager_factory(max_loaded=2)
+    for name in ("chat_1", "chat_2"):
+        manager.add_text(f"Документ коллекции {name}.", {"source": f"{name}.txt", "source_id": name}, collection=name)
+    manager.count_indexed_sources(collection="chat_1")  # chat_1 становится самой свежей
+
+    # 2. Действие
+    manager.add_text("Документ коллекции chat_3.", {"source": "chat_3.txt", "source_id": "chat_3"},
+                     collection="chat_3")
+
+    # 3. Проверка
+    assert manager.loaded_collections() == ["chat_1", "chat_3"]
+    sources = manager.get_indexed_sources(collection="chat_2")
+    assert [source['source'] for source in sources] == ["chat_2.txt"]
+    assert manager.vector_count(collection="chat_2") > 0
+    assert "chat_2" in manager.loaded_collections()
+    assert len(manager.loaded_collections()) == 2
+
+
+def test_evicted_collection_is_closed_without_blocking_the_request(manager_factory, mocker):
+    """
+    Проверяет, что запрос, вытеснивший коллекцию, не ждет ее закрытия (ожидания компактизации),
+    а повторная загрузка этой коллекции дожидается, пока закрытие завершится.
+    """
+    # 1. Подготовка
+    manager = manager_factory(max_loaded=1)
+    manager.add_text("Документ коллекции chat_1.", {"source": "chat_1.txt", "source_id": "chat_1"},
+                     collection="chat_1")
+    service = manager._services["chat_1"]
+    closing_started, finish_closing, closed = threading.Event(), threading.Event(), threading.Event()
+    original_close = service.close
+
+    def slow_close():
+        closing_started.set()
+        finish_closing.wait(5)
+        original_close()
+        closed.set()
+
+    mocker.patch.object(service, 'close', side_effect=slow_close)
+
+    # 2. Действие
+    manager.add_text("Документ коллекции chat_2.", {"source": "chat_2.txt", "source_id": "chat_2"},
+                     collection="chat_2")
+    evicted_while_closing = closing_started.wait(5) and not closed.is_set()
+    reload = threading.Thread(target=manager.count_indexed_sources, kwargs={'collection': "chat_1"})
+    reload.start()
+    reload.join(0.2)
+    reload_waited = reload.is_alive()
+    finish_closing.set()
+    reload.join(5)
+
+    # 3. Проверка
+    assert evicted_while_closing and reload_waited
+    assert manager.count_indexed_sources(collection="chat_1") == 1
+
+
+def test_invalid_collection_name_is_rejected(manager_factory):
+    """Проверяет, что имя коллекции не может выйти за пределы папки коллекций."""
+    manager = manager_factory()
+    with pytest.raises(ValueError):
+        manager.search("вопрос", collection="../secret")
+
+# END OF FILE tests/test_knowledge_base_manager.py #
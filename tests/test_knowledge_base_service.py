@@ -1,101 +1,607 @@
 # START OF FILE tests/test_knowledge_base_service.py #
 
+import hashlib
+import threading
+import numpy as np
 import pytest
 from unittest.mock import MagicMock, patch
+from langchain_core.embeddings import Embeddings
 
 # Патчим тяжелые зависимости на уровне модуля, чтобы они не загружались
 # Это гарантирует, что при импорте KnowledgeBaseService его зависимости уже будут подменены
 with patch('langchain_huggingface.HuggingFaceEmbeddings') as mock_embeddings:
     mock_embeddings.return_value = MagicMock()
     from knowledge_base_service import KnowledgeBaseService
+import vector_index
+
+
+class FakeEmbeddings(Embeddings):
+    """Детерминированные "эмбеддинги": мешок слов, разложенный по хешам в 16 измерений."""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = [0.0] * 16
+        for word in text.lower().split():
+            vector[hashlib.md5(word.encode('utf-8')).digest()[0] % 16] += 1.0
+        return vector
+
+
+@pytest.fixture
+def kb_factory(mocker, tmp_path):
+    """
+    Возвращает функцию, создающую KnowledgeBaseService с настоящим FAISS во временной папке.
+    Повторный вызов имитирует перезапуск бота с теми же файлами на диске.
+    """
+    mocker.patch('knowledge_base_service.VECTOR_STORE_PATH', str(tmp_path / 'faiss_index'))
+    mocker.patch('knowledge_base_service.SOURCE_MAP_PATH', str(tmp_path / 'source_map.json'))
+    mocker.patch('knowledge_base_service.CHUNK_STORE_PATH', str(tmp_path / 'chunk_store.sqlite3'))
+    mocker.patch('knowledge_base_service.EMBEDDING_CACHE_PATH', str(tmp_path / 'embedding_cache.sqlite3'))
+    mocker.patch('knowledge_base_service.HuggingFaceEmbeddings', return_value=FakeEmbeddings())
+    return KnowledgeBaseService
 
 
 @pytest.fixture
-def clean_kb_service(mocker):
+def clean_kb_service(mocker, tmp_path):
     """
     Фикстура, которая создает экземпляр KnowledgeBaseService в "чистом" состоянии,
     как будто программа только что запустилась и не нашла сохраненных файлов.
-    service.vector_store здесь будет None.
+    service.index здесь будет None.
     """
-    mocker.patch('os.path.exists', return_value=False)
-    mocker.patch('builtins.open', mocker.mock_open())
+    # Все файлы базы знаний (снимок и журнал) создаются во временной папке теста
+    mocker.patch('knowledge_base_service.VECTOR_STORE_PATH', str(tmp_path / 'faiss_index'))
+    mocker.patch('knowledge_base_service.SOURCE_MAP_PATH', str(tmp_path / 'source_map.json'))
+    mocker.patch('knowledge_base_service.CHUNK_STORE_PATH', str(tmp_path / 'chunk_store.sqlite3'))
+    mocker.patch('knowledge_base_service.EMBEDDING_CACHE_PATH', str(tmp_path / 'embedding_cache.sqlite3'))
 
     service = KnowledgeBaseService()
+    # Поддельная модель возвращает по одному вектору на каждый чанк
+    service.embeddings.embed_documents.side_effect = lambda texts: [[0.1, 0.2, 0.3] for _ in texts]
 
     # Мокаем методы сохранения, чтобы они ничего не делали в тестах
-    mocker.patch.object(service, '_save_source_map')
     mocker.patch.object(service, 'save_vector_store')
+    mocker.patch.object(service.wal, 'append')
 
     return service
 
 
-def test_add_text_to_empty_kb_calls_from_texts(clean_kb_service, mocker):
+def test_add_text_to_empty_kb_publishes_chunks_in_delta(clean_kb_service, mocker):
     """
-    Проверяет, что при добавлении в пустую базу знаний (vector_store is None)
-    вызывается FAISS.from_texts.
+    Проверяет, что при добавлении в пустую базу знаний векторы сразу публикуются в дельте снимка
+    под теми же id, что и чанки в хранилище, а изменение записывается в журнал.
     """
     # 1. Подготовка
     test_text = "Это длинный текст для создания новой базы знаний." * 100
     test_metadata = {"source": "new_doc.txt", "source_id": "new_id_001"}
 
-    # Создаем поддельный объект vector_store, который ВЕРНЕТСЯ после вызова from_texts
-    mock_vector_store_instance = MagicMock()
-    # Симулируем получение ID после создания базы
-    mock_vector_store_instance.docstore._dict.keys.return_value = ["faiss_id_1", "faiss_id_2"]
+    # 2. Действие
+    clean_kb_service.add_text(test_text, test_metadata)
 
-    # --- КЛЮЧЕВОЕ ИЗМЕНЕНИЕ ---
-    # Патчим метод FAISS.from_texts в пространстве имен, где он используется
-    # (в модуле knowledge_base_service), а не в langchain.
-    mock_faiss_from_texts = mocker.patch(
-        'knowledge_base_service.FAISS.from_texts',  # <-- Правильный путь для патча
-        return_value=mock_vector_store_instance
-    )
+    # 3. Проверка
+    # Базовый индекс собирается только при компактизации
+    assert clean_kb_service.index is None
+    index_ids = clean_kb_service.chunk_store.index_ids_for_source("new_id_001")
+    assert clean_kb_service.vector_count == len(index_ids)
+    assert sorted(clean_kb_service._snapshot.delta_ids.tolist()) == sorted(index_ids)
+
+    # Изменение дописывается в журнал, а полный снимок не переписывается
+    clean_kb_service.wal.append.assert_called_once()
+    assert clean_kb_service.wal.append.call_args.args[0] == 'add'
+    clean_kb_service.save_vector_store.assert_not_called()
+
+
+def test_add_text_to_existing_kb_does_not_touch_published_snapshot(clean_kb_service, mocker):
+    """
+    Проверяет, что добавление в существующую базу не меняет ни опубликованный базовый индекс,
+    ни снимок, который в этот момент может читать поиск: новые векторы появляются только в следующей версии.
+    """
+    # 1. Подготовка
+    test_text = "Это текст для добавления в уже существующую базу." * 100
+    test_metadata = {"source": "existing_doc.txt", "source_id": "existing_id_002"}
+    base = vector_index.create_flat_index(3)
+    clean_kb_service._base = base
+    clean_kb_service._publish()
+    before = clean_kb_service._snapshot
+    mock_create_index = mocker.patch('vector_index.create_flat_index')
 
     # 2. Действие
-    # clean_kb_service.vector_store изначально None
     clean_kb_service.add_text(test_text, test_metadata)
 
     # 3. Проверка
-    # Теперь этот assert должен сработать, потому что мы правильно перехватили вызов
-    mock_faiss_from_texts.assert_called_once()
+    after = clean_kb_service._snapshot
+    assert base.ntotal == 0 and after.base is base
+    assert len(before.delta_ids) == 0 and after.version > before.version
+    new_ids = clean_kb_service.chunk_store.index_ids_for_source("existing_id_002")
+    assert sorted(after.delta_ids.tolist()) == sorted(new_ids)
+    mock_create_index.assert_not_called()
+
+
+def test_changes_survive_restart_via_log_replay(kb_factory):
+    """
+    Проверяет, что добавления и удаления, записанные только в журнал (без снимка),
+    восстанавливаются при следующем запуске.
+    """
+    # 1. Подготовка
+    service = kb_factory()
+    service.add_text("кошки любят молоко и сметану", {"source": "cats.txt", "source_id": "cats"})
+    service.add_text("собаки охраняют дом", {"source": "dogs.txt", "source_id": "dogs"})
+    service.delete_by_source_id("dogs")
+
+    # 2. Действие
+    restarted = kb_factory()
+
+    # 3. Проверка
+    assert [s['source_id'] for s in restarted.get_indexed_sources()] == ["cats"]
+    # Каталог источников восстанавливается из журнала вместе с чанками
+    source = restarted.get_indexed_sources()[0]
+    assert source['chunk_count'] == 1 and source['byte_size'] == len("кошки любят молоко и сметану".encode('utf-8'))
+    assert source['content_hash'] == hashlib.sha256("кошки любят молоко и сметану".encode('utf-8')).hexdigest()
+    assert restarted.count_indexed_sources() == 1
+    results = restarted.search("кошки молоко", k=1)
+    assert results[0].metadata["source_id"] == "cats"
+    # Удаление логическое: вектор остается в индексе до фоновой компактизации, но помечен надгробием
+    assert restarted.vector_count == 1 and restarted._snapshot.ntotal == 2
 
-    # Проверяем, что карта источников обновилась
-    assert "new_id_001" in clean_kb_service.source_id_to_faiss_ids_map
-    assert clean_kb_service.source_id_to_faiss_ids_map["new_id_001"] == ["faiss_id_1", "faiss_id_2"]
 
-    # Проверяем, что было вызвано сохранение
-    clean_kb_service.save_vector_store.assert_called_once()
+def test_snapshot_then_log_replay(kb_factory):
+    """
+    Проверяет, что после записи снимка журнал очищается, а более поздние изменения
+    применяются поверх снимка при перезапуске.
+    """
+    # 1. Подготовка
+    service = kb_factory()
+    service.add_text("первый документ про маркетинг", {"source": "a.txt", "source_id": "a"})
+    service.save_vector_store()
+    assert service.wal.size_bytes == 0
+    service.add_text("второй документ про рекламу", {"source": "b.txt", "source_id": "b"})
 
+    # 2. Действие
+    restarted = kb_factory()
+
+    # 3. Проверка
+    assert {s['source_id'] for s in restarted.get_indexed_sources()} == {"a", "b"}
+    assert restarted.index.ntotal == 1 and restarted.vector_count == 2
 
-def test_add_text_to_existing_kb_calls_add_texts(clean_kb_service, mocker):
+
+def test_reindexing_skips_model_for_cached_chunks(kb_factory, mocker):
     """
-    Проверяет, что при добавлении в существующую базу знаний
-    вызывается метод vector_store.add_texts.
+    Проверяет, что при повторной индексации источника модель вызывается
+    только для новых чанков, а уже встречавшиеся берутся из кэша.
     """
     # 1. Подготовка
-    test_text = "Это текст для добавления в уже существующую базу." * 100
-    test_metadata = {"source": "existing_doc.txt", "source_id": "existing_id_002"}
+    service = kb_factory()
+    paragraphs = [f"абзац номер {i} " + "текст " * 150 for i in range(5)]
+    service.add_text("\n\n".join(paragraphs), {"source": "doc.txt", "source_id": "doc"})
+    spy = mocker.spy(service.embeddings, 'embed_documents')
 
-    # Симулируем существующую базу, назначив поддельный vector_store сервису
-    mock_vector_store_instance = MagicMock()
-    mock_vector_store_instance.add_texts.return_value = ["faiss_id_3", "faiss_id_4"]
-    clean_kb_service.vector_store = mock_vector_store_instance
+    # 2. Действие: меняем только последний абзац
+    paragraphs[-1] = "отредактированный абзац " + "слово " * 150
+    service.add_text("\n\n".join(paragraphs), {"source": "doc.txt", "source_id": "doc"})
+
+    # 3. Проверка
+    spy.assert_called_once()
+    assert len(spy.call_args.args[0]) == 1
+    assert len(service.chunk_store.index_ids_for_source("doc")) == 5
 
-    # Патчим from_texts, чтобы убедиться, что он НЕ вызывается
-    mock_faiss_from_texts = mocker.patch('knowledge_base_service.FAISS.from_texts')
+
+def test_add_text_streams_batches_and_reports_progress(kb_factory, mocker):
+    """
+    Проверяет, что чанки добавляются батчами заданного размера, а вызывающий код получает прогресс
+    после каждого батча (общее число чанков известно, когда документ дочитан).
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.EMBEDDING_BATCH_SIZE', 2)
+    service = kb_factory()
+    text = "\n\n".join(f"раздел {i} " + "слово " * 150 for i in range(5))
+    progress = []
 
     # 2. Действие
-    clean_kb_service.add_text(test_text, test_metadata)
+    added = service.add_text(text, {"source": "doc.txt", "source_id": "doc"},
+                             progress_callback=lambda done, total: progress.append((done, total)))
 
     # 3. Проверка
-    # Проверяем, что был вызван метод .add_texts() у нашего мока
-    clean_kb_service.vector_store.add_texts.assert_called_once()
+    assert added == 5
+    assert progress == [(2, None), (4, 5), (5, 5)]
+    assert len([r for r in service.wal.replay() if r.op == 'add']) == 3
+    assert len(service.chunk_store.index_ids_for_source("doc")) == 5
+    assert service.vector_count == 5
+
 
-    # Убеждаемся, что from_texts НЕ был вызван
-    mock_faiss_from_texts.assert_not_called()
+@pytest.mark.parametrize("index_type", ["ivf_flat", "ivf_pq", "hnsw"])
+def test_flat_index_is_promoted_after_threshold(kb_factory, mocker, index_type):
+    """
+    Проверяет, что после порога плоский индекс заменяется ANN-индексом,
+    а поиск и удаление продолжают работать и переживают перезапуск.
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_INDEX_TYPE', index_type)
+    mocker.patch('knowledge_base_service.KB_INDEX_PROMOTE_THRESHOLD', 300)
+    service = kb_factory()
+    for doc in range(3):
+        text = "\n\n".join(f"док{doc} абзац{i} " + " ".join(f"слово{doc}_{i}_{j}" for j in range(70))
+                             for i in range(110))
+        service.add_text(text, {"source": f"{doc}.txt", "source_id": f"doc{doc}"})
+
+    # 2. Действие: переход запускается в фоне после пересечения порога
+    service._compaction_thread.join()
+    service.delete_by_source_id("doc0")
+    service.save_vector_store()
+    restarted = kb_factory()
+
+    # 3. Проверка
+    for kb in (service, restarted):
+        assert vector_index.index_kind(kb.index) == index_type
+        assert kb.vector_count == 220
+        results = kb.search("док1 абзац5 " + " ".join(f"слово1_5_{j}" for j in range(70)), k=4)
+        assert results and all(doc.metadata["source_id"] != "doc0" for doc in results)
+
+
+def test_deleted_chunks_are_hidden_at_once_and_purged_in_background(kb_factory, mocker):
+    """
+    Проверяет, что удаленные чанки сразу пропадают из поиска, а фоновая компактизация
+    физически удаляет их векторы, когда доля надгробий превышает порог.
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_TOMBSTONE_COMPACT_MIN', 0)
+    mocker.patch('knowledge_base_service.KB_TOMBSTONE_COMPACT_RATIO', 0.5)
+    service = kb_factory()
+    service.add_text("кошки любят молоко и сметану", {"source": "cats.txt", "source_id": "cats"})
+    service.add_text("собаки охраняют дом", {"source": "dogs.txt", "source_id": "dogs"})
+
+    # 2. Действие
+    service.delete_by_source_id("dogs")
+    hidden = service.search("собаки охраняют дом", k=2)
+    service._compaction_thread.join()
+    restarted = kb_factory()
+
+    # 3. Проверка
+    assert [doc.metadata["source_id"] for doc in hidden] == ["cats"]
+    for kb in (service, restarted):
+        assert kb.index.ntotal == 1 and not kb._tombstones
+        assert [doc.metadata["source_id"] for doc in kb.search("собаки охраняют дом", k=2)] == ["cats"]
+
+
+def test_mmap_mode_maps_snapshot_and_copies_index_on_write(kb_factory, mocker):
+    """
+    Проверяет, что в режиме KB_INDEX_MMAP индекс снимка отображается из файла и остается
+    отображенным при добавлениях (они идут в дельту), а после нового снимка отображается заново.
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_INDEX_MMAP', True)
+    service = kb_factory()
+    service.add_text("кошки любят молоко", {"source": "cats.txt", "source_id": "cats"})
+    service.save_vector_store()
+    assert service._base_mmapped
+
+    # 2. Действие
+    restarted = kb_factory()
+    found_before_write = restarted.search("кошки молоко", k=1)
+    restarted.add_text("собаки охраняют дом", {"source": "dogs.txt", "source_id": "dogs"})
+    mmapped_after_write = restarted._base_mmapped
+    restarted.save_vector_store()
+
+    # 3. Проверка
+    assert found_before_write[0].page_content == "кошки любят молоко"
+    assert mmapped_after_write
+    assert restarted._base_mmapped and restarted.index.ntotal == 2
+    assert restarted.search("собаки дом", k=1)[0].metadata["source_id"] == "dogs"
+
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw"])
+def test_search_can_be_restricted_to_sources(kb_factory, mocker, index_type):
+    """
+    Проверяет, что поиск с фильтром по источникам находит чанки только этих источников -
+    и в базовом индексе (плоском и ANN), и в дельте, и в полнотекстовой части.
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_INDEX_TYPE', index_type)
+    mocker.patch('knowledge_base_service.KB_INDEX_PROMOTE_THRESHOLD', 50)
+    service = kb_factory()
+    for i in range(60):
+        service.add_text(f"договор поставки номер {i} оплата", {"source": f"{i}.txt", "source_id": f"doc{i}"})
+    service.save_vector_store()
+    service.add_text("договор поставки свежий оплата", {"source": "new.txt", "source_id": "new"})
+    # Точный текст документа doc5: без фильтра он был бы первым
+    query = "договор поставки номер 5 оплата"
+
+    # 2. Действие
+    unfiltered = service.search(query, k=3)
+    filtered = service.search(query, k=3, source_ids=["doc42", "new"])
+    batch = service.search_batch([query], k=3, source_ids=["doc42"])
+    missing = service.search(query, k=3, source_ids=["unknown"])
+
+    # 3. Проверка
+    assert vector_index.index_kind(service.index) == index_type
+    assert unfiltered[0].metadata["source_id"] == "doc5"
+    assert {doc.metadata["source_id"] for doc in filtered} == {"doc42", "new"}
+    assert [doc.metadata["source_id"] for doc, _ in batch[0]] == ["doc42"]
+    assert missing == []
+
+
+@pytest.mark.parametrize("compression", ["fp16", "sq8"])
+def test_compressed_index_reranks_with_exact_vectors(kb_factory, mocker, compression):
+    """
+    Проверяет, что при включенном сжатии плоский индекс хранит векторы сжатыми, точные векторы
+    пишутся в снимок рядом с ним, а поиск переранжирует кандидатов по ним - и после перезапуска.
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_VECTOR_COMPRESSION', compression)
+    mocker.patch('knowledge_base_service.KB_HYBRID_LEXICAL_WEIGHT', 0.0)
+    service = kb_factory()
+    for i in range(40):
+        service.add_text(f"отчет квартал{i} филиал{i} сводка{i}", {"source": f"{i}.txt", "source_id": f"doc{i}"})
+    query = "отчет квартал23 филиал23 сводка23"
+
+    # 2. Действие
+    service.save_vector_store()
+    service.add_text("отчет квартал свежий", {"source": "new.txt", "source_id": "new"})
+    service.save_vector_store()
+    restarted = kb_factory()
+
+    # 3. Проверка
+    for kb in (service, restarted):
+        assert vector_index.flat_compression(kb.index) == compression
+        assert kb._snapshot.exact_vectors is not None
+        assert kb.search(query, k=1)[0].metadata["source_id"] == "doc23"
+        # Точные расстояния: документ, совпадающий с запросом, находится на нулевом расстоянии
+        assert kb.search_batch([query], k=1)[0][0][1] == pytest.approx(1.0)
+    assert len(restarted.chunk_store.index_ids_for_source("new")) == 1
+    assert restarted.search("отчет квартал свежий", k=1)[0].metadata["source_id"] == "new"
+
+
+def test_pq_compression_reports_recall_with_reranking():
+    """Проверяет, что PQ сжимает индекс, а переранжирование возвращает recall к точному поиску."""
+    # 1. Подготовка
+    rng = np.random.default_rng(1)
+    ids = np.arange(3000, dtype=np.int64) * 3
+    vectors = rng.random((3000, 16), dtype=np.float32)
 
-    # Проверяем карту источников
-    assert "existing_id_002" in clean_kb_service.source_id_to_faiss_ids_map
-    assert clean_kb_service.source_id_to_faiss_ids_map["existing_id_002"] == ["faiss_id_3", "faiss_id_4"]
+    # 2. Действие
+    index = vector_index.build_flat_index("pq", ids, vectors, pq_m=4)
+    recall, reranked_recall = vector_index.compression_recall(index, ids, vectors, rerank_factor=8)
+
+    # 3. Проверка
+    assert vector_index.flat_compression(index) == "pq"
+    uncompressed = vector_index.build_flat_index("none", ids, vectors)
+    assert vector_index.memory_bytes(index) < vector_index.memory_bytes(uncompressed)
+    assert reranked_recall > recall
+    assert reranked_recall >= 0.95
+
+
+def test_search_is_not_blocked_by_writers(kb_factory):
+    """
+    Проверяет, что поиск читает опубликованный снимок и не ждет писателя,
+    который держит блокировку (например, долгую загрузку документа).
+    """
+    # 1. Подготовка
+    service = kb_factory()
+    service.add_text("кошки любят молоко", {"source": "cats.txt", "source_id": "cats"})
+    results = []
+
+    # 2. Действие
+    with service._lock:
+        reader = threading.Thread(target=lambda: results.extend(service.search("кошки молоко", k=1)))
+        reader.start()
+        reader.join(timeout=5)
+        finished_while_locked = not reader.is_alive()
+
+    # 3. Проверка
+    assert finished_while_locked
+    assert results[0].metadata["source_id"] == "cats"
+
+
+@pytest.mark.parametrize("lexical_weight", [0.5, 1.0])
+def test_hybrid_search_finds_exact_codes(kb_factory, mocker, lexical_weight):
+    """
+    Проверяет, что гибридный поиск находит документ по артикулу, который векторный поиск
+    не отличает от похожих документов.
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_HYBRID_LEXICAL_WEIGHT', lexical_weight)
+    service = kb_factory()
+    for i in range(30):
+        service.add_text(f"кампания весна промокод SPRING{i:03d}", {"source": f"{i}.txt", "source_id": f"promo{i}"})
+
+    # 2. Действие
+    results = service.search("промокод SPRING017", k=3)
+
+    # 3. Проверка
+    assert results[0].metadata["source_id"] == "promo17"
+
+
+def test_hybrid_search_sees_only_chunks_of_its_snapshot(kb_factory, mocker):
+    """
+    Проверяет, что полнотекстовая половина гибридного поиска не подмешивает чанки, записанные
+    после публикации снимка, по которому идет векторный поиск.
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_HYBRID_LEXICAL_WEIGHT', 0.5)
+    service = kb_factory()
+    service.add_text("кампания весна промокод SPRING001", {"source": "a.txt", "source_id": "a"})
+    published = service._snapshot
+    service.add_text("кампания осень промокод AUTUMN002", {"source": "b.txt", "source_id": "b"})
+
+    # 2. Действие
+    hits = service._search_snapshot(published, ["промокод autumn002"], k=3)[0]
+
+    # 3. Проверка
+    assert hits and all(index_id <= published.max_id for index_id, _ in hits)
+    assert service.search("промокод AUTUMN002", k=1)[0].metadata["source_id"] == "b"
+
+
+def test_repeated_questions_are_served_from_caches(kb_factory, mocker):
+    """
+    Проверяет, что повторный вопрос не векторизуется заново и берет результат из кэша,
+    а после изменения базы результат пересчитывается, но эмбеддинг запроса переиспользуется.
+    """
+    # 1. Подготовка
+    service = kb_factory()
+    service.add_text("кошки любят молоко", {"source": "cats.txt", "source_id": "cats"})
+    spy = mocker.spy(service.embeddings, 'embed_documents')
+
+    # 2. Действие
+    first = service.search("Кошки   молоко", k=1)
+    repeated = service.search("кошки молоко", k=1)
+    model_calls = spy.call_count
+    service.add_text("собаки охраняют дом", {"source": "dogs.txt", "source_id": "dogs"})
+    after_change = service.search("кошки молоко", k=2)
+
+    # 3. Проверка
+    assert model_calls == 1
+    assert first == repeated
+    assert {doc.metadata["source_id"] for doc in after_change} == {"cats", "dogs"}
+    stats = service.get_cache_stats()
+    assert stats['query_embeddings']['hits'] == 1
+    assert stats['search_results']['hits'] == 1 and stats['search_results']['misses'] == 2
+
+
+def test_search_batch_embeds_queries_in_one_call_and_returns_scores(kb_factory, mocker):
+    """
+    Проверяет, что пакетный поиск векторизует все запросы одним вызовом модели
+    и возвращает для каждого запроса свои результаты с оценками по убыванию.
+    """
+    # 1. Подготовка
+    service = kb_factory()
+    service.add_text("кошки любят молоко", {"source": "cats.txt", "source_id": "cats"})
+    service.add_text("собаки охраняют дом", {"source": "dogs.txt", "source_id": "dogs"})
+    spy = mocker.spy(service.embeddings, 'embed_documents')
+
+    # 2. Действие
+    results = service.search_batch(["кошки молоко", "собаки дом", "кошки молоко"], k=2)
+
+    # 3. Проверка
+    spy.assert_called_once()
+    assert spy.call_args.args[0] == ["кошки молоко", "собаки дом"]
+    assert [[doc.metadata["source_id"] for doc, _ in hits][0] for hits in results] == ["cats", "dogs", "cats"]
+    assert all(hits[0][1] >= hits[-1][1] > 0 for hits in results)
+
+
+def test_concurrent_searches_are_micro_batched(kb_factory, mocker):
+    """Проверяет, что одновременные вопросы при включенном окне склеиваются в один пакетный поиск."""
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_SEARCH_BATCH_WINDOW_MS', 200)
+    service = kb_factory()
+    service.add_text("кошки любят молоко", {"source": "cats.txt", "source_id": "cats"})
+    service.add_text("собаки охраняют дом", {"source": "dogs.txt", "source_id": "dogs"})
+    spy = mocker.spy(service, '_search_snapshot')
+    results = {}
+    queries = ["кошки молоко", "собаки дом", "молоко"]
+
+    # 2. Действие
+    threads = [threading.Thread(target=lambda q=q: results.update({q: service.search(q, k=1)})) for q in queries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 3. Проверка
+    spy.assert_called_once()
+    assert results["кошки молоко"][0].metadata["source_id"] == "cats"
+    assert results["собаки дом"][0].metadata["source_id"] == "dogs"
+
+
+def test_legacy_pickle_snapshot_is_migrated_to_chunk_store(kb_factory, tmp_path):
+    """
+    Проверяет, что снимок старого формата (FAISS.save_local из LangChain) загружается:
+    чанки переносятся в хранилище, а .pkl больше не используется.
+    """
+    # 1. Подготовка
+    from langchain_community.vectorstores import FAISS
+    texts = ["кошки любят молоко", "собаки охраняют дом"]
+    metadatas = [{"source": "cats.txt", "source_id": "cats"}, {"source": "dogs.txt", "source_id": "dogs"}]
+    FAISS.from_texts(texts, FakeEmbeddings(), metadatas=metadatas).save_local(str(tmp_path), "faiss_index")
+
+    # 2. Действие
+    service = kb_factory()
+
+    # 3. Проверка
+    assert not (tmp_path / "faiss_index.pkl").exists()
+    assert service.index.ntotal == 2
+    assert service.search("собаки дом", k=1)[0].page_content == "собаки охраняют дом"
+    assert {s['source_id'] for s in service.get_indexed_sources()} == {"cats", "dogs"}
+
+
+def test_near_duplicate_documents_share_chunks(kb_factory, mocker):
+    """
+    Проверяет, что почти дубликат уже загруженного документа не векторизуется повторно,
+    а после удаления первого документа общий текст остается доступен через второй.
+    """
+    # 1. Подготовка
+    service = kb_factory()
+    text = ("Сотрудник подает заявление на отпуск руководителю не позднее чем за две недели до его начала, "
+            "после чего отдел кадров готовит приказ и знакомит с ним сотрудника под подпись.")
+    service.add_text(text, {"source": "v1.txt", "source_id": "v1"})
+    spy = mocker.spy(service.embeddings, 'embed_documents')
+
+    # 2. Действие
+    service.add_text(text.replace("Сотрудник", "Работник", 1), {"source": "v2.txt", "source_id": "v2"})
+    vectors_after_copy = service.vector_count
+    service.delete_by_source_id("v1")
+
+    # 3. Проверка
+    assert spy.call_count == 0
+    assert vectors_after_copy == 1
+    assert [s['source_id'] for s in service.get_indexed_sources()] == ["v2"]
+    results = service.search("заявление на отпуск", k=1, source_ids=["v2"])
+    assert results[0].page_content == text and results[0].metadata["source_id"] == "v2"
+    # После перезапуска база восстанавливается из журнала в том же виде
+    restarted = kb_factory()
+    assert restarted.search("заявление на отпуск", k=1)[0].metadata["source_id"] == "v2"
+
+def test_add_blocks_streams_document_and_rolls_back_on_parser_error(kb_factory):
+    """
+    Проверяет, что документ из потока блоков индексируется без сборки целиком и попадает в каталог
+    с размером всего текста, а ошибка посреди чтения удаляет уже добавленную часть и пробрасывается.
+    """
+    # 1. Подготовка
+    service = kb_factory()
+    pages = [f"страница {i} " + f"текст{i} " * 300 for i in range(20)]
+
+    def broken_pages():
+        yield from pages[:10]
+        raise ValueError("поврежденная страница")
+
+    # 2. Действие
+    added = service.add_blocks(iter(pages), {"source": "report.pdf", "source_id": "report"})
+    with pytest.raises(ValueError):
+        service.add_blocks(broken_pages(), {"source": "broken.pdf", "source_id": "broken"})
+
+    # 3. Проверка
+    assert added > 20
+    source = service.chunk_store.get_source("report")
+    assert source['byte_size'] == len("\n".join(pages).encode('utf-8'))
+    assert source['chunk_count'] == added
+    assert not service.chunk_store.has_source("broken")
+    assert service.vector_count == added
+
+def test_deleted_chunk_ids_are_not_reused_after_restart(kb_factory, mocker):
+    """
+    Проверяет, что после перезапуска новые чанки не получают id удаленных, чьи векторы
+    еще лежат в сохраненном индексе под надгробиями.
+    """
+    # 1. Подготовка
+    mocker.patch('knowledge_base_service.KB_HYBRID_LEXICAL_WEIGHT', 0)
+    mocker.patch('knowledge_base_service.KB_TOMBSTONE_COMPACT_MIN', 10 ** 6)
+    service = kb_factory()
+    service.add_text("кошки любят молоко и сметану", {"source": "cats.txt", "source_id": "cats"})
+    service.add_text("собаки охраняют дом", {"source": "dogs.txt", "source_id": "dogs"})
+    service.save_vector_store()
+    service.delete_by_source_id("dogs")
+    service.save_vector_store()
+    dogs_ids = set(service._tombstones)
+
+    # 2. Действие
+    restarted = kb_factory()
+    restarted.add_text("попугаи повторяют слова", {"source": "birds.txt", "source_id": "birds"})
+    restarted.save_vector_store()
+    reloaded = kb_factory()
+
+    # 3. Проверка
+    birds_ids = set(restarted.chunk_store.index_ids_for_source("birds"))
+    assert birds_ids and not birds_ids & dogs_ids
+    for kb in (restarted, reloaded):
+        assert kb.search("попугаи повторяют слова", k=1)[0].metadata["source_id"] == "birds"
+        assert {doc.metadata["source_id"] for doc in kb.search("собаки охраняют дом", k=3)} == {"cats", "birds"}
 
 # END OF FILE tests/test_knowledge_base_service.py #
\ No newline at end of file
@@ -0,0 +1,44 @@
+# START OF FILE tests/test_micro_batcher.py #
+
+import threading
+import pytest
+from micro_batcher import MicroBatcher
+
+
+def test_calls_within_window_share_one_batch():
+    """Проверяет, что вызовы, пришедшие в пределах окна, выполняются одним пакетом и получают свои результаты."""
+    # 1. Подготовка
+    batches = []
+
+    def handler(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    batcher = MicroBatcher(handler, window_seconds=0.2, max_batch_size=3)
+    results = {}
+
+    # 2. Действие: пакет заполняется раньше окна и уходит сразу
+    threads = [threading.Thread(target=lambda i=i: results.update({i: batcher.submit(i)})) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 3. Проверка
+    assert len(batches) == 1 and sorted(batches[0]) == [0, 1, 2]
+    assert results == {0: 0, 1: 10, 2: 20}
+
+
+def test_handler_error_is_raised_in_every_caller():
+    """Проверяет, что ошибка обработчика пакета доходит до каждого вызова."""
+    # 1. Подготовка
+    def handler(items):
+        raise RuntimeError("сбой")
+
+    batcher = MicroBatcher(handler, window_seconds=0.0)
+
+    # 2. Действие и 3. Проверка
+    with pytest.raises(RuntimeError, match="сбой"):
+        batcher.submit(1)
+
+# END OF FILE tests/test_micro_batcher.py #
@@ -0,0 +1,57 @@
+# START OF FILE tests/test_parsed_text_cache.py #
+
+import random
+import pytest
+from parsed_text_cache import ParsedTextCache
+
+
+def _blocks_with_error():
+    yield "Первая страница"
+    raise RuntimeError("поврежденный файл")
+
+
+def test_incomplete_parse_is_not_cached(tmp_path):
+    """Проверяет, что текст попадает в кэш, только если документ разобран до конца."""
+    # 1. Подготовка
+    cache = ParsedTextCache(str(tmp_path / "cache.sqlite3"), parser_version=1, max_size_mb=1)
+
+    # 2. Действие
+    with pytest.raises(RuntimeError):
+        list(cache.store(["sha256:a"], _blocks_with_error()))
+    interrupted = cache.store(["sha256:b"], iter(["раз", "два"]))
+    next(interrupted)
+    interrupted.close()
+
+    # 3. Проверка
+    assert cache.find(["sha256:a"]) is None
+    assert cache.find(["sha256:b"]) is None
+
+
+def test_parser_version_and_lru_eviction(tmp_path):
+    """
+    Проверяет, что записи другой версии парсера не находятся, а при превышении объема
+    вытесняются давно не использованные документы.
+    """
+    # 1. Подготовка
+    db_path = str(tmp_path / "cache.sqlite3")
+    cache = ParsedTextCache(db_path, parser_version=1, max_size_mb=1)
+    cache.max_size_bytes = 2600
+    # Случайные байты в hex сжимаются примерно вдвое, поэтому каждый документ занимает около 1 КБ
+    documents = {name: random.Random(name).randbytes(1000).hex() for name in "abc"}
+
+    # 2. Действие
+    list(cache.store(["sha256:a"], [documents["a"]]))
+    list(cache.store(["sha256:b"], [documents["b"]]))
+    assert cache.find(["sha256:a"])  # "a" используется позже "b"
+    list(cache.store(["sha256:c"], [documents["c"]]))
+    cache.close()
+    new_version = ParsedTextCache(db_path, parser_version=2, max_size_mb=1)
+    reopened = ParsedTextCache(db_path, parser_version=1, max_size_mb=1)
+
+    # 3. Проверка
+    assert new_version.find(["sha256:a"]) is None
+    assert list(reopened.iter_blocks(["sha256:a"])) == [documents["a"]]
+    assert reopened.find(["sha256:b"]) is None
+    assert list(reopened.iter_blocks(["sha256:c"])) == [documents["c"]]
+
+# END OF FILE tests/test_parsed_text_cache.py #
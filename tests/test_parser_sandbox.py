@@ -0,0 +1,88 @@
+# START OF FILE tests/test_parser_sandbox.py #
+
+import os
+import time
+import pytest
+from parser_sandbox import ParserSandbox
+
+
+# Функции выполняются в процессах песочницы, поэтому объявлены на уровне модуля
+def _allocate(megabytes: int) -> int:
+    return len(bytearray(megabytes * 1024 * 1024))
+
+
+def _spin() -> None:
+    while True:
+        pass
+
+
+def _sleep(seconds: float) -> None:
+    time.sleep(seconds)
+
+
+@pytest.fixture
+def sandbox():
+    sandbox = ParserSandbox(workers=1, memory_limit_mb=512, cpu_limit_seconds=1, timeout_seconds=1, max_tasks=2)
+    yield sandbox
+    sandbox.close()
+
+
+def test_memory_and_cpu_limits_interrupt_parsing(sandbox):
+    """
+    Проверяет, что разбор, превысивший лимит памяти или процессорного времени, прерывается
+    ошибкой ValueError, а песочница продолжает принимать задачи.
+    """
+    # 1. Подготовка
+    sandbox.timeout_seconds = 10
+
+    # 2. Действие и 3. Проверка
+    with pytest.raises(ValueError, match="памяти"):
+        sandbox.run(_allocate, 1024)
+    with pytest.raises(ValueError, match="процессорного времени"):
+        sandbox.run(_spin)
+    assert sandbox.run(_allocate, 1) == 1024 * 1024
+
+
+def test_wall_clock_timeout_and_worker_recycling(sandbox):
+    """Проверяет таймаут задачи по реальному времени и замену процесса после max_tasks задач."""
+    # 1. Подготовка
+    pids = [sandbox.run(os.getpid) for _ in range(3)]
+
+    # 2. Действие
+    with pytest.raises(ValueError, match="время"):
+        sandbox.run(_sleep, 5)
+
+    # 3. Проверка
+    assert pids[0] == pids[1] and pids[2] != pids[1]
+    assert pids[0] != os.getpid()
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+def test_hung_worker_is_killed_when_its_pool_is_replaced(sandbox):
+    """
+    Проверяет, что процесс, зависший без нагрузки на CPU (лимит CPU его не остановит), завершается
+    после таймаута ожидания, а новые задачи выполняются в новом процессе.
+    """
+    # 1. Подготовка
+    hung_pid = sandbox.run(os.getpid)
+    future = sandbox.submit(_sleep, 60, timeout=0)
+
+    # 2. Действие
+    with pytest.raises(TimeoutError):
+        sandbox.result(future, 0.5)
+    deadline = time.monotonic() + 15
+    while _is_running(hung_pid) and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    # 3. Проверка
+    assert not _is_running(hung_pid)
+    assert sandbox.run(os.getpid) != hung_pid
+
+# END OF FILE tests/test_parser_sandbox.py #
@@ -0,0 +1,22 @@
+# START OF FILE tests/test_query_cache.py #
+
+from query_cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used_and_counts_hits():
+    """Проверяет, что при переполнении вытесняется давно не использованная запись, а попадания считаются."""
+    # 1. Подготовка
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    # 2. Действие
+    cache.get("a")  # "a" становится последней использованной
+    cache.put("c", 3)
+
+    # 3. Проверка
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats() == {'entries': 2, 'hits': 3, 'misses': 1, 'hit_rate': 0.75}
+
+# END OF FILE tests/test_query_cache.py #
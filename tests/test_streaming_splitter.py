@@ -0,0 +1,48 @@
+# START OF FILE tests/test_streaming_splitter.py #
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from streaming_splitter import iter_chunks, batched
+
+
+def test_stream_of_blocks_is_chunked_like_whole_text():
+    """
+    Проверяет, что потоковое разбиение начинает отдавать чанки до конца документа
+    и дает те же чанки (с тем же перекрытием), что и разбиение цельного текста.
+    """
+    # 1. Подготовка
+    splitter = RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=50, length_function=len)
+    blocks = [" ".join(f"стр{page}_слово{i}" for i in range(40)) for page in range(30)]
+    read = []
+
+    def read_blocks():
+        for block in blocks:
+            read.append(block)
+            yield block
+
+    # 2. Действие
+    stream = iter_chunks(splitter, read_blocks(), buffer_chars=1000)
+    first_chunk = next(stream)
+    blocks_read_for_first_chunk = len(read)
+    chunks = [first_chunk] + list(stream)
+
+    # 3. Проверка
+    assert blocks_read_for_first_chunk < len(blocks)
+    assert chunks == splitter.split_text("\n".join(blocks))
+
+
+def test_batched_reads_one_batch_ahead():
+    """Проверяет, что к выдаче последнего батча поток уже исчерпан."""
+    # 1. Подготовка
+    state = {'exhausted': False}
+
+    def items():
+        yield from range(5)
+        state['exhausted'] = True
+
+    # 2. Действие
+    seen = [(batch, state['exhausted']) for batch in batched(items(), 2)]
+
+    # 3. Проверка
+    assert seen == [([0, 1], False), ([2, 3], True), ([4], True)]
+
+# END OF FILE tests/test_streaming_splitter.py #
@@ -0,0 +1,69 @@
+# START OF FILE tests/test_vector_store_log.py #
+
+import os
+import numpy as np
+import pytest
+from vector_store_log import VectorStoreLog
+
+
+@pytest.fixture
+def log(tmp_path):
+    """Возвращает пустой журнал во временной папке."""
+    return VectorStoreLog(str(tmp_path / "index.wal"))
+
+
+def test_append_and_replay_roundtrip(log):
+    """
+    Проверяет, что записи читаются обратно в том же порядке вместе с векторами.
+    """
+    # 1. Подготовка
+    vectors = np.arange(6, dtype=np.float32).reshape(2, 3)
+
+    # 2. Действие
+    log.append('add', {'ids': ['a', 'b']}, vectors)
+    log.append('delete', {'ids': ['a']})
+    records = list(log.replay())
+
+    # 3. Проверка
+    assert [r.op for r in records] == ['add', 'delete']
+    assert records[0].payload == {'ids': ['a', 'b']}
+    np.testing.assert_array_equal(records[0].vectors, vectors)
+    assert records[1].vectors is None
+
+
+def test_torn_tail_is_discarded(log):
+    """
+    Проверяет, что недописанная при сбое запись отбрасывается,
+    а все предыдущие записи остаются целыми.
+    """
+    # 1. Подготовка
+    log.append('add', {'ids': ['a']}, np.ones((1, 4), dtype=np.float32))
+    good_size = os.path.getsize(log.path)
+    log.append('add', {'ids': ['b']}, np.ones((1, 4), dtype=np.float32))
+    # Имитируем сбой посреди записи второй записи
+    with open(log.path, 'r+b') as f:
+        f.truncate(good_size + 10)
+
+    # 2. Действие
+    records = list(VectorStoreLog(log.path).replay())
+
+    # 3. Проверка
+    assert [r.payload['ids'] for r in records] == [['a']]
+    assert os.path.getsize(log.path) == good_size
+
+
+def test_rotate_keeps_records_until_discarded(log):
+    """
+    Проверяет, что повернутый журнал продолжает воспроизводиться, пока снимок не подтвержден.
+    """
+    # 1. Подготовка
+    log.append('add', {'ids': ['a']})
+    log.rotate()
+    log.append('add', {'ids': ['b']})
+
+    # 2. Действие и проверка
+    assert [r.payload['ids'] for r in log.replay()] == [['a'], ['b']]
+    log.discard_rotated()
+    assert [r.payload['ids'] for r in log.replay()] == [['b']]
+
+# END OF FILE tests/test_vector_store_log.py #
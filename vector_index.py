@@ -0,0 +1,318 @@
+# START OF FILE vector_index.py #
+
+import math
+import logging
+from typing import Tuple
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые типы индекса. Все индексы хранят собственные int64 id векторов,
+# поэтому добавление и удаление не зависят от позиции вектора внутри индекса.
+INDEX_FLAT = 'flat'
+INDEX_IVF_FLAT = 'ivf_flat'
+INDEX_IVF_PQ = 'ivf_pq'
+INDEX_HNSW = 'hnsw'
+INDEX_TYPES = (INDEX_FLAT, INDEX_IVF_FLAT, INDEX_IVF_PQ, INDEX_HNSW)
+
+# Способы хранения векторов в плоском индексе: без сжатия, float16 (в 2 раза меньше),
+# 8-битное скалярное квантование (в 4 раза) и PQ из m подквантователей (в d*4/m раз)
+COMPRESSION_NONE = 'none'
+COMPRESSION_FP16 = 'fp16'
+COMPRESSION_SQ8 = 'sq8'
+COMPRESSION_PQ = 'pq'
+COMPRESSION_TYPES = (COMPRESSION_NONE, COMPRESSION_FP16, COMPRESSION_SQ8, COMPRESSION_PQ)
+# Для k-means PQ FAISS просит не меньше 39 точек на каждый из 256 центроидов
+_PQ_MIN_TRAIN_SIZE = 39 * 256
+
+# Кандидаты для подбора параметров поиска (от быстрых к точным)
+_NPROBE_CANDIDATES = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+_EF_SEARCH_CANDIDATES = (16, 32, 48, 64, 96, 128, 192, 256, 384, 512)
+
+
+def create_flat_index(dim: int) -> faiss.Index:
+    """Точный индекс полного перебора с собственными id. С него начинается любая база знаний."""
+    return faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+
+
+def index_kind(index: faiss.Index) -> str:
+    if isinstance(index, faiss.IndexIVFPQ):
+        return INDEX_IVF_PQ
+    if isinstance(index, faiss.IndexIVFFlat):
+        return INDEX_IVF_FLAT
+    if isinstance(index, faiss.IndexIDMap2) and isinstance(faiss.downcast_index(index.index), faiss.IndexHNSWFlat):
+        return INDEX_HNSW
+    return INDEX_FLAT
+
+
+def memory_bytes(index: faiss.Index) -> int:
+    """Оценка памяти, занятой индексом: векторы (или их коды), id и служебные структуры."""
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(base, faiss.IndexIVF):
+        return index.ntotal * (base.code_size + 8) + base.nlist * base.d * 4
+    if isinstance(base, faiss.IndexHNSW):
+        return index.ntotal * (base.d * 4 + base.hnsw.nb_neighbors(0) * 4 + 16)
+    # Плоский индекс: код вектора (float32 без сжатия) плюс id в IndexIDMap2 и обратной карте
+    return index.ntotal * (base.sa_code_size() + 16)
+
+
+def flat_compression(index: faiss.Index | None) -> str:
+    """Способ хранения векторов плоского индекса (для прочих индексов и отсутствующего индекса - none)."""
+    if index is None or index_kind(index) != INDEX_FLAT or not isinstance(index, faiss.IndexIDMap2):
+        return COMPRESSION_NONE
+    base = faiss.downcast_index(index.index)
+    if isinstance(base, faiss.IndexScalarQuantizer):
+        return COMPRESSION_FP16 if base.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else COMPRESSION_SQ8
+    if isinstance(base, faiss.IndexPQ):
+        return COMPRESSION_PQ
+    return COMPRESSION_NONE
+
+
+def is_lossy(index: faiss.Index | None) -> bool:
+    """True, если индекс хранит векторы приближенно и его выдачу стоит переранжировать по точным векторам."""
+    return index is not None and (index_kind(index) == INDEX_IVF_PQ or flat_compression(index) != COMPRESSION_NONE)
+
+
+def compression_min_size(compression: str) -> int:
+    """Сколько векторов нужно, чтобы обучить сжатие (до этого база хранится без сжатия)."""
+    return _PQ_MIN_TRAIN_SIZE if compression == COMPRESSION_PQ else 0
+
+
+def build_flat_index(compression: str, ids: np.ndarray, vectors: np.ndarray, pq_m: int = 48) -> faiss.Index:
+    """
+    Строит (и при необходимости обучает) плоский индекс полного перебора с заданным сжатием векторов.
+    :param pq_m: Число подквантователей PQ (должно делить размерность; иначе уменьшается до делителя).
+    """
+    dim = vectors.shape[1]
+    if compression == COMPRESSION_NONE:
+        index = create_flat_index(dim)
+    else:
+        if compression == COMPRESSION_PQ:
+            while dim % pq_m:
+                pq_m -= 1
+            description = f"PQ{pq_m}np"  # np - без долгого полисемантического обучения
+        else:
+            description = 'SQfp16' if compression == COMPRESSION_FP16 else 'SQ8'
+        inner = faiss.index_factory(dim, description)
+        train_size = min(len(vectors), 256 * 256)
+        train_vectors = (vectors[np.random.default_rng(0).choice(len(vectors), train_size, replace=False)]
+                         if train_size < len(vectors) else vectors)
+        inner.train(train_vectors)
+        index = faiss.IndexIDMap2(inner)
+    if len(ids):
+        index.add_with_ids(vectors, ids)
+    return index
+
+
+def compression_recall(index: faiss.Index, ids: np.ndarray, vectors: np.ndarray, rerank_factor: int,
+                       k: int = 10, sample_size: int = 500) -> Tuple[float, float]:
+    """
+    Recall@k сжатого индекса относительно точного поиска по исходным векторам: как есть
+    и после точного переранжирования k * rerank_factor кандидатов.
+    :return: (recall без переранжирования, recall с переранжированием)
+    """
+    n = len(ids)
+    k = min(k, n)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(n, min(sample_size, n), replace=False)]
+    _, positions = faiss.knn(queries, vectors, k)
+    ground_truth = ids[positions]
+    recall = measure_recall(index, queries, ground_truth)
+    _, candidates = index.search(queries, k * rerank_factor)
+    order = np.argsort(ids)
+    hits = 0
+    for query, row, truth_row in zip(queries, candidates, ground_truth):
+        row = row[row != -1]
+        rows = order[np.searchsorted(ids, row, sorter=order)]
+        distances = ((vectors[rows] - query) ** 2).sum(axis=1)
+        hits += len(set(row[np.argsort(distances)[:k]]) & set(truth_row))
+    return recall, hits / ground_truth.size
+
+
+def ensure_id_mapped(index: faiss.Index) -> faiss.Index:
+    """
+    Переводит индекс старого формата (IndexFlatL2 из LangChain, где id - позиция вектора)
+    в индекс с явными id. Id совпадают с прежними позициями, поэтому карта id остается верной.
+    """
+    if isinstance(index, (faiss.IndexIDMap2, faiss.IndexIVF)):
+        return index
+    logger.info(f"Перевожу индекс старого формата ({index.ntotal} векторов) на явные id.")
+    migrated = create_flat_index(index.d)
+    if index.ntotal:
+        migrated.add_with_ids(index.reconstruct_n(0, index.ntotal), np.arange(index.ntotal, dtype=np.int64))
+    return migrated
+
+
+def read_index(path: str, mmap: bool = False) -> Tuple[faiss.Index, bool]:
+    """
+    Читает индекс с диска. При mmap=True векторы не копируются в память, а отображаются из файла
+    (страницы подгружаются по мере обращения и разделяются всеми процессами, читающими тот же файл).
+    Такой индекс доступен только для чтения: перед изменением его нужно скопировать в память (copy_to_memory).
+    :return: (индекс, True если индекс отображен из файла)
+    """
+    if mmap:
+        # IO_FLAG_MMAP_IFC отображает коды плоских и IVF-индексов; старые сборки FAISS умеют только IO_FLAG_MMAP
+        mmap_flags = [faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY] if hasattr(faiss, 'IO_FLAG_MMAP_IFC') else []
+        mmap_flags.append(faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        for flags in mmap_flags:
+            try:
+                return faiss.read_index(path, flags), True
+            except RuntimeError as e:
+                logger.debug(f"Не удалось отобразить индекс {path} с флагами {flags}: {e}")
+        logger.warning(f"Индекс {path} не поддерживает отображение в память. Загружаю его целиком.")
+    return faiss.read_index(path), False
+
+
+def copy_to_memory(index: faiss.Index) -> faiss.Index:
+    """Полная копия индекса в памяти. clone_index не подходит: копия отображенного индекса ссылается на файл."""
+    return faiss.deserialize_index(faiss.serialize_index(index))
+
+
+def index_ids(index: faiss.Index) -> np.ndarray:
+    """Возвращает id всех записей индекса (без восстановления самих векторов)."""
+    if isinstance(index, faiss.IndexIVF):
+        invlists = index.invlists
+        ids = [faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+               for list_no in range(index.nlist) if invlists.list_size(list_no)]
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    return faiss.vector_to_array(index.id_map).astype(np.int64)
+
+
+def export_vectors(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """Возвращает (id, векторы) всех записей индекса. Для IVF-PQ векторы восстанавливаются приближенно."""
+    ids = index_ids(index)
+    if isinstance(index, faiss.IndexIVF):
+        vectors = index.reconstruct_batch(ids) if len(ids) else np.empty((0, index.d), dtype=np.float32)
+        return ids, vectors
+    vectors = index.index.reconstruct_n(0, index.ntotal) if index.ntotal else np.empty((0, index.d), np.float32)
+    return ids, vectors
+
+
+def remove_ids(index: faiss.Index, ids: np.ndarray) -> faiss.Index:
+    """
+    Удаляет векторы по id и возвращает индекс (возможно, новый).
+    HNSW не поддерживает удаление, поэтому граф перестраивается из оставшихся векторов.
+    """
+    if index_kind(index) != INDEX_HNSW:
+        index.remove_ids(ids)
+        return index
+    all_ids, vectors = export_vectors(index)
+    keep = ~np.isin(all_ids, ids)
+    hnsw = faiss.downcast_index(index.index).hnsw
+    rebuilt = faiss.IndexIDMap2(faiss.IndexHNSWFlat(index.d, hnsw.nb_neighbors(1)))
+    inner = faiss.downcast_index(rebuilt.index)
+    inner.hnsw.efConstruction, inner.hnsw.efSearch = hnsw.efConstruction, hnsw.efSearch
+    rebuilt.add_with_ids(vectors[keep], all_ids[keep])
+    return rebuilt
+
+
+def search_params(index: faiss.Index, ids: np.ndarray, exclude: bool = True) -> faiss.SearchParameters:
+    """
+    Параметры поиска, исключающие из выдачи заданные id (exclude=False - оставляющие только их).
+    Текущие nprobe / efSearch индекса сохраняются: параметры, переданные в search, заменяют
+    собственные настройки индекса.
+    """
+    selector = faiss.IDSelectorBatch(ids)
+    if exclude:
+        selector = faiss.IDSelectorNot(selector)
+    kind = index_kind(index)
+    if kind in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    if kind == INDEX_HNSW:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=faiss.downcast_index(index.index).hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def build_ann_index(kind: str, ids: np.ndarray, vectors: np.ndarray, nlist: int = 0, pq_m: int = 48,
+                    hnsw_m: int = 32) -> faiss.Index:
+    """
+    Строит и (для IVF) обучает ANN-индекс заданного типа на переданных векторах.
+    :param nlist: Число кластеров IVF; 0 - подобрать по размеру базы (~4*sqrt(N)).
+    :param pq_m: Число подквантователей IVF-PQ (должно делить размерность).
+    :param hnsw_m: Число связей вершины в графе HNSW.
+    """
+    n, dim = vectors.shape
+    if kind == INDEX_HNSW:
+        index = faiss.IndexIDMap2(faiss.IndexHNSWFlat(dim, hnsw_m))
+        faiss.downcast_index(index.index).hnsw.efConstruction = max(40, 2 * hnsw_m)
+        index.add_with_ids(vectors, ids)
+        return index
+
+    if not nlist:
+        # Не меньше ~39 точек на кластер, иначе k-means FAISS обучается плохо
+        nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+    quantizer = faiss.IndexFlatL2(dim)
+    if kind == INDEX_IVF_PQ:
+        while dim % pq_m:
+            pq_m -= 1
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, 8)
+    elif kind == INDEX_IVF_FLAT:
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+    else:
+        raise ValueError(f"Неизвестный тип индекса: {kind}")
+    # Для обучения достаточно 256 точек на кластер (больше FAISS все равно не использует)
+    train_size = min(n, 256 * nlist)
+    train_vectors = vectors[np.random.default_rng(0).choice(n, train_size, replace=False)] if train_size < n else vectors
+    index.train(train_vectors)
+    # Хеш-таблица id -> позиция нужна для reconstruct и для удаления по id
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    index.add_with_ids(vectors, ids)
+    return index
+
+
+def set_search_param(index: faiss.Index, value: int):
+    """Устанавливает nprobe (IVF) или efSearch (HNSW)."""
+    kind = index_kind(index)
+    if kind in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        index.nprobe = value
+    elif kind == INDEX_HNSW:
+        faiss.downcast_index(index.index).hnsw.efSearch = value
+
+
+def measure_recall(index: faiss.Index, queries: np.ndarray, ground_truth: np.ndarray) -> float:
+    """Recall@k: доля истинных k ближайших соседей (по точному поиску), найденных индексом."""
+    k = ground_truth.shape[1]
+    _, found = index.search(queries, k)
+    hits = sum(len(set(found_row) & set(truth_row)) for found_row, truth_row in zip(found, ground_truth))
+    return hits / ground_truth.size
+
+
+def tune_search_params(index: faiss.Index, ids: np.ndarray, vectors: np.ndarray, k: int = 10,
+                       target_recall: float = 0.95, sample_size: int = 500) -> Tuple[int | None, float]:
+    """
+    Подбирает минимальный nprobe/efSearch, при котором recall@k относительно точного поиска
+    не ниже target_recall. Запросами служит случайная выборка векторов самой базы.
+    :return: (выбранное значение параметра или None для плоского индекса, достигнутый recall)
+    """
+    kind = index_kind(index)
+    n = len(ids)
+    k = min(k, n)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(n, min(sample_size, n), replace=False)]
+    # Точные соседи считаются прямо по матрице, без копирования ее во временный индекс
+    _, positions = faiss.knn(queries, vectors, k)
+    ground_truth = ids[positions]
+
+    if kind == INDEX_FLAT:
+        return None, measure_recall(index, queries, ground_truth)
+
+    if kind == INDEX_HNSW:
+        candidates = _EF_SEARCH_CANDIDATES
+    else:
+        candidates = [c for c in _NPROBE_CANDIDATES if c < index.nlist] + [index.nlist]
+    best_value, best_recall = None, 0.0
+    for value in candidates:
+        set_search_param(index, max(value, k) if kind == INDEX_HNSW else value)
+        recall = measure_recall(index, queries, ground_truth)
+        best_value, best_recall = value, recall
+        if recall >= target_recall:
+            break
+    if best_recall < target_recall:
+        logger.warning(f"Индекс {kind} не достиг целевого recall@{k}={target_recall:.2f} "
+                       f"(лучший: {best_recall:.3f}). Используются самые точные параметры поиска.")
+    set_search_param(index, max(best_value, k) if kind == INDEX_HNSW else best_value)
+    return best_value, best_recall
+
+# END OF FILE vector_index.py #
@@ -0,0 +1,173 @@
+# START OF FILE vector_store_log.py #
+
+import os
+import json
+import time
+import zlib
+import struct
+import logging
+import threading
+from typing import Any, Dict, Iterator, NamedTuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Заголовок записи: сигнатура, CRC32 (метаданные + данные), длина метаданных, длина данных
+_RECORD_MAGIC = b'KBWL'
+_RECORD_HEADER = struct.Struct('<4sIII')
+
+
+class LogRecord(NamedTuple):
+    op: str
+    payload: Dict[str, Any]
+    vectors: np.ndarray | None
+    ts: float
+
+
+class VectorStoreLog:
+    """
+    Журнал упреждающей записи (WAL) для базы знаний.
+    Изменения (добавление векторов и чанков, удаление, очистка) дописываются в конец файла,
+    вместо того чтобы каждый раз переписывать весь индекс. Каждая запись защищена CRC32,
+    поэтому недописанный при сбое "хвост" журнала обнаруживается и отбрасывается при чтении.
+
+    При компактизации активный журнал "поворачивается" в файл `<path>.1`, который удаляется
+    только после того, как новый снимок базы полностью записан на диск.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rotated_path = f"{path}.1"
+        self._lock = threading.Lock()
+        self._file = None
+        self._first_record_ts: float | None = None
+
+    @property
+    def size_bytes(self) -> int:
+        """Суммарный размер активного и повернутого журналов."""
+        return sum(os.path.getsize(p) for p in (self.path, self.rotated_path) if os.path.exists(p))
+
+    @property
+    def age_seconds(self) -> float:
+        """Время с момента первой записи, не попавшей в снимок. 0, если журнал пуст."""
+        if self._first_record_ts is None:
+            return 0.0
+        return time.time() - self._first_record_ts
+
+    def append(self, op: str, payload: Dict[str, Any], vectors: np.ndarray | None = None):
+        """
+        Дописывает запись в журнал и сбрасывает ее на диск (fsync).
+        :param op: Тип операции ('add', 'delete', 'clear').
+        :param payload: JSON-сериализуемые данные операции.
+        :param vectors: Необязательная матрица векторов float32.
+        """
+        ts = time.time()
+        meta = {'op': op, 'ts': ts, 'payload': payload}
+        data = b''
+        if vectors is not None:
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            meta['shape'] = list(vectors.shape)
+            data = vectors.tobytes()
+        meta_bytes = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+        crc = zlib.crc32(data, zlib.crc32(meta_bytes))
+        record = _RECORD_HEADER.pack(_RECORD_MAGIC, crc, len(meta_bytes), len(data)) + meta_bytes + data
+
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'ab')
+            self._file.write(record)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if self._first_record_ts is None:
+                self._first_record_ts = ts
+
+    def replay(self) -> Iterator[LogRecord]:
+        """
+        Последовательно читает все целые записи: сначала из повернутого журнала, затем из активного.
+        Поврежденный или недописанный хвост файла отрезается.
+        """
+        for path in (self.rotated_path, self.path):
+            if os.path.exists(path):
+                yield from self._read_file(path)
+
+    def _read_file(self, path: str) -> Iterator[LogRecord]:
+        valid_end = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    break
+                magic, crc, meta_len, data_len = _RECORD_HEADER.unpack(header)
+                if magic != _RECORD_MAGIC:
+                    break
+                meta_bytes, data = f.read(meta_len), f.read(data_len)
+                if len(meta_bytes) < meta_len or len(data) < data_len:
+                    break
+                if zlib.crc32(data, zlib.crc32(meta_bytes)) != crc:
+                    break
+                meta = json.loads(meta_bytes.decode('utf-8'))
+                vectors = None
+                if 'shape' in meta:
+                    vectors = np.frombuffer(data, dtype=np.float32).reshape(meta['shape'])
+                valid_end = f.tell()
+                if self._first_record_ts is None:
+                    self._first_record_ts = meta['ts']
+                yield LogRecord(meta['op'], meta['payload'], vectors, meta['ts'])
+            file_size = f.seek(0, os.SEEK_END)
+
+        if valid_end < file_size:
+            logger.warning(f"Журнал {path} содержит недописанную или поврежденную запись. "
+                           f"Отбрасываю {file_size - valid_end} байт в конце файла.")
+            with open(path, 'r+b') as f:
+                f.truncate(valid_end)
+                os.fsync(f.fileno())
+
+    def rotate(self):
+        """
+        Закрывает активный журнал и переносит его содержимое в повернутый файл.
+        Новые записи после этого попадают в чистый активный журнал.
+        """
+        with self._lock:
+            self._close()
+            self._first_record_ts = None
+            if not os.path.exists(self.path):
+                return
+            if os.path.exists(self.rotated_path):
+                # Предыдущая компактизация не завершилась: дописываем, чтобы не потерять записи.
+                with open(self.path, 'rb') as src, open(self.rotated_path, 'ab') as dst:
+                    while block := src.read(1024 * 1024):
+                        dst.write(block)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+
+    def discard_rotated(self):
+        """Удаляет повернутый журнал после того, как его записи вошли в снимок."""
+        with self._lock:
+            if os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+
+    def reset(self):
+        """Полностью удаляет журнал (например, при очистке базы знаний)."""
+        with self._lock:
+            self._close()
+            for path in (self.path, self.rotated_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._first_record_ts = None
+
+    def close(self):
+        """Закрывает файл журнала (записи остаются на диске)."""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+# END OF FILE vector_store_log.py #